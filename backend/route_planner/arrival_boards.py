@@ -0,0 +1,185 @@
+"""
+Per-stop arrival boards, recomputed once per feed refresh
+
+The arrival predictor places every live bus on its route pattern each
+refresh (see eta_engine). From there each upcoming stop within the horizon
+gets a predicted arrival: scheduled running time along the pattern scaled
+to the bus's measured speed (or the route's typical speed), plus dwell at
+the stops in between.
+
+All predictions land in one array sorted by (stop, arrival time) with a
+per-stop offset table, so answering "what arrives at this stop" is a slice
+of an already-sorted board instead of a fresh prediction for every bus.
+"""
+
+import time
+import numpy as np
+from .plan_cache import snap, CELL_DEG
+from .raptor import get_raptor_router
+from .tracing import traced
+
+HORIZON_MINUTES = 60        # Arrivals further ahead are not posted
+SNAP_RADIUS_KM = 0.3        # A location reads the boards of stops this close
+MAX_SNAP_CELLS = 100000
+
+
+class _Board:
+    """One feed refresh's predictions, sorted by (stop, arrival time)"""
+
+    def __init__(self, tt, buses, predictor, stop_ptr, arrive_at, bus, along_km, speed, confidence):
+        self.tt = tt
+        self.buses = buses
+        self.predictor = predictor
+        self.stop_ptr = stop_ptr
+        self.arrive_at = arrive_at
+        self.bus = bus
+        self.along_km = along_km
+        self.speed = speed
+        self.confidence = confidence
+
+
+class ArrivalBoards:
+    """Predicted arrivals at every stop, swapped in whole on each feed refresh"""
+
+    def __init__(self, route_mapper):
+        self.route_mapper = route_mapper
+        self._board = None
+        self._stop_cells = (None, {})
+        self._route_names = {}
+        self.refreshes = 0
+        self.last_refresh_ms = 0.0
+
+    def refresh(self, buses, predictor, feed_time=None):
+        """Recompute every board from the buses the predictor placed; returns the number of arrivals posted"""
+        started = time.perf_counter()
+        placement = predictor.eta.placement
+        if placement is None or placement.buses is not buses or len(placement) == 0:
+            self._board = None
+            return 0
+        tt = placement.geometry.tt
+        feed_time = feed_time or int(time.time())
+        bus_index = placement.bus
+
+        # Speed: measured when the bus is moving, else the route's typical speed
+        slots = predictor.history.slots([buses[i]['id'] for i in bus_index.tolist()])
+        measured, count = predictor.history.motion(slots)
+        moving = measured >= 1
+        confidence = np.where(moving, np.minimum(0.9, 0.5 + np.minimum(count, 10) * 0.05),
+                              np.where(np.isnan(measured), 0.3, 0.2))
+        typical = predictor.profiles.speeds([buses[i].get('route_id') for i in bus_index.tolist()], feed_time)
+        speed = np.where(moving, measured, typical)
+
+        # Every upcoming stop of each placed bus
+        end = tt.pattern_stop_ptr[placement.pattern + 1]
+        remaining = end - placement.next_entry
+        owner = np.repeat(np.arange(len(bus_index)), remaining)
+        entry = np.arange(int(remaining.sum())) - np.repeat(np.cumsum(remaining) - remaining, remaining) \
+            + placement.next_entry[owner]
+        arrive_at = placement.reported[owner] + placement.travel_seconds(owner, entry, speed[owner])
+        keep = np.flatnonzero(arrive_at - feed_time <= HORIZON_MINUTES * 60)
+        owner, entry, arrive_at = owner[keep], entry[keep], arrive_at[keep]
+        along_km = placement.along_m(owner, entry) / 1000
+        stops = tt.pattern_stops[entry]
+
+        order = np.lexsort((arrive_at, stops))
+        stop_ptr = np.concatenate([[0], np.cumsum(np.bincount(stops, minlength=tt.n_stops))])
+        self._name_routes(buses[i].get('route_id') for i in bus_index.tolist())
+        self._board = _Board(
+            tt, buses, predictor, stop_ptr,
+            arrive_at=arrive_at[order],
+            bus=bus_index[owner[order]],
+            along_km=along_km[order],
+            speed=speed[owner[order]],
+            confidence=confidence[owner[order]],
+        )
+        self.refreshes += 1
+        self.last_refresh_ms = (time.perf_counter() - started) * 1000
+        return len(order)
+
+    def _name_routes(self, route_ids):
+        """Look up display names once per route rather than once per arrival"""
+        for route_id in set(route_ids):
+            if route_id not in self._route_names:
+                route_info = self.route_mapper.get_route_info(route_id, mode='bus')
+                self._route_names[route_id] = route_info.get('name', f"Bus {route_id}")
+
+    def stop_index(self, stop_id):
+        board = self._board
+        if board is not None:
+            return board.tt.stop_index(stop_id)
+        router = get_raptor_router()
+        return None if router is None else router.tt.stop_index(stop_id)
+
+    @traced
+    def stops_near(self, lat, lon):
+        """Bus stops within SNAP_RADIUS_KM of a location, nearest first (cached per grid cell)"""
+        board = self._board
+        if board is None:
+            return np.empty(0, dtype=np.int64)
+        tt = board.tt
+        if self._stop_cells[0] is not tt:
+            self._stop_cells = (tt, {})
+        stop_cells = self._stop_cells[1]
+        cell = snap(lat, lon)
+        stops = stop_cells.get(cell)
+        if stops is None:
+            idx, km = tt.nearby_stops(cell[0] * CELL_DEG, cell[1] * CELL_DEG, SNAP_RADIUS_KM)
+            keep = ~tt.stop_is_metro[idx]
+            stops = idx[keep][np.argsort(km[keep], kind='stable')]
+            if len(stop_cells) >= MAX_SNAP_CELLS:
+                stop_cells.clear()
+            stop_cells[cell] = stops
+        return stops
+
+    @traced
+    def arrivals(self, stops, limit=5, route_id=None, now=None):
+        """Soonest arrivals over some stops' boards, one per bus, as arrival dicts"""
+        board = self._board
+        if board is None or len(stops) == 0:
+            return []
+        now = time.time() if now is None else now
+        ptr = board.stop_ptr
+        rows = np.concatenate([np.arange(ptr[s], ptr[s + 1]) for s in np.asarray(stops).tolist()])
+        rows = rows[board.arrive_at[rows] >= now]
+        if route_id:
+            rows = rows[[board.buses[b].get('route_id') == route_id for b in board.bus[rows].tolist()]]
+        if len(stops) > 1:
+            rows = rows[np.argsort(board.arrive_at[rows], kind='stable')]
+            _, first = np.unique(board.bus[rows], return_index=True)
+            rows = rows[np.sort(first)]
+        rows = rows[:limit]
+
+        tt = board.tt
+        stop_of = np.searchsorted(ptr, rows, side='right') - 1
+        arrivals = []
+        for row, stop in zip(rows.tolist(), stop_of.tolist()):
+            bus = board.buses[board.bus[row]]
+            eta_minutes = max(1, int(round((board.arrive_at[row] - now) / 60)))
+            arrivals.append({
+                'route_id': bus['route_id'],
+                'route_name': self._route_names.get(bus['route_id'], f"Bus {bus['route_id']}"),
+                'bus_id': bus['id'],
+                'stop_id': str(tt.stop_ids[stop]),
+                'stop_name': str(tt.stop_names[stop]),
+                'eta_minutes': eta_minutes,
+                'eta_formatted': board.predictor.format_arrival_time(eta_minutes),
+                'confidence': round(float(board.confidence[row]), 2),
+                'status': 'approaching',
+                'speed_kmh': round(float(board.speed[row]), 1),
+                'distance_km': round(float(board.along_km[row]), 2),
+                'current_position': {
+                    'lat': bus['lat'],
+                    'lon': bus['lon']
+                }
+            })
+        return arrivals
+
+    def stats(self):
+        board = self._board
+        return {
+            'stops_with_arrivals': 0 if board is None else int(np.count_nonzero(np.diff(board.stop_ptr))),
+            'arrivals': 0 if board is None else len(board.arrive_at),
+            'buses_placed': 0 if board is None else len(np.unique(board.bus)),
+            'refreshes': self.refreshes,
+            'last_refresh_ms': round(self.last_refresh_ms, 1),
+        }
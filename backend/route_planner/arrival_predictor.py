@@ -1,100 +1,104 @@
 """
 Real-time arrival prediction for buses
 Calculates when buses will reach user's location based on:
-- Current bus position
+- Current bus position, along its route where it can be placed on one
 - Historical speed tracking
 - Distance to user
 - Time of day patterns
 """
 
 from datetime import datetime, timedelta
-from geopy.distance import geodesic
-from collections import defaultdict
 import math
+import time
+import numpy as np
+from .geo import haversine_km
+from .vehicle_history import VehicleHistory, TTL_SECONDS
+from .speed_profiles import get_speed_profiles
+from .eta_engine import EtaEngine
+from .tracing import traced
 
 class ArrivalPredictor:
     """Predicts when buses will arrive at user's location"""
     
     def __init__(self):
-        self.bus_history = defaultdict(list)  # Track bus positions over time
-        self.speed_cache = {}  # Cache calculated speeds
-        self.last_cleanup = datetime.now()
+        self.history = VehicleHistory()  # Track bus positions over time, within a memory budget
+        self.profiles = get_speed_profiles()  # Typical speed per route and time of week
+        self.eta = EtaEngine()  # Where each bus is along its route pattern
     
-    def update_bus_position(self, bus_id, lat, lon, timestamp):
-        """Track bus position over time to calculate speed"""
-        self.bus_history[bus_id].append({
-            'lat': lat,
-            'lon': lon,
-            'timestamp': timestamp,
-            'time': datetime.now()
-        })
+    @traced
+    def update_from_feed(self, buses, feed_timestamp=None):
+        """
+        Record every vehicle of a feed refresh; returns the indices of the
+        buses whose reports were new (see VehicleHistory.ingest)
+        
+        Reports are stamped with the vehicle's own timestamp (the feed
+        header's when it has none), so speeds follow the GPS fixes rather
+        than when the feed happened to be fetched.
+        """
+        fallback = feed_timestamp or int(time.time())
+        ids = [bus.get('id') for bus in buses]
+        timestamps = np.array([bus.get('timestamp') or fallback for bus in buses], dtype=np.int64)
+        recorded = self.history.ingest(
+            ids,
+            [bus.get('lat') for bus in buses],
+            [bus.get('lon') for bus in buses],
+            timestamps
+        )
+        
+        # New speed measurements feed the route speed profiles
+        speeds, _ = self.history.motion(self.history.slots([ids[i] for i in recorded.tolist()]))
+        self.profiles.add([buses[i].get('route_id') for i in recorded.tolist()], speeds, timestamps[recorded])
+        self.profiles.maybe_save()
         
-        # Keep only last 10 positions (last ~10 minutes)
-        if len(self.bus_history[bus_id]) > 10:
-            self.bus_history[bus_id] = self.bus_history[bus_id][-10:]
+        try:
+            self.eta.place(buses, self.history, fallback)
+        except Exception as e:
+            print(f"⚠ Could not place buses on their routes: {e}")
+        return recorded
+    
+    def warm_start(self, records):
+        """
+        Rebuild the position history from logged reports
         
-        # Cleanup old data every hour
-        if (datetime.now() - self.last_cleanup).seconds > 3600:
-            self._cleanup_old_data()
+        records is a dict of arrays as returned by PositionLog.read(). Each
+        vehicle's reports are replayed in timestamp order, the n-th report
+        of every vehicle in one batch. Speed profiles are not fed again:
+        they were persisted when the reports first arrived.
+        """
+        vehicle_ids = records['vehicle_id']
+        if len(vehicle_ids) == 0:
+            return 0
+        names, codes = np.unique(vehicle_ids.astype(str), return_inverse=True)
+        order = np.lexsort((records['timestamp'], codes))
+        codes = codes[order]
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+        rank = np.arange(len(codes)) - np.repeat(starts, np.diff(np.r_[starts, len(codes)]))
+        
+        for r in range(int(rank.max()) + 1):
+            rows = order[rank == r]
+            self.history.ingest(names[codes[rank == r]].tolist(), records['lat'][rows],
+                                records['lon'][rows], records['timestamp'][rows])
+        return len(order)
+    
+    def update_bus_position(self, bus_id, lat, lon, timestamp):
+        """Track one bus position over time to calculate speed"""
+        self.history.ingest([bus_id], [lat], [lon], [timestamp or int(time.time())])
     
     def _cleanup_old_data(self):
         """Remove buses that haven't been seen in 30 minutes"""
-        cutoff = datetime.now() - timedelta(minutes=30)
-        buses_to_remove = []
-        
-        for bus_id, history in self.bus_history.items():
-            if not history or history[-1]['time'] < cutoff:
-                buses_to_remove.append(bus_id)
-        
-        for bus_id in buses_to_remove:
-            del self.bus_history[bus_id]
-            if bus_id in self.speed_cache:
-                del self.speed_cache[bus_id]
-        
-        self.last_cleanup = datetime.now()
+        return self.history.evict_older_than(time.time() - TTL_SECONDS)
+    
+    def start_cleanup(self):
+        """Forget unseen buses on a background timer instead of during updates"""
+        return self.history.start_evictor()
     
+    @traced
     def calculate_bus_speed(self, bus_id):
         """
-        Calculate bus's current speed based on recent positions
-        Returns speed in km/h
+        Bus's current speed based on its recent positions
+        Returns speed in km/h, or None without enough history
         """
-        if bus_id not in self.bus_history:
-            return None
-        
-        history = self.bus_history[bus_id]
-        
-        if len(history) < 2:
-            return None
-        
-        # Calculate speed from last 2-3 positions
-        recent = history[-3:] if len(history) >= 3 else history[-2:]
-        
-        total_distance = 0
-        total_time = 0
-        
-        for i in range(len(recent) - 1):
-            pos1 = recent[i]
-            pos2 = recent[i + 1]
-            
-            # Distance in km
-            distance = geodesic(
-                (pos1['lat'], pos1['lon']),
-                (pos2['lat'], pos2['lon'])
-            ).km
-            
-            # Time in hours
-            time_diff = (pos2['time'] - pos1['time']).seconds / 3600.0
-            
-            if time_diff > 0:
-                total_distance += distance
-                total_time += time_diff
-        
-        if total_time > 0:
-            speed = total_distance / total_time  # km/h
-            self.speed_cache[bus_id] = speed
-            return speed
-        
-        return None
+        return self.history.speed(bus_id)
     
     def calculate_bearing(self, lat1, lon1, lat2, lon2):
         """Calculate bearing between two points"""
@@ -105,33 +109,18 @@ class ArrivalPredictor:
         bearing = math.atan2(x, y)
         return (math.degrees(bearing) + 360) % 360
     
-    def is_bus_approaching(self, bus_lat, bus_lon, user_lat, user_lon):
+    @traced
+    def is_bus_approaching(self, bus_id, user_lat, user_lon):
         """
         Check if bus is moving towards user or away
         Returns: 'approaching', 'moving_away', or 'unknown'
         """
-        bus_id = f"{bus_lat}_{bus_lon}"  # Temporary ID
-        
-        if bus_id not in self.bus_history or len(self.bus_history[bus_id]) < 2:
+        _, lat, lon = self.history.recent(bus_id, 2)
+        if len(lat) < 2:
             return 'unknown'
         
-        history = self.bus_history[bus_id]
-        
-        # Get previous position
-        prev_pos = history[-2]
-        curr_pos = history[-1]
-        
-        # Distance from previous position to user
-        prev_distance = geodesic(
-            (prev_pos['lat'], prev_pos['lon']),
-            (user_lat, user_lon)
-        ).km
-        
-        # Distance from current position to user
-        curr_distance = geodesic(
-            (curr_pos['lat'], curr_pos['lon']),
-            (user_lat, user_lon)
-        ).km
+        # Distance from the previous and the current position to the user
+        prev_distance, curr_distance = haversine_km(lat, lon, user_lat, user_lon)
         
         # If getting closer, it's approaching
         if curr_distance < prev_distance:
@@ -139,6 +128,7 @@ class ArrivalPredictor:
         else:
             return 'moving_away'
     
+    @traced
     def predict_arrival_time(self, bus, user_lat, user_lon):
         """
         Predict when bus will arrive at user's location
@@ -148,121 +138,114 @@ class ArrivalPredictor:
             'eta_minutes': int,
             'eta_time': datetime,
             'confidence': float (0-1),
-            'status': 'approaching' | 'moving_away' | 'stationary',
+            'status': 'approaching' | 'moving_away' | 'stationary' | 'off_route' | 'unknown',
             'speed_kmh': float
         }
         """
-        bus_id = bus.get('id')
-        bus_lat = bus.get('lat')
-        bus_lon = bus.get('lon')
-        
-        # Calculate distance to user
-        distance_km = geodesic((bus_lat, bus_lon), (user_lat, user_lon)).km
-        
-        # Update position history
-        self.update_bus_position(
-            bus_id, 
-            bus_lat, 
-            bus_lon, 
-            bus.get('timestamp', 0)
-        )
-        
-        # Calculate bus speed
-        speed = self.calculate_bus_speed(bus_id)
-        
-        # Determine if approaching
-        status = self.is_bus_approaching(bus_lat, bus_lon, user_lat, user_lon)
-        
-        # Default values
-        default_speed = self._get_default_speed_by_time()
-        
-        if speed is None:
-            # No history, use default speed
-            speed = default_speed
-            confidence = 0.3  # Low confidence
-        elif speed < 1:
-            # Bus is stationary or very slow
-            status = 'stationary'
-            speed = default_speed  # Assume it will start moving
-            confidence = 0.2
-        else:
-            # We have real speed data
-            confidence = min(0.9, 0.5 + (len(self.bus_history[bus_id]) * 0.05))
-        
-        # Adjust speed based on status
-        if status == 'moving_away':
-            # Bus is going away, might come back on route
-            # Assume it needs to complete loop
-            speed = speed * 0.5  # Will take longer
-            confidence = confidence * 0.5
-        
-        # Calculate ETA
-        if speed > 0:
-            eta_hours = distance_km / speed
-            eta_minutes = int(eta_hours * 60)
-            
-            # Add buffer for stops (1 min per km)
-            stop_buffer = int(distance_km * 1)
-            eta_minutes += stop_buffer
-            
-            # Cap at reasonable values
-            eta_minutes = max(1, min(eta_minutes, 120))  # 1-120 minutes
-            
-            eta_time = datetime.now() + timedelta(minutes=eta_minutes)
-        else:
-            eta_minutes = 999
-            eta_time = None
-            confidence = 0
+        prediction = {key: value[0] for key, value in self.predict_batch([bus], user_lat, user_lon).items()}
+        eta_minutes = int(prediction['eta_minutes'])
         
         return {
             'eta_minutes': eta_minutes,
-            'eta_time': eta_time,
-            'confidence': round(confidence, 2),
-            'status': status,
-            'speed_kmh': round(speed, 1) if speed else 0,
-            'distance_km': round(distance_km, 2)
+            'eta_time': datetime.now() + timedelta(minutes=eta_minutes),
+            'confidence': float(prediction['confidence']),
+            'status': str(prediction['status']),
+            'speed_kmh': float(prediction['speed_kmh']),
+            'distance_km': float(prediction['distance_km'])
         }
     
-    def _get_default_speed_by_time(self):
-        """Get default speed based on time of day (traffic patterns)"""
-        hour = datetime.now().hour
+    @traced
+    def predict_batch(self, vehicles, user_lat, user_lon, when=None):
+        """
+        Predict when each of many vehicles reaches the user's location
+        
+        Distance, approach status, speed and ETA are computed for all
+        vehicles at once. Buses placed on their route pattern are timed
+        along it to the pattern stop nearest the user; others by straight
+        line distance. Returns a dict of arrays with one entry per
+        vehicle: eta_minutes, confidence, status, speed_kmh, distance_km
+        (as in predict_arrival_time). `when` (epoch seconds, default now)
+        picks the typical speeds; replays pass the recording's time.
+        """
+        ids = [bus.get('id') for bus in vehicles]
+        lat = np.array([bus.get('lat') for bus in vehicles], dtype=np.float64)
+        lon = np.array([bus.get('lon') for bus in vehicles], dtype=np.float64)
+        distance_km = haversine_km(lat, lon, user_lat, user_lon)
+        
+        # Speed and the last two positions from the history
+        slots = self.history.slots(ids)
+        speed, count = self.history.motion(slots)
+        prev_distance = haversine_km(*self.history.positions(slots, back=1), user_lat, user_lon)
+        curr_distance = haversine_km(*self.history.positions(slots), user_lat, user_lon)
+        status = np.where(count < 2, 'unknown',
+                          np.where(curr_distance < prev_distance, 'approaching', 'moving_away'))
+        
+        # No history: the route's typical speed now, low confidence.
+        # Stationary or very slow: assume it will start moving at that speed
+        measured = ~np.isnan(speed)
+        stationary = measured & (speed < 1)
+        confidence = np.where(measured, np.minimum(0.9, 0.5 + np.minimum(count, 10) * 0.05), 0.3)
+        confidence[stationary] = 0.2
+        typical = self.profiles.speeds([bus.get('route_id') for bus in vehicles], when)
+        speed = np.where(measured & ~stationary, speed, typical)
+        status[stationary] = 'stationary'
+        
+        # On a known route the approach is decided by the stop sequence, not
+        # by getting closer: a bus on another road may be closing in too
+        _, seconds, along_km, route_status = self.eta.to_point(ids, user_lat, user_lon, speed)
+        status = np.where(route_status != 'unknown', route_status.astype(str), status)
+        along = ~np.isnan(seconds)
+        
+        # Bus is going away, might come back on route: assume it needs to
+        # complete the loop
+        away = status == 'moving_away'
+        speed = np.where(away, speed * 0.5, speed)
+        confidence = np.where(away, confidence * 0.5, confidence)
+        
+        # Off a known route: ETA plus a buffer for stops (1 min per km).
+        # Capped at 1-120 minutes
+        eta_minutes = (distance_km / speed * 60).astype(np.int64) + distance_km.astype(np.int64)
+        eta_minutes = np.where(along, np.ceil(np.nan_to_num(seconds) / 60), eta_minutes).astype(np.int64)
+        eta_minutes = np.clip(eta_minutes, 1, 120)
+        distance_km = np.where(along, along_km, distance_km)
         
-        # Peak hours: slower
-        if 8 <= hour <= 10 or 17 <= hour <= 20:
-            return 15  # km/h (heavy traffic)
-        # Mid-day: moderate
-        elif 10 < hour < 17:
-            return 22  # km/h (moderate traffic)
-        # Night: faster
-        else:
-            return 30  # km/h (light traffic)
+        return {
+            'eta_minutes': eta_minutes,
+            'confidence': np.round(confidence, 2),
+            'status': status,
+            'speed_kmh': np.round(speed, 1),
+            'distance_km': np.round(distance_km, 2)
+        }
     
+    @traced
     def get_next_buses_at_stop(self, user_lat, user_lon, route_id, buses, limit=3):
         """
         Get next N buses arriving at user's location for a specific route
         
         Returns list of buses with arrival predictions, sorted by ETA
         """
-        predictions = []
-        
-        for bus in buses:
-            if bus.get('route_id') != route_id:
-                continue
-            
-            prediction = self.predict_arrival_time(bus, user_lat, user_lon)
-            
-            # Only include approaching or unknown buses
-            if prediction['status'] in ['approaching', 'unknown']:
-                predictions.append({
-                    'bus_id': bus.get('id'),
-                    'vehicle_label': bus.get('vehicle_id', bus.get('id')),
-                    **prediction
-                })
-        
-        # Sort by ETA
-        predictions.sort(key=lambda x: x['eta_minutes'])
-        
-        return predictions[:limit]
+        buses = [bus for bus in buses if bus.get('route_id') == route_id]
+        if not buses:
+            return []
+        
+        prediction = self.predict_batch(buses, user_lat, user_lon)
+        
+        # Only include approaching or unknown buses, soonest first
+        keep = np.flatnonzero(np.isin(prediction['status'], ['approaching', 'unknown']))
+        keep = keep[np.argsort(prediction['eta_minutes'][keep], kind='stable')][:limit]
+        
+        return [
+            {
+                'bus_id': buses[i].get('id'),
+                'vehicle_label': buses[i].get('vehicle_id', buses[i].get('id')),
+                'eta_minutes': int(prediction['eta_minutes'][i]),
+                'confidence': float(prediction['confidence'][i]),
+                'status': str(prediction['status'][i]),
+                'speed_kmh': float(prediction['speed_kmh'][i]),
+                'distance_km': float(prediction['distance_km'][i])
+            }
+            for i in keep.tolist()
+        ]
     
     def format_arrival_time(self, eta_minutes):
         """Format ETA in human-readable form"""
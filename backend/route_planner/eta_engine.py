@@ -0,0 +1,317 @@
+"""
+Along-route arrival times from each vehicle's position on its trip
+
+Every route pattern (a route's stop sequence) gets, once per static data
+version:
+
+- stop_m: each stop's distance along the trip's shape, projected in
+  order so loops cannot pull a stop back onto an earlier leg (the
+  straight-line stop-to-stop chain when there is no usable shape);
+- stop_s: the scheduled running time from the first stop (median over the
+  pattern's trips, dwell excluded), so slow and fast stretches keep their
+  proportions;
+- dwell_s: scheduled dwell before each stop, at least MIN_DWELL_SECONDS
+  per intermediate stop.
+
+Each feed refresh places every bus on a pattern (its trip's, or the
+route's pattern it is closest to and moving forwards along) at a distance
+d along it. The time to reach a later stop k is then a few array lookups:
+
+    (stop_s[k] - s(d)) * scheduled speed / live speed + dwell_s[k] - dwell_s[next]
+"""
+
+import threading
+import time
+import numpy as np
+from .geo import haversine_km, project_m
+from .raptor import get_raptor_router
+from .shape_index import get_shape_index
+from .tracing import traced
+
+MIN_DWELL_SECONDS = 10      # Dwell assumed at intermediate stops the schedule gives none
+MAX_STOP_OFFSET_M = 300     # Stops further than this from the shape make the pattern fall back to straight lines
+MAX_OFF_ROUTE_KM = 0.5      # Buses further than this from every stop of their pattern are not placed
+BACKWARD_PENALTY_KM = 1.0   # Candidate patterns the bus moves backwards along count as this much further
+USER_STOP_KM = 1.0          # Predictions to a point go to the pattern's stop nearest to it, within this
+KEY_M = 1e7                 # > any pattern length in metres: separates patterns in search keys
+
+
+def _nearest_positions(tt, patterns, lat, lon):
+    """Position and distance (km) of the stop of each pattern nearest to each point"""
+    n = tt.pattern_n_stops[patterns]
+    starts = np.cumsum(n) - n
+    owner = np.repeat(np.arange(len(patterns)), n)
+    position = np.arange(int(n.sum())) - np.repeat(starts, n)
+    stops = tt.pattern_stops[tt.pattern_stop_ptr[patterns][owner] + position]
+    km = haversine_km(lat[owner], lon[owner], tt.stop_lat[stops], tt.stop_lon[stops])
+    km = np.where(np.isnan(km), np.inf, km)
+    # First minimum of each group, in linear time
+    hit = np.flatnonzero(km == np.repeat(np.minimum.reduceat(km, starts), n))
+    nearest = hit[np.r_[True, owner[hit][1:] != owner[hit][:-1]]]
+    return position[nearest], km[nearest]
+
+
+class RouteGeometry:
+    """Stop distances, running times and dwell along every route pattern"""
+
+    def __init__(self, tt, shape_index=None):
+        started = time.time()
+        self.tt = tt
+        self.shape_index = shape_index
+
+        # Patterns split only to keep trips FIFO share a stop sequence: keep one
+        representative = {}
+        pattern_rep = np.empty(tt.n_patterns, dtype=np.int64)
+        for p in range(tt.n_patterns):
+            stops = tt.pattern_stops[tt.pattern_stop_ptr[p]:tt.pattern_stop_ptr[p + 1]]
+            pattern_rep[p] = representative.setdefault((int(tt.pattern_route[p]), stops.tobytes()), p)
+
+        trip_pattern = np.full(len(tt.trip_ids), -1, dtype=np.int64)
+        trip_pattern[tt.pattern_trips] = pattern_rep[np.repeat(np.arange(tt.n_patterns), tt.pattern_n_trips)]
+        self.trip_pattern = {trip_id: p for trip_id, p in zip(tt.trip_ids.tolist(), trip_pattern.tolist())
+                             if p >= 0}
+        self.route_patterns = {}
+        for (route, _), p in representative.items():
+            if not tt.route_is_metro[route]:
+                self.route_patterns.setdefault(str(tt.route_ids[route]), []).append(p)
+
+        owner = np.repeat(np.arange(tt.n_patterns), tt.pattern_n_stops)
+        self.stop_m = tt.pattern_km() * 1000
+        self.pattern_shape = np.full(tt.n_patterns, -1, dtype=np.int64)
+        if shape_index is not None:
+            self._project_stops(sorted(set(representative.values())))
+        self.stop_key = owner * KEY_M + self.stop_m
+        self._schedule()
+        print(f"✓ Route geometry for {len(representative):,} patterns "
+              f"({int((self.pattern_shape >= 0).sum()):,} on shapes) in {time.time() - started:.1f}s")
+
+    def _project_stops(self, patterns):
+        """Distances of each pattern's stops along its first trip's shape, in stop order"""
+        tt, si = self.tt, self.shape_index
+        first_trips = tt.trip_ids[tt.pattern_trips[tt.pattern_trip_ptr[patterns]]]
+        shapes = si.shapes_for(first_trips.tolist(), [None] * len(patterns))
+        for p, shape in zip(patterns, shapes.tolist()):
+            if shape < 0:
+                continue
+            a, b = si.shape_ptr[shape], si.shape_ptr[shape + 1]
+            px, py, dist = si.pt_x[a:b], si.pt_y[a:b], si.pt_dist_m[a:b]
+            stops = tt.pattern_stops[tt.pattern_stop_ptr[p]:tt.pattern_stop_ptr[p + 1]]
+            x, y = project_m(tt.stop_lat[stops], tt.stop_lon[stops], si.origin_lat, si.origin_lon)
+
+            # Every stop against every segment, then the best segment not
+            # before the previous stop's
+            dx, dy = np.diff(px), np.diff(py)
+            length_sq = np.maximum(dx * dx + dy * dy, 1e-9)
+            t = np.clip(((x[:, None] - px[:-1]) * dx + (y[:, None] - py[:-1]) * dy) / length_sq, 0.0, 1.0)
+            offset = np.hypot(px[:-1] + t * dx - x[:, None], py[:-1] + t * dy - y[:, None])
+            along = dist[:-1] + t * np.diff(dist)
+            stop_m = np.empty(len(stops))
+            floor = -1.0
+            for k in range(len(stops)):
+                allowed = np.where(along[k] >= floor, offset[k], np.inf)
+                best = int(np.argmin(allowed))
+                if allowed[best] > MAX_STOP_OFFSET_M:
+                    break
+                stop_m[k] = floor = along[k, best]
+            else:
+                self.stop_m[tt.pattern_stop_ptr[p]:tt.pattern_stop_ptr[p + 1]] = stop_m
+                self.pattern_shape[p] = shape
+
+    def _schedule(self):
+        """Cumulative scheduled running time, dwell and scheduled speed per pattern"""
+        tt = self.tt
+        self.stop_s = np.zeros(len(tt.pattern_stops))
+        self.dwell_s = np.zeros(len(tt.pattern_stops))
+        self.speed_mps = np.ones(tt.n_patterns)
+        for p in range(tt.n_patterns):
+            a, b = tt.pattern_stop_ptr[p], tt.pattern_stop_ptr[p + 1]
+            n_stops, n_trips = b - a, tt.pattern_n_trips[p]
+            times = slice(tt.pattern_time_ptr[p], tt.pattern_time_ptr[p + 1])
+            arr = tt.arr_times[times].reshape(n_stops, n_trips).astype(np.float64)
+            dep = tt.dep_times[times].reshape(n_stops, n_trips).astype(np.float64)
+            run = np.median(arr[1:] - dep[:-1], axis=1)
+            dwell = np.median(dep - arr, axis=1)
+            length = np.diff(self.stop_m[a:b])
+
+            # Segments the schedule does not time run at the pattern's average pace
+            timed = run > 0
+            speed = length[timed].sum() / run[timed].sum() if timed.any() and length[timed].sum() > 0 else 1.0
+            run = np.where(timed, run, length / speed)
+            dwell[1:-1] = np.maximum(dwell[1:-1], MIN_DWELL_SECONDS)
+            dwell[[0, -1]] = 0
+            self.speed_mps[p] = speed
+            self.stop_s[a + 1:b] = np.cumsum(run)
+            self.dwell_s[a:b] = np.concatenate([[0], np.cumsum(dwell[:-1])])
+
+
+class Placement:
+    """Where each bus of one feed refresh is along its pattern"""
+
+    def __init__(self, geometry, buses, bus, pattern, distance_m, next_entry, sched_s, reported):
+        self.geometry = geometry
+        self.buses = buses
+        self.bus = bus                  # Index into buses
+        self.pattern = pattern
+        self.distance_m = distance_m    # Along the pattern
+        self.next_entry = next_entry    # Pattern stop entry of the next stop (end of pattern if none)
+        self.sched_s = sched_s          # Scheduled running time from the first stop to here
+        self.reported = reported        # Report time (epoch seconds)
+        self.row = {buses[i]['id']: r for r, i in enumerate(bus.tolist())}
+
+    def __len__(self):
+        return len(self.bus)
+
+    def rows(self, vehicle_ids):
+        """Placement row per vehicle id, -1 when not placed"""
+        get = self.row.get
+        return np.fromiter((get(v, -1) for v in vehicle_ids), dtype=np.int64, count=len(vehicle_ids))
+
+    def travel_seconds(self, rows, entries, speed_kmh):
+        """Seconds from each placed bus (rows) to a later stop entry of its pattern at a live speed"""
+        g = self.geometry
+        pattern = self.pattern[rows]
+        scheduled = (g.stop_s[entries] - self.sched_s[rows]) * g.speed_mps[pattern]
+        dwell = g.dwell_s[entries] - g.dwell_s[self.next_entry[rows]]
+        return np.maximum(scheduled, 0) / (np.asarray(speed_kmh) / 3.6) + np.maximum(dwell, 0)
+
+    def along_m(self, rows, entries):
+        return self.geometry.stop_m[entries] - self.distance_m[rows]
+
+
+class EtaEngine:
+    """Places each feed's buses on their route patterns and times them to stops"""
+
+    def __init__(self):
+        self._geometry = None
+        self._lock = threading.Lock()
+        self.placement = None
+
+    def geometry(self):
+        """RouteGeometry of the current static data (None until it is loaded)"""
+        router = get_raptor_router()
+        if router is None:
+            return None
+        shape_index = get_shape_index()
+        with self._lock:
+            g = self._geometry
+            if g is None or g.tt is not router.tt or g.shape_index is not shape_index:
+                g = self._geometry = RouteGeometry(router.tt, shape_index)
+            return g
+
+    @traced
+    def place(self, buses, history, feed_time=None):
+        """Place one feed's buses; the result is also kept as .placement"""
+        g = self.geometry()
+        if g is None or not buses:
+            self.placement = None
+            return None
+        tt = g.tt
+        feed_time = feed_time or int(time.time())
+        lat = np.array([bus['lat'] for bus in buses], dtype=np.float64)
+        lon = np.array([bus['lon'] for bus in buses], dtype=np.float64)
+
+        # Candidate patterns: the trip's own, else each of the route's
+        cand_bus, cand_pattern = [], []
+        for i, bus in enumerate(buses):
+            pattern = g.trip_pattern.get(bus.get('trip_id'))
+            candidates = [pattern] if pattern is not None else g.route_patterns.get(bus.get('route_id'), ())
+            cand_bus.extend([i] * len(candidates))
+            cand_pattern.extend(candidates)
+        if not cand_bus:
+            self.placement = None
+            return None
+        cand_bus = np.array(cand_bus, dtype=np.int64)
+        cand_pattern = np.array(cand_pattern, dtype=np.int64)
+
+        # Nearest stop now and at the previous report; moving backwards along
+        # a pattern means it is the other direction
+        prev_lat, prev_lon = history.positions(history.slots([bus['id'] for bus in buses]), back=1)
+        position, off_km = _nearest_positions(tt, cand_pattern, lat[cand_bus], lon[cand_bus])
+        prev_position, _ = _nearest_positions(tt, cand_pattern, prev_lat[cand_bus], prev_lon[cand_bus])
+        backwards = ~np.isnan(prev_lat[cand_bus]) & (prev_position > position)
+        score = off_km + BACKWARD_PENALTY_KM * backwards
+
+        order = np.lexsort((score, cand_bus))
+        first = order[np.r_[True, cand_bus[order][1:] != cand_bus[order][:-1]]]
+        first = first[off_km[first] <= MAX_OFF_ROUTE_KM]
+        bus, pattern, position = cand_bus[first], cand_pattern[first], position[first]
+        distance_m = self._locate(g, pattern, position, lat[bus], lon[bus])
+
+        # Next stop: the first one further along than the bus, and the
+        # scheduled-time coordinate of the bus between it and the previous one
+        base, end = tt.pattern_stop_ptr[pattern], tt.pattern_stop_ptr[pattern + 1]
+        next_entry = np.minimum(np.searchsorted(g.stop_key, pattern * KEY_M + distance_m, side='right'), end)
+        prev_entry = np.maximum(next_entry - 1, base)
+        ahead = np.minimum(next_entry, end - 1)
+        span = g.stop_m[ahead] - g.stop_m[prev_entry]
+        fraction = np.where(span > 0, np.clip((distance_m - g.stop_m[prev_entry]) / np.maximum(span, 1e-9), 0, 1), 0)
+        sched_s = g.stop_s[prev_entry] + fraction * (g.stop_s[ahead] - g.stop_s[prev_entry])
+
+        reported = np.array([buses[i].get('timestamp') or feed_time for i in bus.tolist()], dtype=np.float64)
+        self.placement = Placement(g, buses, bus, pattern, distance_m, next_entry, sched_s, reported)
+        return self.placement
+
+    def _locate(self, g, pattern, position, lat, lon):
+        """Distance along each pattern: projected onto its shape, else from the nearest stop"""
+        tt = g.tt
+        base = tt.pattern_stop_ptr[pattern]
+        n_stops = tt.pattern_n_stops[pattern]
+
+        # Nearest stop and which side of it the bus is
+        following = np.minimum(position + 1, n_stops - 1)
+        stop_at = tt.pattern_stops[base + position]
+        stop_after = tt.pattern_stops[base + following]
+        to_stop = haversine_km(lat, lon, tt.stop_lat[stop_at], tt.stop_lon[stop_at]) * 1000
+        to_after = haversine_km(lat, lon, tt.stop_lat[stop_after], tt.stop_lon[stop_after]) * 1000
+        hop_after = g.stop_m[base + following] - g.stop_m[base + position]
+        passed = (position + 1 < n_stops) & (to_after < hop_after)
+        hop_before = g.stop_m[base + position] - g.stop_m[base + np.maximum(position - 1, 0)]
+        distance_m = np.where(passed, g.stop_m[base + position] + np.minimum(to_stop, hop_after),
+                              g.stop_m[base + position] - np.minimum(to_stop, hop_before))
+
+        shapes = g.pattern_shape[pattern]
+        on_shape = np.flatnonzero(shapes >= 0)
+        if len(on_shape) and g.shape_index is not None:
+            matched = g.shape_index.match(lat[on_shape], lon[on_shape], shapes[on_shape])['distance_m']
+            # A projection far from the stop-based estimate is the wrong leg of a loop
+            ok = np.abs(matched - distance_m[on_shape]) < 2 * np.maximum(hop_after, hop_before)[on_shape] + 200
+            distance_m[on_shape[ok]] = matched[ok]
+        return distance_m
+
+    @traced
+    def to_point(self, vehicle_ids, user_lat, user_lon, speed_kmh):
+        """
+        Along-route arrival at the stop nearest a point, per vehicle
+
+        Returns (rows, seconds, along_km, status): rows is -1 for vehicles
+        not placed on a pattern (seconds/along NaN, status 'unknown'); status
+        is 'approaching' when the point's stop is still ahead, 'moving_away'
+        when it has been passed and 'off_route' when the pattern does not
+        come within USER_STOP_KM of the point.
+        """
+        n = len(vehicle_ids)
+        seconds, along_km = np.full(n, np.nan), np.full(n, np.nan)
+        status = np.full(n, 'unknown', dtype=object)
+        placement = self.placement
+        if placement is None:
+            return np.full(n, -1, dtype=np.int64), seconds, along_km, status
+        g = placement.geometry
+        tt = g.tt
+
+        rows = placement.rows(vehicle_ids)
+        placed = np.flatnonzero(rows >= 0)
+        if len(placed) == 0:
+            return rows, seconds, along_km, status
+        pattern = placement.pattern[rows[placed]]
+        position, km = _nearest_positions(tt, pattern, np.full(len(placed), float(user_lat)),
+                                          np.full(len(placed), float(user_lon)))
+        entry = tt.pattern_stop_ptr[pattern] + position
+        near = km <= USER_STOP_KM
+        ahead = near & (entry >= placement.next_entry[rows[placed]])
+        status[placed] = np.where(ahead, 'approaching', np.where(near, 'moving_away', 'off_route'))
+
+        hit, hit_rows, hit_entry = placed[ahead], rows[placed][ahead], entry[ahead]
+        seconds[hit] = (placement.reported[hit_rows] - time.time()
+                        + placement.travel_seconds(hit_rows, hit_entry, np.asarray(speed_kmh)[hit]))
+        along_km[hit] = placement.along_m(hit_rows, hit_entry) / 1000
+        return rows, seconds, along_km, status
@@ -0,0 +1,294 @@
+"""
+Record and replay GTFS-RT VehiclePositions snapshots
+
+`record` polls the live feed and saves every distinct snapshot, byte for
+byte, as `<fetch time in ms>.pb` in a recording directory. A recording is
+replayed at real time (speed 1), accelerated (speed N) or as fast as
+possible (speed 0), either:
+
+- injected straight into a SimpleRoutePlanner (`ingest_feed`), or
+- served from a local stand-in endpoint; point the server at it with
+  REALTIME_API_URL=http://127.0.0.1:8765/VehiclePositions.pb
+
+`bench` replays a recording into an isolated planner (in-memory speed
+profiles, throw-away position log) and reports ingest time, ETA error
+against where each vehicle actually was a few minutes later, and planning
+throughput, so runs over the same recording are comparable offline.
+
+    python -m route_planner.feed_replay record <dir> [interval_s] [duration_s]
+    python -m route_planner.feed_replay serve <dir> [speed] [port]
+    python -m route_planner.feed_replay bench <dir> [speed] [plans]
+"""
+
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+import requests
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from .geo import haversine_km
+
+DEFAULT_PORT = 8765
+RECORD_INTERVAL_SECONDS = 10
+ETA_HORIZON_MINUTES = 5     # Bench: predict where each bus is this much later
+ETA_MIN_MOVE_KM = 0.5       # ...if it moved at least this far
+ETA_SAMPLE = 200            # Vehicles scored per snapshot
+BENCH_PLANS = 100
+
+
+def record(directory, interval=RECORD_INTERVAL_SECONDS, duration=None, url=None):
+    """
+    Poll the feed every `interval` seconds and save each new snapshot
+
+    Snapshots identical to the previous one are skipped. Runs until
+    `duration` seconds have passed (or forever); returns the number saved.
+    """
+    from .simple_planner import REALTIME_API
+
+    url = url or REALTIME_API
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    started = time.time()
+    last_digest = None
+    saved = 0
+    try:
+        while duration is None or time.time() - started < duration:
+            tick = time.time()
+            try:
+                response = requests.get(url, timeout=10)
+                response.raise_for_status()
+                digest = hashlib.sha256(response.content).digest()
+                if digest != last_digest:
+                    path = directory / f"{int(tick * 1000)}.pb"
+                    tmp_path = path.with_name(f"{path.name}.tmp-{os.getpid()}")
+                    tmp_path.write_bytes(response.content)
+                    os.replace(tmp_path, path)
+                    last_digest = digest
+                    saved += 1
+                    print(f"✓ {path.name} ({len(response.content):,} bytes)")
+            except Exception as e:
+                print(f"⚠ Fetch failed: {e}")
+            time.sleep(max(0.0, interval - (time.time() - tick)))
+    except KeyboardInterrupt:
+        pass
+    print(f"✓ Recorded {saved} snapshots to {directory}")
+    return saved
+
+
+def load_recording(directory):
+    """[(fetch time in epoch seconds, path)] of a recording, oldest first"""
+    snapshots = []
+    for path in Path(directory).glob('*.pb'):
+        if path.stem.isdigit():
+            snapshots.append((int(path.stem) / 1000, path))
+    snapshots.sort()
+    return snapshots
+
+
+def replay(directory, sink, speed=1.0):
+    """
+    Call sink(content, fetch_time) for each snapshot of a recording
+
+    Snapshots are released on the recording's own schedule divided by
+    `speed`; a speed of 0 releases them back to back. Returns the number
+    of snapshots replayed.
+    """
+    snapshots = load_recording(directory)
+    if not snapshots:
+        return 0
+    first = snapshots[0][0]
+    started = time.monotonic()
+    for fetched_at, path in snapshots:
+        if speed > 0:
+            delay = (fetched_at - first) / speed - (time.monotonic() - started)
+            if delay > 0:
+                time.sleep(delay)
+        sink(path.read_bytes(), fetched_at)
+    return len(snapshots)
+
+
+class StandInFeed:
+    """Local HTTP endpoint serving the latest published snapshot"""
+
+    def __init__(self, port=DEFAULT_PORT, host='127.0.0.1'):
+        feed = self
+        self.content = None
+        self.requests = 0
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                content = feed.content
+                feed.requests += 1
+                if content is None:
+                    self.send_error(503, "No snapshot published yet")
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-protobuf')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.url = f"http://{host}:{self.server.server_port}/VehiclePositions.pb"
+        self._thread = None
+
+    def publish(self, content, fetched_at=None):
+        self.content = content
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def serve(directory, speed=1.0, port=DEFAULT_PORT):
+    """Replay a recording through a stand-in endpoint, then keep serving the last snapshot"""
+    feed = StandInFeed(port).start()
+    print(f"✓ Stand-in feed at {feed.url}")
+    print(f"  Start the server with REALTIME_API_URL={feed.url}")
+
+    def publish(content, fetched_at):
+        feed.publish(content)
+        print(f"  {time.strftime('%H:%M:%S', time.localtime(fetched_at))} "
+              f"({len(content):,} bytes, {feed.requests} requests so far)")
+
+    try:
+        replay(directory, publish, speed)
+        print("✓ Recording finished; serving its last snapshot (Ctrl-C to stop)")
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        feed.stop()
+
+
+def _positions(content):
+    """{vehicle id: (lat, lon, timestamp)} of a raw snapshot"""
+    from google.transit import gtfs_realtime_pb2
+
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(content)
+    positions = {}
+    for entity in feed.entity:
+        if entity.HasField("vehicle"):
+            v = entity.vehicle
+            positions[v.vehicle.id] = (v.position.latitude, v.position.longitude,
+                                       v.timestamp or feed.header.timestamp)
+    return positions
+
+
+def _isolated_planner():
+    """A planner whose predictor starts cold and writes nothing to disk"""
+    from .simple_planner import SimpleRoutePlanner
+    from .arrival_predictor import ArrivalPredictor
+    from .speed_profiles import SpeedProfiles
+    from .position_log import PositionLog
+
+    planner = SimpleRoutePlanner()
+    planner.arrival_predictor = ArrivalPredictor()
+    planner.arrival_predictor.profiles = SpeedProfiles()
+    planner.position_log = PositionLog(tempfile.mkdtemp(prefix='replay-positions-'))
+    return planner
+
+
+def benchmark(directory, speed=0.0, plans=BENCH_PLANS, seed=0):
+    """Replay a recording into an isolated planner and report accuracy and throughput"""
+    snapshots = load_recording(directory)
+    if len(snapshots) < 2:
+        print(f"✗ Need at least two snapshots in {directory}")
+        return None
+
+    positions = [_positions(path.read_bytes()) for _, path in snapshots]
+    fetch_times = np.array([fetched_at for fetched_at, _ in snapshots])
+    planner = _isolated_planner()
+    predictor = planner.arrival_predictor
+    rng = np.random.default_rng(seed)
+    ingest_ms, errors = [], []
+    tick = iter(range(len(snapshots)))
+
+    def inject(content, fetched_at):
+        i = next(tick)
+        started = time.perf_counter()
+        planner.ingest_feed(content)
+        ingest_ms.append((time.perf_counter() - started) * 1000)
+
+        # Score predictions towards where each bus was ETA_HORIZON_MINUTES later
+        j = int(np.searchsorted(fetch_times, fetched_at + ETA_HORIZON_MINUTES * 60))
+        if j >= len(snapshots):
+            return
+        now, later = positions[i], positions[j]
+        buses = [bus for bus in planner.buses if bus['id'] in later]
+        for k in rng.permutation(len(buses))[:ETA_SAMPLE].tolist():
+            bus = buses[k]
+            lat, lon, ts = later[bus['id']]
+            start_ts = now[bus['id']][2]
+            if ts <= start_ts or haversine_km(bus['lat'], bus['lon'], lat, lon) < ETA_MIN_MOVE_KM:
+                continue
+            eta = predictor.predict_batch([bus], lat, lon, when=start_ts)['eta_minutes'][0]
+            errors.append(float(eta) - (ts - start_ts) / 60)
+
+    started = time.perf_counter()
+    replay(directory, inject, speed)
+    wall = time.perf_counter() - started
+
+    # Uncached planning between positions of buses in the last snapshot
+    points = np.array([(lat, lon) for lat, lon, _ in positions[-1].values()])
+    pairs = points[rng.integers(0, len(points), size=(plans, 2))].reshape(plans, 4)
+    plan_ms = []
+    for start_lat, start_lon, end_lat, end_lon in pairs.tolist():
+        started = time.perf_counter()
+        planner._plan_route(start_lat, start_lon, end_lat, end_lon)
+        plan_ms.append((time.perf_counter() - started) * 1000)
+
+    span = fetch_times[-1] - fetch_times[0]
+    ingest_ms, plan_ms, errors = np.array(ingest_ms), np.array(plan_ms), np.array(errors)
+    print(f"\n{len(snapshots)} snapshots covering {span / 60:.1f} min, replayed in {wall:.1f} s")
+    print(f"  ingest      median {np.median(ingest_ms):7.1f} ms   p95 {np.percentile(ingest_ms, 95):7.1f} ms")
+    if len(errors):
+        print(f"  ETA error   median {np.median(np.abs(errors)):7.1f} min  p90 "
+              f"{np.percentile(np.abs(errors), 90):7.1f} min  bias {np.mean(errors):+.1f} min "
+              f"({len(errors):,} predictions, {ETA_HORIZON_MINUTES} min ahead)")
+    else:
+        print(f"  ETA error   no vehicle moved {ETA_MIN_MOVE_KM} km within {ETA_HORIZON_MINUTES} min")
+    print(f"  planning    median {np.median(plan_ms):7.1f} ms   p95 {np.percentile(plan_ms, 95):7.1f} ms   "
+          f"{len(plan_ms) / (plan_ms.sum() / 1000):.1f} plans/s")
+    return {'ingest_ms': ingest_ms, 'eta_error_minutes': errors, 'plan_ms': plan_ms}
+
+
+def main():
+    """Command line entry point"""
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command is None or len(sys.argv) < 3:
+        print("Usage: python -m route_planner.feed_replay record|serve|bench <dir> [...]")
+        return
+    directory = sys.argv[2]
+    if command == 'record':
+        record(directory,
+               float(sys.argv[3]) if len(sys.argv) > 3 else RECORD_INTERVAL_SECONDS,
+               float(sys.argv[4]) if len(sys.argv) > 4 else None)
+    elif command == 'serve':
+        serve(directory,
+              float(sys.argv[3]) if len(sys.argv) > 3 else 1.0,
+              int(sys.argv[4]) if len(sys.argv) > 4 else DEFAULT_PORT)
+    elif command == 'bench':
+        benchmark(directory,
+                  float(sys.argv[3]) if len(sys.argv) > 3 else 0.0,
+                  int(sys.argv[4]) if len(sys.argv) > 4 else BENCH_PLANS)
+    else:
+        print("Usage: python -m route_planner.feed_replay record|serve|bench <dir> [...]")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Vectorized geodesy helpers
+
+geopy's geodesic() is exact but costs ~50 µs per call. For scanning
+thousands of stops or vehicles at once these NumPy versions are used
+instead; at city scale the haversine error is well under 0.5%.
+"""
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance in km; arguments broadcast like NumPy arrays"""
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype=np.float64))
+                              for v in (lat1, lon1, lat2, lon2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def bearing_deg(lat1, lon1, lat2, lon2):
+    """Initial bearing from point 1 to point 2 in degrees (0 = north, clockwise)"""
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype=np.float64))
+                              for v in (lat1, lon1, lat2, lon2))
+    dlon = lon2 - lon1
+    x = np.sin(dlon) * np.cos(lat2)
+    y = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(dlon)
+    return (np.degrees(np.arctan2(x, y)) + 360) % 360
+
+
+def project_m(lat, lon, origin_lat, origin_lon):
+    """
+    Equirectangular projection to metres around an origin
+
+    Accurate to a few metres across Delhi NCR, which is all that is needed
+    for nearest-segment and grid computations.
+    """
+    k = np.pi / 180.0 * EARTH_RADIUS_KM * 1000.0
+    x = (np.asarray(lon, dtype=np.float64) - origin_lon) * k * np.cos(np.radians(origin_lat))
+    y = (np.asarray(lat, dtype=np.float64) - origin_lat) * k
+    return x, y
+
+
+def points_within(lat, lon, ref_lat, ref_lon, max_km, chunk=256):
+    """
+    For each query point, the reference points within max_km of it
+
+    Distances are computed as (chunk x n_ref) blocks, so thousands of
+    queries cost a few large NumPy operations rather than one scan each.
+    Returns a list of (indices, distances_km), nearest first.
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    results = []
+    for a in range(0, len(lat), chunk):
+        d = haversine_km(lat[a:a + chunk, None], lon[a:a + chunk, None], ref_lat[None, :], ref_lon[None, :])
+        rows, cols = np.nonzero(d <= max_km)
+        near = d[rows, cols]
+        order = np.lexsort((near, rows))
+        rows, cols, near = rows[order], cols[order], near[order]
+        bounds = np.searchsorted(rows, np.arange(1, len(d)))
+        results.extend(zip(np.split(cols, bounds), np.split(near, bounds)))
+    return results
@@ -1,73 +1,327 @@
 """
 Download and extract GTFS data from Delhi Open Transit Data portal
+
+Downloads are conditional (ETag/Last-Modified), resumable (HTTP Range),
+checksummed and extracted atomically, so an unchanged feed costs a single
+round trip and an interrupted download never leaves a corrupt gtfs_data.
+A crash during the final swap is repaired on the next run or load (see
+recover_interrupted_swap).
 """
 
 import requests
 import zipfile
+import hashlib
+import json
+import shutil
 import os
+from datetime import datetime
 from pathlib import Path
 
 GTFS_STATIC_URL = "https://otd.delhi.gov.in/data/static/GTFS.zip"
 GTFS_DATA_DIR = Path(__file__).parent.parent / "gtfs_data"
 
-def download_gtfs_data(force=False):
+REQUIRED_FILES = ['routes.txt', 'stops.txt', 'trips.txt', 'stop_times.txt']
+OPTIONAL_FILES = [
+    'agency.txt', 'calendar.txt', 'calendar_dates.txt', 'shapes.txt',
+    'frequencies.txt', 'transfers.txt', 'fare_attributes.txt',
+    'fare_rules.txt', 'feed_info.txt',
+]
+
+META_FILE = ".download_meta.json"
+CHUNK_SIZE = 256 * 1024          # 256 KB network reads
+WRITE_BUFFER = 8 * 1024 * 1024   # 8 MB buffered file writes
+
+
+def download_gtfs_data(force=False, url=GTFS_STATIC_URL, data_dir=GTFS_DATA_DIR,
+                       expected_sha256=None):
     """
     Download GTFS static data from Delhi Open Transit Data
-    
+
     Args:
-        force: If True, re-download even if data exists
-    
+        force: If True, re-download even if the remote feed is unchanged
+        url: Feed URL (override to point at a mirror or local stand-in)
+        data_dir: Directory the GTFS files are extracted into
+        expected_sha256: Optional checksum the downloaded zip must match
+
     Returns:
         Path to extracted GTFS data directory
     """
-    GTFS_DATA_DIR.mkdir(parents=True, exist_ok=True)
-    zip_path = GTFS_DATA_DIR / "GTFS.zip"
-    
-    # Check if data already exists
-    required_files = ['routes.txt', 'stops.txt', 'trips.txt', 'stop_times.txt']
-    if not force and all((GTFS_DATA_DIR / f).exists() for f in required_files):
-        print(f"✓ GTFS data already exists in {GTFS_DATA_DIR}")
-        return GTFS_DATA_DIR
-    
-    print(f"Downloading GTFS data from {GTFS_STATIC_URL}...")
-    
+    data_dir = Path(data_dir)
+    data_dir.parent.mkdir(parents=True, exist_ok=True)
+    recover_interrupted_swap(data_dir)
+    part_path = data_dir.with_name(data_dir.name + ".zip.part")
+    part_meta_path = data_dir.with_name(data_dir.name + ".zip.part.json")
+
+    meta = _read_json(data_dir / META_FILE)
+    have_data = all((data_dir / f).exists() for f in REQUIRED_FILES)
+
+    headers = {}
+    if have_data and not force:
+        # Conditional GET: the server answers 304 if the feed is unchanged
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    # Resume a previous partial download of the same remote file. If-Range
+    # needs a strong validator: a weak ETag falls back to Last-Modified, and
+    # without either the download starts over
+    part_meta = _read_json(part_meta_path)
+    offset = 0
+    if part_path.exists() and part_meta.get('url') == url:
+        validator = _range_validator(part_meta)
+        if validator and part_path.stat().st_size > 0:
+            offset = part_path.stat().st_size
+            headers['Range'] = f'bytes={offset}-'
+            headers['If-Range'] = validator
+
+    if offset:
+        print(f"Resuming GTFS download from {url} at {offset / 1024 / 1024:.2f} MB...")
+    else:
+        print(f"Downloading GTFS data from {url}...")
+
+    stage = 'downloading'
     try:
-        response = requests.get(GTFS_STATIC_URL, stream=True, timeout=30)
+        response = requests.get(url, headers=headers, stream=True, timeout=30)
+
+        if response.status_code == 304:
+            print(f"✓ GTFS feed unchanged, data in {data_dir} is up to date")
+            meta['checked_at'] = datetime.now().isoformat()
+            _write_json(data_dir / META_FILE, meta)
+            _remove(part_path, part_meta_path)
+            return data_dir
+
         response.raise_for_status()
-        
-        # Save zip file
-        with open(zip_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        
-        print(f"✓ Downloaded {zip_path.stat().st_size / 1024 / 1024:.2f} MB")
-        
-        # Extract zip file
+
+        if response.status_code == 206 and (not offset or _range_start(response) != offset):
+            # A range we did not ask for: its Content-Length is not the file
+            # size, so fetch the whole file again without Range
+            response.close()
+            headers.pop('Range', None)
+            headers.pop('If-Range', None)
+            offset = 0
+            print("  Server answered with an unexpected range, restarting the download")
+            response = requests.get(url, headers=headers, stream=True, timeout=30)
+            if response.status_code == 304:
+                print(f"✓ GTFS feed unchanged, data in {data_dir} is up to date")
+                _remove(part_path, part_meta_path)
+                return data_dir
+            response.raise_for_status()
+            if response.status_code == 206:
+                raise IOError("Server keeps answering with partial content to a full request")
+
+        if response.status_code == 206:
+            mode = 'ab'
+            total_size = _range_total(response)
+        else:
+            # Server ignored the range (or the file changed): start over
+            mode = 'wb'
+            offset = 0
+            total_size = _int_header(response, 'Content-Length')
+
+        remote = {
+            'url': url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }
+        _write_json(part_meta_path, remote)
+
+        # Hash the bytes we already have, then keep hashing while streaming
+        sha256 = hashlib.sha256()
+        if mode == 'ab':
+            _hash_file(part_path, sha256)
+
+        with open(part_path, mode, buffering=WRITE_BUFFER) as f:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                if chunk:
+                    f.write(chunk)
+                    sha256.update(chunk)
+
+        size = part_path.stat().st_size
+        if total_size is not None and size != total_size:
+            raise IOError(f"Incomplete download: got {size} of {total_size} bytes "
+                          f"(partial file kept for resume)")
+        print(f"✓ Downloaded {size / 1024 / 1024:.2f} MB")
+
+        # Verify checksum and zip integrity before touching gtfs_data
+        stage = 'verifying'
+        digest = sha256.hexdigest()
+        if expected_sha256 and digest != expected_sha256.lower():
+            _remove(part_path, part_meta_path)
+            raise IOError(f"Checksum mismatch: expected {expected_sha256}, got {digest}")
+
+        if have_data and not force and digest == meta.get('sha256'):
+            # Server does not support conditional requests but nothing changed
+            print(f"✓ GTFS feed unchanged (sha256 {digest[:12]}), skipping extraction")
+            meta.update({k: v for k, v in remote.items() if v})
+            meta['checked_at'] = datetime.now().isoformat()
+            _write_json(data_dir / META_FILE, meta)
+            _remove(part_path, part_meta_path)
+            return data_dir
+
         print("Extracting GTFS files...")
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            zip_ref.extractall(GTFS_DATA_DIR)
-        
-        # Remove zip file
-        zip_path.unlink()
-        
+        stage = 'extracting'
+        _extract_atomically(part_path, data_dir, {
+            **remote,
+            'sha256': digest,
+            'size': size,
+            'downloaded_at': datetime.now().isoformat(),
+            'checked_at': datetime.now().isoformat(),
+        })
+        _remove(part_path, part_meta_path)
+
         # List extracted files
-        files = list(GTFS_DATA_DIR.glob('*.txt'))
+        files = list(data_dir.glob('*.txt'))
         print(f"✓ Extracted {len(files)} GTFS files:")
         for f in sorted(files):
             size_kb = f.stat().st_size / 1024
             print(f"  - {f.name} ({size_kb:.1f} KB)")
-        
-        return GTFS_DATA_DIR
-        
+
+        return data_dir
+
     except requests.exceptions.RequestException as e:
         print(f"✗ Error downloading GTFS data: {e}")
+        if part_path.exists():
+            print(f"  Partial download kept at {part_path}, re-run to resume")
         print("\nAlternative: Download manually from https://otd.delhi.gov.in/data/static/")
-        print(f"and extract to: {GTFS_DATA_DIR}")
+        print(f"and extract to: {data_dir}")
         raise
     except Exception as e:
-        print(f"✗ Error extracting GTFS data: {e}")
+        print(f"✗ Error {stage} GTFS data: {e}")
+        if isinstance(e, zipfile.BadZipFile):
+            # Complete but corrupt: nothing to resume, start over next time
+            _remove(part_path, part_meta_path)
+        if part_path.exists():
+            print(f"  Partial download kept at {part_path}, re-run to resume")
+        raise
+
+
+def recover_interrupted_swap(data_dir=GTFS_DATA_DIR):
+    """
+    Put a feed back in place if a crash hit between the two swap renames
+
+    The staging directory is complete once its metadata file exists (it is
+    written last), so it wins; otherwise the previous feed is restored.
+    Returns True if something was restored.
+    """
+    data_dir = Path(data_dir)
+    if data_dir.exists():
+        return False
+    staging_dir = data_dir.with_name(data_dir.name + ".staging")
+    old_dir = data_dir.with_name(data_dir.name + ".old")
+    if (staging_dir / META_FILE).exists():
+        source = staging_dir
+    elif old_dir.exists():
+        source = old_dir
+    else:
+        return False
+    os.replace(source, data_dir)
+    print(f"⚠ Restored {data_dir} from {source.name} after an interrupted update")
+    return True
+
+
+def _extract_atomically(zip_path, data_dir, meta):
+    """
+    Extract the GTFS tables into a staging directory and swap it into place
+
+    Only known GTFS .txt members are extracted (flattened, so zips with a
+    top-level folder work too). The live directory is replaced by two
+    renames, so readers never see a half-extracted feed; if the process
+    dies between them, recover_interrupted_swap() finishes the job.
+    """
+    wanted = set(REQUIRED_FILES + OPTIONAL_FILES)
+    staging_dir = data_dir.with_name(data_dir.name + ".staging")
+    old_dir = data_dir.with_name(data_dir.name + ".old")
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    staging_dir.mkdir(parents=True)
+
+    try:
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            bad_member = zip_ref.testzip()
+            if bad_member:
+                raise zipfile.BadZipFile(f"CRC check failed for {bad_member}")
+
+            for info in zip_ref.infolist():
+                name = Path(info.filename).name
+                if info.is_dir() or name not in wanted:
+                    continue
+                with zip_ref.open(info) as src, open(staging_dir / name, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, WRITE_BUFFER)
+
+        missing = [f for f in REQUIRED_FILES if not (staging_dir / f).exists()]
+        if missing:
+            raise zipfile.BadZipFile(f"GTFS zip is missing required files: {missing}")
+
+        _write_json(staging_dir / META_FILE, meta)
+
+        shutil.rmtree(old_dir, ignore_errors=True)
+        if data_dir.exists():
+            os.replace(data_dir, old_dir)
+        os.replace(staging_dir, data_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+    except Exception:
+        shutil.rmtree(staging_dir, ignore_errors=True)
         raise
 
+
+def _hash_file(path, digest):
+    """Feed an existing file into a running hash"""
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(WRITE_BUFFER), b''):
+            digest.update(block)
+
+
+def _range_validator(part_meta):
+    """Strong validator for If-Range: the ETag unless weak, else Last-Modified"""
+    etag = part_meta.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return part_meta.get('last_modified')
+
+
+def _range_start(response):
+    """First byte offset of a 206 response (Content-Range: bytes a-b/total)"""
+    content_range = response.headers.get('Content-Range', '')
+    try:
+        return int(content_range.split()[1].split('-')[0])
+    except (IndexError, ValueError):
+        return None
+
+
+def _range_total(response):
+    """Full file size advertised by a 206 response, if known"""
+    content_range = response.headers.get('Content-Range', '')
+    total = content_range.rsplit('/', 1)[-1]
+    return int(total) if total.isdigit() else None
+
+
+def _int_header(response, name):
+    value = response.headers.get(name)
+    return int(value) if value and value.isdigit() else None
+
+
+def _read_json(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_json(path, data):
+    tmp_path = Path(str(path) + ".tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _remove(*paths):
+    for path in paths:
+        try:
+            Path(path).unlink()
+        except FileNotFoundError:
+            pass
+
 if __name__ == "__main__":
     # Test the downloader
     try:
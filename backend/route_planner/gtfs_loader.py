@@ -1,21 +1,45 @@
 """
 Load GTFS data into SQLite database for fast querying
+
+The DTC bus feed (gtfs_data/) and the DMRC metro feed (DMRC_GTFS/) share one
+database. Metro IDs are namespaced with METRO_ID_PREFIX so stop, trip,
+route and service IDs never collide between the feeds.
 """
 
 import sqlite3
 import pandas as pd
 from pathlib import Path
+from datetime import datetime
+import json
+import os
 import time
+import uuid
+from .transfers import TransferTable, transfers_path, DEFAULT_RADIUS_M
+from .shape_index import ShapeIndex, shape_index_path
+from .gtfs_downloader import recover_interrupted_swap
 
 GTFS_DATA_DIR = Path(__file__).parent.parent / "gtfs_data"
+METRO_GTFS_DIR = Path(__file__).parent.parent.parent / "DMRC_GTFS"
 DB_PATH = Path(__file__).parent.parent / "database" / "transit.db"
 
+METRO_ID_PREFIX = "metro:"
+
+# Columns holding GTFS identifiers: always stored as TEXT, prefixed for metro
+ID_COLUMNS = ['route_id', 'agency_id', 'stop_id', 'parent_station', 'trip_id', 'service_id', 'shape_id']
+ID_DTYPES = {column: str for column in ID_COLUMNS}
+
 class GTFSLoader:
-    def __init__(self, gtfs_dir=GTFS_DATA_DIR, db_path=DB_PATH):
+    def __init__(self, gtfs_dir=GTFS_DATA_DIR, db_path=DB_PATH, metro_dir=METRO_GTFS_DIR,
+                 transfer_radius_m=DEFAULT_RADIUS_M):
         self.gtfs_dir = Path(gtfs_dir)
         self.db_path = Path(db_path)
+        self.metro_dir = Path(metro_dir) if metro_dir else None
+        self.transfer_radius_m = transfer_radius_m
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
         
+        # A crash mid-update can leave the feed in gtfs_data.old/.staging
+        recover_interrupted_swap(self.gtfs_dir)
+        
     def load_all(self, force=False):
         """Load all GTFS files into database"""
         
@@ -37,8 +61,14 @@ class GTFSLoader:
             print("See GTFS_SETUP.md for instructions")
             return False
         
-        # Create database connection
-        conn = sqlite3.connect(self.db_path)
+        # Build into a private file next to the live database so readers of
+        # transit.db never see dropped or half-written tables
+        build_path = self.db_path.with_name(f"{self.db_path.name}.build-{os.getpid()}")
+        self._remove_db_file(build_path)
+        conn = sqlite3.connect(build_path)
+        # The build file is thrown away on failure, so skip journaling
+        conn.execute("PRAGMA journal_mode=OFF")
+        conn.execute("PRAGMA synchronous=OFF")
         
         try:
             # Load each GTFS file
@@ -47,46 +77,86 @@ class GTFSLoader:
             self._load_trips(conn)
             self._load_stop_times(conn)
             self._load_calendar(conn)
+            self._load_shapes(conn)
             
             # Create indexes for fast queries
             self._create_indexes(conn)
             
-            # Print statistics
-            self._print_stats(conn)
-            
+            version = self._write_version(conn)
             conn.commit()
-            elapsed = time.time() - start_time
-            print(f"\n✓ Database created successfully in {elapsed:.1f}s")
-            print(f"  Location: {self.db_path}")
-            print(f"  Size: {self.db_path.stat().st_size / 1024 / 1024:.1f} MB")
             
-            return True
+            # Refuse to publish a database that is empty or damaged
+            self._validate(conn)
+            
+            # Precompute derived data that is stored alongside the database
+            artifacts = self._build_artifacts(conn, version)
+            
+            # Print statistics
+            self._print_stats(conn)
             
         except Exception as e:
             print(f"✗ Error loading GTFS data: {e}")
-            conn.rollback()
-            raise
-        finally:
             conn.close()
+            self._remove_db_file(build_path)
+            for leftover in self.db_path.parent.glob(f"*.build-{os.getpid()}"):
+                leftover.unlink()
+            raise
+        
+        conn.close()
+        self._swap_into_place(build_path, artifacts)
+        
+        elapsed = time.time() - start_time
+        print(f"\n✓ Database created successfully in {elapsed:.1f}s")
+        print(f"  Location: {self.db_path}")
+        print(f"  Version: {version}")
+        print(f"  Size: {self.db_path.stat().st_size / 1024 / 1024:.1f} MB")
+        
+        return True
+    
+    def _feeds(self):
+        """(directory, ID prefix) of each feed to load"""
+        feeds = [(self.gtfs_dir, '')]
+        if self.metro_dir and (self.metro_dir / 'stops.txt').exists():
+            feeds.append((self.metro_dir, METRO_ID_PREFIX))
+        return feeds
+    
+    def _prefix_ids(self, df, prefix):
+        """Namespace the identifier columns of a metro table"""
+        if prefix:
+            for column in ID_COLUMNS:
+                if column in df.columns:
+                    df[column] = df[column].where(df[column].isna(), prefix + df[column].astype(str))
+        return df
+    
+    def _read_table(self, filename):
+        """Read a GTFS table from every feed that has it"""
+        frames = []
+        for feed_dir, prefix in self._feeds():
+            path = feed_dir / filename
+            if path.exists():
+                frames.append(self._prefix_ids(pd.read_csv(path, dtype=ID_DTYPES), prefix))
+        if not frames:
+            return None
+        return pd.concat(frames, ignore_index=True)
     
     def _load_routes(self, conn):
         """Load routes.txt"""
         print("Loading routes...")
-        df = pd.read_csv(self.gtfs_dir / 'routes.txt')
+        df = self._read_table('routes.txt')
         df.to_sql('routes', conn, if_exists='replace', index=False)
         print(f"  ✓ Loaded {len(df)} routes")
     
     def _load_stops(self, conn):
         """Load stops.txt"""
         print("Loading stops...")
-        df = pd.read_csv(self.gtfs_dir / 'stops.txt')
+        df = self._read_table('stops.txt')
         df.to_sql('stops', conn, if_exists='replace', index=False)
         print(f"  ✓ Loaded {len(df)} stops")
     
     def _load_trips(self, conn):
         """Load trips.txt"""
         print("Loading trips...")
-        df = pd.read_csv(self.gtfs_dir / 'trips.txt')
+        df = self._read_table('trips.txt')
         df.to_sql('trips', conn, if_exists='replace', index=False)
         print(f"  ✓ Loaded {len(df)} trips")
     
@@ -96,26 +166,51 @@ class GTFSLoader:
         
         # Load in chunks to handle large files
         chunk_size = 100000
-        chunks = pd.read_csv(self.gtfs_dir / 'stop_times.txt', chunksize=chunk_size)
-        
         total_rows = 0
-        for i, chunk in enumerate(chunks):
-            chunk.to_sql('stop_times', conn, if_exists='append' if i > 0 else 'replace', index=False)
-            total_rows += len(chunk)
-            print(f"  ... {total_rows:,} rows loaded", end='\r')
+        columns = None
+        
+        for feed_dir, prefix in self._feeds():
+            chunks = pd.read_csv(feed_dir / 'stop_times.txt', chunksize=chunk_size, dtype=ID_DTYPES)
+            for chunk in chunks:
+                chunk = self._prefix_ids(chunk, prefix)
+                if columns is None:
+                    columns = list(chunk.columns)
+                    chunk.to_sql('stop_times', conn, if_exists='replace', index=False)
+                else:
+                    # Later feeds are aligned to the columns of the first one
+                    chunk.reindex(columns=columns).to_sql('stop_times', conn, if_exists='append', index=False)
+                total_rows += len(chunk)
+                print(f"  ... {total_rows:,} rows loaded", end='\r')
         
         print(f"\n  ✓ Loaded {total_rows:,} stop times")
     
     def _load_calendar(self, conn):
-        """Load calendar.txt"""
-        calendar_file = self.gtfs_dir / 'calendar.txt'
-        if calendar_file.exists():
+        """Load calendar.txt and calendar_dates.txt"""
+        df = self._read_table('calendar.txt')
+        if df is not None:
             print("Loading calendar...")
-            df = pd.read_csv(calendar_file)
             df.to_sql('calendar', conn, if_exists='replace', index=False)
             print(f"  ✓ Loaded {len(df)} calendar entries")
         else:
             print("  ⚠ calendar.txt not found (optional)")
+        
+        df = self._read_table('calendar_dates.txt')
+        if df is not None:
+            print("Loading calendar dates...")
+            df.to_sql('calendar_dates', conn, if_exists='replace', index=False)
+            print(f"  ✓ Loaded {len(df)} calendar exceptions")
+        else:
+            print("  ⚠ calendar_dates.txt not found (optional)")
+    
+    def _load_shapes(self, conn):
+        """Load shapes.txt (optional; stop sequences are used where it is missing)"""
+        df = self._read_table('shapes.txt')
+        if df is not None:
+            print("Loading shapes...")
+            df.to_sql('shapes', conn, if_exists='replace', index=False)
+            print(f"  ✓ Loaded {len(df):,} shape points")
+        else:
+            print("  ⚠ shapes.txt not found (optional)")
     
     def _create_indexes(self, conn):
         """Create indexes for fast queries"""
@@ -137,6 +232,136 @@ class GTFSLoader:
         
         print(f"  ✓ Created {len(indexes)} indexes")
     
+    def _write_version(self, conn):
+        """Stamp the build with a unique version that running servers can detect"""
+        version = f"{datetime.now():%Y%m%d%H%M%S}-{uuid.uuid4().hex[:8]}"
+        source = self._read_download_meta()
+        
+        conn.execute("DROP TABLE IF EXISTS db_version")
+        conn.execute(
+            "CREATE TABLE db_version (version TEXT, built_at TEXT, gtfs_sha256 TEXT, gtfs_etag TEXT)"
+        )
+        conn.execute(
+            "INSERT INTO db_version VALUES (?, ?, ?, ?)",
+            (version, datetime.now().isoformat(), source.get('sha256'), source.get('etag'))
+        )
+        return version
+    
+    def _read_download_meta(self):
+        """Metadata written by gtfs_downloader next to the extracted feed"""
+        try:
+            with open(self.gtfs_dir / ".download_meta.json", 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+    
+    def _validate(self, conn):
+        """Check the freshly built database before it replaces the live one"""
+        result = conn.execute("PRAGMA quick_check").fetchone()[0]
+        if result != 'ok':
+            raise sqlite3.DatabaseError(f"Integrity check failed: {result}")
+        
+        for table in ['routes', 'stops', 'trips', 'stop_times']:
+            count = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            if count == 0:
+                raise ValueError(f"Table '{table}' is empty")
+        
+        orphans = conn.execute(
+            "SELECT COUNT(*) FROM (SELECT DISTINCT trip_id FROM stop_times) st "
+            "LEFT JOIN trips t ON t.trip_id = st.trip_id WHERE t.trip_id IS NULL"
+        ).fetchone()[0]
+        if orphans:
+            print(f"  ⚠ {orphans:,} trips in stop_times.txt are missing from trips.txt")
+        
+        print("  ✓ Validation passed")
+    
+    def _build_artifacts(self, conn, version):
+        """
+        Build files derived from the database next to the build
+        
+        Returns (temporary path, final path) pairs. Each artifact records the
+        database version it belongs to so readers can detect mismatches.
+        """
+        # Imported here because these modules use constants from this one
+        from .service_calendar import ServiceCalendar, service_days_path
+        from .raptor import Timetable, timetable_path
+        
+        artifacts = []
+        
+        print("Precomputing active trips per service day...")
+        final_path = service_days_path(self.db_path)
+        tmp_path = final_path.with_name(f"{final_path.name}.build-{os.getpid()}")
+        calendar = ServiceCalendar.build(conn, version)
+        calendar.save(tmp_path)
+        artifacts.append((tmp_path, final_path))
+        print(f"  ✓ {calendar.n_days} days ({calendar.start_date} to {calendar.end_date}), "
+              f"{len(calendar.service_ids)} services, {len(calendar.trip_ids):,} trips")
+        
+        print("Building route pattern timetable...")
+        final_path = timetable_path(self.db_path)
+        tmp_path = final_path.with_name(f"{final_path.name}.build-{os.getpid()}")
+        timetable = Timetable.build(conn, version)
+        timetable.save(tmp_path)
+        artifacts.append((tmp_path, final_path))
+        print(f"  ✓ {timetable.n_patterns:,} route patterns over {timetable.n_stops:,} stops")
+        
+        print(f"Precomputing walking transfers within {self.transfer_radius_m} m...")
+        final_path = transfers_path(self.db_path)
+        tmp_path = final_path.with_name(f"{final_path.name}.build-{os.getpid()}")
+        transfers = TransferTable.build(
+            timetable.stop_lat, timetable.stop_lon, self.transfer_radius_m, db_version=version
+        )
+        transfers.save(tmp_path)
+        artifacts.append((tmp_path, final_path))
+        print(f"  ✓ {transfers.n_links:,} stop-to-stop links, "
+              f"{transfers.count_between(timetable.stop_is_metro):,} bus ↔ metro interchanges")
+        
+        print("Indexing route shapes for map-matching...")
+        final_path = shape_index_path(self.db_path)
+        tmp_path = final_path.with_name(f"{final_path.name}.build-{os.getpid()}")
+        shape_index = ShapeIndex.build(conn, timetable, version)
+        shape_index.save(tmp_path)
+        artifacts.append((tmp_path, final_path))
+        print(f"  ✓ {shape_index.n_shapes:,} shapes, {shape_index.n_segments:,} segments "
+              f"in {len(shape_index.cell_keys):,} (shape, cell) buckets")
+        
+        return artifacts
+    
+    def _swap_into_place(self, build_path, artifacts=()):
+        """Atomically replace the live database (and its artifacts) with the new build"""
+        # Make sure the data is on disk before the rename becomes visible
+        for path in [build_path] + [tmp for tmp, _ in artifacts]:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        
+        # Artifacts first: the database rename is what readers react to
+        for tmp_path, final_path in artifacts:
+            os.replace(tmp_path, final_path)
+        os.replace(build_path, self.db_path)
+        
+        # Persist the directory entry as well (not supported everywhere)
+        try:
+            dir_fd = os.open(self.db_path.parent, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(dir_fd)
+        except OSError:
+            pass
+        finally:
+            os.close(dir_fd)
+    
+    def _remove_db_file(self, path):
+        """Remove a database file and any SQLite side files"""
+        for suffix in ['', '-journal', '-wal', '-shm']:
+            try:
+                os.unlink(f"{path}{suffix}")
+            except FileNotFoundError:
+                pass
+    
     def _print_stats(self, conn):
         """Print database statistics"""
         print("\nDatabase Statistics:")
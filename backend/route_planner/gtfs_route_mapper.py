@@ -4,6 +4,7 @@ Map route IDs to human-readable names using GTFS data
 
 import csv
 from pathlib import Path
+from .tracing import traced
 
 class GTFSRouteMapper:
     """Maps route IDs to route names from GTFS data"""
@@ -137,6 +138,7 @@ class GTFSRouteMapper:
         
         return "Metro Line"
     
+    @traced
     def get_route_name(self, route_id, mode='bus'):
         """Get human-readable route name"""
         if mode == 'metro':
@@ -158,6 +160,7 @@ class GTFSRouteMapper:
         # Fallback
         return f"{'Metro' if mode == 'metro' else 'Bus'} {route_id}"
     
+    @traced
     def get_route_info(self, route_id, mode='bus'):
         """Get full route information"""
         if mode == 'metro':
@@ -0,0 +1,436 @@
+"""
+Contraction hierarchy over the unified bus + metro network
+
+TransitNetwork.search() is a plain Dijkstra over every route node of both
+feeds. For all-mode queries this module precomputes a contraction
+hierarchy: states are contracted one at a time (least important first),
+adding shortcut edges wherever the only shortest path ran through the
+removed state. A query is then a bidirectional Dijkstra that only ever
+climbs to more important states, so it settles a few hundred states
+instead of most of the graph.
+
+The hierarchy is built over the same search states as TransitNetwork
+(node, or stop reached on foot), so "never chain two walks" is preserved
+exactly and results equal search(). Should contraction get too dense, the
+remaining states are kept as a core that queries search plainly.
+
+Building takes minutes (tens of minutes for a city-wide feed), so it is an
+offline step; the index is stored next to transit.db, stamped with the
+database version, and picked up by load_network() when it matches:
+
+    python -m route_planner.hierarchy build [transit.db]
+    python -m route_planner.hierarchy bench [transit.db] [queries]
+"""
+
+import heapq
+import os
+import sys
+import time
+import numpy as np
+from pathlib import Path
+from .shared_snapshot import load_npz
+
+CHANGE = -1                 # Pseudo network edge: changing vehicles at a stop
+WITNESS_SETTLE_LIMIT = 100  # Witness searches give up (and add the shortcut) after this
+WITNESS_HOP_LIMIT = 5       # ...or after paths of this many edges
+DENSE_PAIRS = 64            # States joining more (in x out) pairs use 2-hop witnesses
+CORE_SHORTCUTS = 512        # Stop contracting once the least important state needs more
+
+
+def hierarchy_path(db_path):
+    """Location of the hierarchy stored alongside a database"""
+    db_path = Path(db_path)
+    return db_path.with_name(f"{db_path.stem}.ch.npz")
+
+
+def state_edges(network):
+    """
+    Edges of the search-state graph as (src, dst, seconds, network edge)
+
+    Stop s is split in two: s itself (reached by vehicle) keeps the walks,
+    which land in the on-foot state n_nodes + s' of the other stop, and the
+    on-foot state holds the stop's board edges. A free CHANGE edge from s to
+    its on-foot state lets riders change vehicles. Reaching a stop by either
+    state costs the same as in TransitNetwork.search(), but a busy
+    interchange no longer joins every arriving route to every departing one.
+    """
+    from .network import BOARD, WALK
+
+    n_nodes, n_stops = network.n_nodes, network.n_stops
+    src = np.repeat(np.arange(n_nodes), np.diff(network.edge_ptr))
+    edge = np.arange(network.n_edges)
+    board = network.edge_kind == BOARD
+    dst = network.edge_to + np.where(network.edge_kind == WALK, n_nodes, 0)
+
+    # Board edges leave from the on-foot state only
+    src = np.where(board, src + n_nodes, src)
+    stops = np.arange(n_stops)
+    src = np.concatenate([src, stops])
+    dst = np.concatenate([dst, stops + n_nodes]).astype(np.int64)
+    edge = np.concatenate([edge, np.full(n_stops, CHANGE)])
+    seconds = np.where(edge == CHANGE, 0, network.edge_seconds[edge]).astype(np.int64)
+
+    # Keep the fastest of parallel edges
+    order = np.lexsort((seconds, dst, src))
+    src, dst, seconds, edge = src[order], dst[order], seconds[order], edge[order]
+    first = np.ones(len(src), dtype=bool)
+    first[1:] = (src[1:] != src[:-1]) | (dst[1:] != dst[:-1])
+    return src[first], dst[first], seconds[first], edge[first]
+
+
+class ContractionHierarchy:
+    """Upward/downward CSR graphs plus shortcut unpacking data"""
+
+    ARRAYS = ['rank', 'up_ptr', 'up_to', 'up_seconds', 'down_ptr', 'down_from', 'down_seconds',
+              'edge_keys', 'edge_via']
+
+    def __init__(self, db_version=None, **arrays):
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+        self.db_version = db_version
+        self.n_states = len(self.rank)
+        self._lists = None
+
+    @property
+    def n_shortcuts(self):
+        return int(np.count_nonzero(self.edge_via >= 0))
+
+    @classmethod
+    def build(cls, network, db_version=None, verbose=True):
+        """Contract every search state of a network"""
+        n = network.n_nodes + network.n_stops
+        src, dst, seconds, edge = state_edges(network)
+
+        out = [dict() for _ in range(n)]
+        inn = [dict() for _ in range(n)]
+        # (u, w) -> middle state of a shortcut, or -(network edge + 2)
+        via = {}
+        for u, w, c, e in zip(src.tolist(), dst.tolist(), seconds.tolist(), edge.tolist()):
+            out[u][w] = c
+            inn[w][u] = c
+            via[(u, w)] = -(e + 2)
+
+        deleted = [0] * n
+        level = [0] * n
+        rank = np.full(n, -1, dtype=np.int64)
+        up, down = [], []
+
+        def shortcuts(v):
+            """Shortcuts needed if v were contracted now"""
+            needed = []
+            targets = out[v]
+            if not targets:
+                return needed
+            hop_limit = WITNESS_HOP_LIMIT if len(inn[v]) * len(targets) <= DENSE_PAIRS else 2
+            for u, cu in inn[v].items():
+                limit = cu + max(targets.values())
+                dist = {u: 0}
+                heap = [(0, u, 0)]
+                settled = 0
+                remaining = len(targets)
+                while heap and remaining and settled < WITNESS_SETTLE_LIMIT:
+                    d, x, hops = heapq.heappop(heap)
+                    if d > dist[x]:
+                        continue
+                    settled += 1
+                    if x in targets:
+                        remaining -= 1
+                    if hops == hop_limit:
+                        continue
+                    for y, c in out[x].items():
+                        nd = d + c
+                        if y != v and nd <= limit and nd < dist.get(y, nd + 1):
+                            dist[y] = nd
+                            heapq.heappush(heap, (nd, y, hops + 1))
+                for w, cw in targets.items():
+                    if w != u and dist.get(w, cu + cw + 1) > cu + cw:
+                        needed.append((u, w, cu + cw))
+            return needed
+
+        def priority(v, needed):
+            return 2 * (2 * len(needed) - len(inn[v]) - len(out[v])) + deleted[v] + 12 * level[v]
+
+        started = time.time()
+        heap = [(priority(v, shortcuts(v)), v) for v in range(n)]
+        heapq.heapify(heap)
+        next_rank = 0
+        while heap:
+            _, v = heapq.heappop(heap)
+            if rank[v] >= 0:
+                continue
+            # Lazy update: re-queue if v is no longer the least important
+            needed = shortcuts(v)
+            current = priority(v, needed)
+            if heap and current > heap[0][0]:
+                heapq.heappush(heap, (current, v))
+                continue
+            if len(needed) > CORE_SHORTCUTS:
+                heapq.heappush(heap, (current, v))
+                break
+
+            for u, w, c in needed:
+                if c < out[u].get(w, c + 1):
+                    out[u][w] = c
+                    inn[w][u] = c
+                    via[(u, w)] = v
+
+            rank[v] = next_rank
+            next_rank += 1
+            up.extend((v, w, c) for w, c in out[v].items())
+            down.extend((v, u, c) for u, c in inn[v].items())
+            for u in inn[v]:
+                del out[u][v]
+                deleted[u] += 1
+                level[u] = max(level[u], level[v] + 1)
+            for w in out[v]:
+                del inn[w][v]
+                deleted[w] += 1
+                level[w] = max(level[w], level[v] + 1)
+
+            if verbose and next_rank % 10000 == 0:
+                print(f"  contracted {next_rank:,}/{n:,} states ({time.time() - started:.0f}s)")
+
+        # What is left is a dense core of interchanges: it keeps its edges
+        # as they are, in both directions, and is searched like a plain graph
+        core = [v for _, v in sorted(heap) if rank[v] < 0]
+        for v in core:
+            if rank[v] < 0:
+                rank[v] = next_rank
+                next_rank += 1
+                up.extend((v, w, c) for w, c in out[v].items())
+                down.extend((v, u, c) for u, c in inn[v].items())
+        if verbose and core:
+            print(f"  core of {len(set(core)):,} states left uncontracted ({time.time() - started:.0f}s)")
+
+        up_ptr, up_to, up_seconds = _csr(n, up)
+        down_ptr, down_from, down_seconds = _csr(n, down)
+        keys = np.array([u * n + w for u, w in via], dtype=np.int64)
+        values = np.fromiter(via.values(), dtype=np.int64, count=len(via))
+        order = np.argsort(keys)
+        return cls(
+            db_version=db_version, rank=rank.astype(np.int32),
+            up_ptr=up_ptr, up_to=up_to, up_seconds=up_seconds,
+            down_ptr=down_ptr, down_from=down_from, down_seconds=down_seconds,
+            edge_keys=keys[order], edge_via=values[order],
+        )
+
+    def query(self, sources, source_seconds, targets):
+        """
+        Bidirectional upward search
+
+        sources/source_seconds are starting states and costs; targets maps
+        state -> extra cost (the egress walk). Returns ((cost, target state,
+        source state, [(network edge, from state, to state), ...]) or None,
+        number of states settled).
+        """
+        up_ptr, up_to, up_seconds, down_ptr, down_from, down_seconds = self._adjacency_lists()
+        forward = {}
+        backward = {}
+        forward_parent = {}
+        backward_parent = {}
+        fq = []
+        bq = []
+        for s, c in zip(sources, source_seconds):
+            if c < forward.get(s, c + 1):
+                forward[s] = c
+                fq.append((c, s))
+        for t, c in targets.items():
+            if c < backward.get(t, c + 1):
+                backward[t] = c
+                bq.append((c, t))
+        heapq.heapify(fq)
+        heapq.heapify(bq)
+
+        best = float('inf')
+        meet = None
+        settled = 0
+        while fq or bq:
+            go_forward = fq and (not bq or fq[0][0] <= bq[0][0])
+            queue, dist, other, parent, ptr, adj, weights, stall_ptr, stall_adj, stall_weights = (
+                (fq, forward, backward, forward_parent, up_ptr, up_to, up_seconds,
+                 down_ptr, down_from, down_seconds) if go_forward
+                else (bq, backward, forward, backward_parent, down_ptr, down_from, down_seconds,
+                      up_ptr, up_to, up_seconds)
+            )
+            d, x = heapq.heappop(queue)
+            if d >= best:
+                # This direction cannot improve any more
+                queue.clear()
+                continue
+            if d > dist[x]:
+                continue
+            settled += 1
+            if x in other and d + other[x] < best:
+                best = d + other[x]
+                meet = x
+            # Stall-on-demand: a more important state already reaches x
+            # sooner, so nothing needs to be relaxed from here
+            stalled = False
+            for i in range(stall_ptr[x], stall_ptr[x + 1]):
+                if dist.get(stall_adj[i], d) + stall_weights[i] < d:
+                    stalled = True
+                    break
+            if stalled:
+                continue
+            for i in range(ptr[x], ptr[x + 1]):
+                y = adj[i]
+                nd = d + weights[i]
+                if nd < dist.get(y, nd + 1):
+                    dist[y] = nd
+                    parent[y] = x
+                    heapq.heappush(queue, (nd, y))
+
+        if meet is None:
+            return None, settled
+
+        # Chain of hierarchy edges source -> meet -> target, then unpack them
+        chain = [meet]
+        while chain[0] in forward_parent:
+            chain.insert(0, forward_parent[chain[0]])
+        while chain[-1] in backward_parent:
+            chain.append(backward_parent[chain[-1]])
+        path = []
+        for u, w in zip(chain[:-1], chain[1:]):
+            self._unpack(u, w, path)
+        return (best, chain[-1], chain[0], path), settled
+
+    def _unpack(self, u, w, path):
+        """Append the network edges (or CHANGE) behind hierarchy edge u -> w"""
+        stack = [(u, w)]
+        while stack:
+            a, b = stack.pop()
+            i = int(np.searchsorted(self.edge_keys, a * self.n_states + b))
+            via = int(self.edge_via[i])
+            if via < 0:
+                path.append((-via - 2, a, b))
+            else:
+                stack.append((via, b))
+                stack.append((a, via))
+
+    def _adjacency_lists(self):
+        if self._lists is None:
+            self._lists = tuple(getattr(self, name).tolist() for name in
+                                ['up_ptr', 'up_to', 'up_seconds', 'down_ptr', 'down_from', 'down_seconds'])
+        return self._lists
+
+    def save(self, path):
+        """Write atomically (temp file + rename)"""
+        path = Path(path)
+        tmp_path = path.with_name(f"{path.name}.tmp-{os.getpid()}")
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, db_version=np.array(self.db_version or ''),
+                     **{name: getattr(self, name) for name in self.ARRAYS})
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with load_npz(path) as data:
+            return cls(db_version=str(data['db_version']) or None,
+                       **{name: data[name] for name in cls.ARRAYS})
+
+
+def _csr(n, triples):
+    """(from, to, seconds) triples -> CSR arrays indexed by `from`"""
+    triples = np.array(triples, dtype=np.int64).reshape(-1, 3)
+    order = np.argsort(triples[:, 0], kind='stable')
+    triples = triples[order]
+    ptr = np.concatenate([[0], np.cumsum(np.bincount(triples[:, 0], minlength=n))])
+    return ptr, triples[:, 1].astype(np.int32), triples[:, 2].astype(np.int32)
+
+
+def load_hierarchy(transit_db, version, n_states):
+    """Load the hierarchy stored next to transit.db if it matches"""
+    path = hierarchy_path(transit_db.db_path)
+    if not path.exists():
+        return None
+    hierarchy = ContractionHierarchy.load(path)
+    if (version and hierarchy.db_version != version) or hierarchy.n_states != n_states:
+        print(f"⚠ {path.name} does not match transit.db version {version}, ignoring "
+              f"(rebuild with: python -m route_planner.hierarchy build)")
+        return None
+    return hierarchy
+
+
+def build_hierarchy(db_path=None):
+    """Build and store the hierarchy for a database"""
+    from .transit_db import TransitDB
+    from .gtfs_loader import DB_PATH
+    from .network import load_network
+
+    transit_db = TransitDB(db_path or DB_PATH)
+    if not transit_db.exists():
+        print("✗ No transit.db found - load GTFS data first")
+        return None
+    conn = transit_db.connection()
+    network = load_network(transit_db, conn, transit_db.version)
+    if network is None:
+        print("✗ No timetable artifact found - reload GTFS data first")
+        return None
+
+    print(f"Contracting {network.n_nodes + network.n_stops:,} search states...")
+    started = time.time()
+    hierarchy = ContractionHierarchy.build(network, transit_db.version)
+    hierarchy.save(hierarchy_path(transit_db.db_path))
+    print(f"✓ Built hierarchy in {time.time() - started:.0f}s: "
+          f"{len(hierarchy.up_to) + len(hierarchy.down_from):,} edges, "
+          f"{hierarchy.n_shortcuts:,} shortcuts")
+    return hierarchy
+
+
+def benchmark(db_path=None, queries=200, seed=0):
+    """Compare hierarchy queries against plain Dijkstra on random stop pairs"""
+    from .transit_db import TransitDB
+    from .gtfs_loader import DB_PATH
+    from .network import load_network
+
+    transit_db = TransitDB(db_path or DB_PATH)
+    network = load_network(transit_db, transit_db.connection(), transit_db.version)
+    if network is None or network.hierarchy is None:
+        print("✗ No hierarchy for this database - run: python -m route_planner.hierarchy build")
+        return None
+
+    rng = np.random.default_rng(seed)
+    n_nodes = network.n_nodes
+    times = {'dijkstra': [], 'hierarchy': []}
+    settled = {'dijkstra': [], 'hierarchy': []}
+    mismatches = 0
+    for a, b in rng.integers(0, network.n_stops, size=(queries, 2)).tolist():
+        started = time.perf_counter()
+        seconds, _, _ = network.search([a], [0], targets={b: 0})
+        times['dijkstra'].append(time.perf_counter() - started)
+        settled['dijkstra'].append(int(np.isfinite(seconds).sum()))
+        expected = min(seconds[b], seconds[n_nodes + b])
+
+        started = time.perf_counter()
+        result, count = network.hierarchy.query([n_nodes + a], [0], {b: 0, n_nodes + b: 0})
+        times['hierarchy'].append(time.perf_counter() - started)
+        settled['hierarchy'].append(count)
+        got = result[0] if result else float('inf')
+        if got != expected:
+            mismatches += 1
+
+    print(f"\n{queries} random stop-to-stop queries "
+          f"({n_nodes + network.n_stops:,} search states):")
+    for name in ['dijkstra', 'hierarchy']:
+        t = np.array(times[name]) * 1000
+        print(f"  {name:10s} median {np.median(t):7.2f} ms   p95 {np.percentile(t, 95):7.2f} ms   "
+              f"states touched {int(np.median(settled[name])):,}")
+    print(f"  speedup {np.median(times['dijkstra']) / np.median(times['hierarchy']):.0f}x, "
+          f"{mismatches} mismatching travel times")
+    return times
+
+
+def main():
+    """Command line entry point"""
+    command = sys.argv[1] if len(sys.argv) > 1 else 'build'
+    db_path = sys.argv[2] if len(sys.argv) > 2 else None
+    if command == 'build':
+        build_hierarchy(db_path)
+    elif command == 'bench':
+        benchmark(db_path, int(sys.argv[3]) if len(sys.argv) > 3 else 200)
+    else:
+        print("Usage: python -m route_planner.hierarchy build|bench [transit.db] [queries]")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Isochrones: everywhere reachable from one point within a time budget
+
+A single one-to-all RAPTOR search over the shared network (bus + metro +
+walking transfers) gives the earliest arrival at every stop. Stops reached
+within the budget are returned with their arrival times; optionally the
+area is drawn as a gridded polygon by letting the traveller walk on from
+each reached stop (and from the origin) for whatever time is left.
+"""
+
+import numpy as np
+from datetime import datetime
+from .geo import EARTH_RADIUS_KM, project_m
+from .raptor import INF, format_seconds
+from .transfers import WALK_SPEED_KMH
+
+MAX_MINUTES = 120
+DEFAULT_CELL_M = 250
+MAX_WALK_KM = 1.5           # Longest walk from the origin or off a vehicle
+
+
+def compute_isochrone(network, lat, lon, minutes, departure=None, max_transfers=3,
+                      polygon=False, cell_m=DEFAULT_CELL_M):
+    """
+    Stops reachable from (lat, lon) within `minutes`, departing at `departure`
+
+    Returns a dict with the reached stops (fastest first) and, when polygon
+    is set, a GeoJSON MultiPolygon of the grid cells reachable on foot.
+    """
+    departure = departure or datetime.now()
+    budget = int(minutes * 60)
+    t0, arrival = network.router.reach(lat, lon, departure, budget, max_transfers, MAX_WALK_KM)
+
+    reached = np.flatnonzero(arrival < min(t0 + budget, INF))
+    reached = reached[np.argsort(arrival[reached], kind='stable')]
+    stops = [{
+        'id': str(network.stop_ids[s]),
+        'name': str(network.stop_names[s]),
+        'lat': float(network.stop_lat[s]),
+        'lon': float(network.stop_lon[s]),
+        'mode': 'METRO' if network.stop_is_metro[s] else 'BUS',
+        'arrival': format_seconds(arrival[s]),
+        'minutes': round((int(arrival[s]) - t0) / 60, 1),
+    } for s in reached.tolist()]
+
+    result = {
+        'origin': {'lat': lat, 'lon': lon},
+        'departure': format_seconds(t0),
+        'minutes': minutes,
+        'stops': stops,
+        'count': len(stops),
+        'metro_stops': sum(1 for s in stops if s['mode'] == 'METRO'),
+    }
+
+    if polygon:
+        # Walking radius left at each reached stop, plus the origin itself
+        walk_m_per_s = WALK_SPEED_KMH * 1000.0 / 3600
+        remaining = np.concatenate([[budget], t0 + budget - arrival[reached]])
+        radius_m = np.minimum(remaining * walk_m_per_s, MAX_WALK_KM * 1000.0)
+        point_lat = np.concatenate([[lat], network.stop_lat[reached]])
+        point_lon = np.concatenate([[lon], network.stop_lon[reached]])
+        result['polygon'] = _grid_polygon(point_lat, point_lon, radius_m, lat, lon, cell_m)
+
+    return result
+
+
+def _grid_polygon(point_lat, point_lon, radius_m, origin_lat, origin_lon, cell_m):
+    """Union of walking disks rasterised on a grid, as a GeoJSON MultiPolygon"""
+    x, y = project_m(point_lat, point_lon, origin_lat, origin_lon)
+    reach = int(np.ceil(radius_m.max() / cell_m))
+    x_min = x.min() - (reach + 1) * cell_m
+    y_min = y.min() - (reach + 1) * cell_m
+    n_cx = int(np.ceil((x.max() - x_min) / cell_m)) + reach + 2
+    n_cy = int(np.ceil((y.max() - y_min) / cell_m)) + reach + 2
+
+    # Stamp every point's disk at once: (point, window offset) pairs whose
+    # cell centre lies within that point's radius
+    cx = np.floor((x - x_min) / cell_m).astype(np.int64)
+    cy = np.floor((y - y_min) / cell_m).astype(np.int64)
+    offsets = np.arange(-reach, reach + 1)
+    dx, dy = (d.ravel() for d in np.meshgrid(offsets, offsets, indexing='ij'))
+    gx = cx[:, None] + dx[None, :]
+    gy = cy[:, None] + dy[None, :]
+    centre_x = x_min + (gx + 0.5) * cell_m
+    centre_y = y_min + (gy + 0.5) * cell_m
+    inside = np.hypot(centre_x - x[:, None], centre_y - y[:, None]) <= radius_m[:, None]
+
+    grid = np.zeros((n_cy, n_cx), dtype=bool)
+    grid[gy[inside], gx[inside]] = True
+
+    # Runs of filled cells per row, merged with identical runs in the rows above
+    rectangles = []
+    open_runs = {}
+    for row in range(n_cy + 1):
+        runs = set()
+        if row < n_cy:
+            edges = np.diff(np.concatenate([[0], grid[row].astype(np.int8), [0]]))
+            runs = set(zip(np.flatnonzero(edges == 1).tolist(), np.flatnonzero(edges == -1).tolist()))
+        for run in list(open_runs):
+            if run not in runs:
+                rectangles.append((run[0], open_runs.pop(run), run[1], row))
+        for run in runs:
+            open_runs.setdefault(run, row)
+
+    k = np.pi / 180.0 * EARTH_RADIUS_KM * 1000.0
+    lon_scale = k * np.cos(np.radians(origin_lat))
+
+    def corner(col, row):
+        return [round(origin_lon + (x_min + col * cell_m) / lon_scale, 6),
+                round(origin_lat + (y_min + row * cell_m) / k, 6)]
+
+    coordinates = [[[corner(c0, r0), corner(c1, r0), corner(c1, r1), corner(c0, r1), corner(c0, r0)]]
+                   for c0, r0, c1, r1 in rectangles]
+    return {
+        'type': 'MultiPolygon',
+        'coordinates': coordinates,
+        'cell_m': cell_m,
+        'area_km2': round(float(grid.sum()) * cell_m * cell_m / 1e6, 2),
+    }
@@ -0,0 +1,140 @@
+"""
+Many-to-many door-to-door travel-time matrices
+
+Each origin costs one one-to-all RAPTOR search over the shared bus + metro
+network; a single vectorized sweep then reads every destination's arrival
+from the labels of the stops it can walk from. Destinations are snapped
+to stops once per matrix, and origins are spread over a process pool.
+
+The pool is started once, by start_pool() at server startup, before any
+other thread exists: forked workers then inherit the loaded network and
+no lock can be held mid-fork. Requests only send their snapped
+destinations along with each run of origins. Without a pool (scripts,
+tests) origins are searched in the calling process.
+
+The result is a dense int32 array of travel seconds (UNREACHABLE where the
+destination cannot be reached within the time budget).
+"""
+
+import math
+import multiprocessing
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from .geo import haversine_km, points_within
+from .network import MAX_WALK_KM, get_network
+from .transfers import WALK_SPEED_KMH
+from .transit_db import get_transit_db
+
+UNREACHABLE = -1
+DEFAULT_MAX_MINUTES = 180
+ORIGINS_PER_TASK = 8
+TASKS_PER_WORKER = 4
+
+# Worker processes shared by all requests, set by start_pool
+_pool = None
+_pool_workers = 0
+
+
+def start_pool(workers=None):
+    """
+    Start the matrix worker processes
+
+    Call once at startup, before starting any thread. Uses fork where the
+    platform has it (workers share the already loaded network), else spawn
+    (each worker loads the network once, on start).
+    """
+    global _pool, _pool_workers
+    if _pool is not None:
+        return _pool
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1:
+        return None
+
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in methods else 'spawn')
+    get_network()
+    _pool = ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker)
+    # The first task launches the workers now rather than from a request thread
+    _pool.submit(_init_worker).result()
+    _pool_workers = workers
+    print(f"✓ Started {workers} travel-time matrix workers ({context.get_start_method()})")
+    return _pool
+
+
+def travel_time_matrix(origins, destinations, departure=None, max_transfers=3,
+                       max_minutes=DEFAULT_MAX_MINUTES):
+    """
+    Door-to-door travel seconds from every origin to every destination
+
+    origins/destinations are sequences of (lat, lon). Returns an int32
+    array of shape (len(origins), len(destinations)).
+    """
+    network = get_network()
+    if network is None:
+        raise RuntimeError("Static GTFS data not loaded")
+
+    origins = np.asarray(origins, dtype=np.float64).reshape(-1, 2)
+    destinations = np.asarray(destinations, dtype=np.float64).reshape(-1, 2)
+    departure = departure or datetime.now()
+
+    # Snap destinations once: flat (destination, stop, walk seconds) triples
+    snapped = points_within(destinations[:, 0], destinations[:, 1],
+                            network.stop_lat, network.stop_lon, MAX_WALK_KM)
+    egress_dest = np.repeat(np.arange(len(destinations)), [len(stops) for stops, _ in snapped])
+    egress_stop = np.concatenate([stops for stops, _ in snapped] + [np.empty(0, dtype=np.int64)])
+    egress_km = np.concatenate([km for _, km in snapped] + [np.empty(0)])
+    egress_seconds = (egress_km / WALK_SPEED_KMH * 3600).astype(np.int64)
+
+    state = (get_transit_db().version, destinations, egress_dest, egress_stop, egress_seconds,
+             departure, max_transfers, int(max_minutes * 60))
+    matrix = np.full((len(origins), len(destinations)), UNREACHABLE, dtype=np.int32)
+
+    pool = _pool
+    if pool is None:
+        start, block = _origin_rows((0, origins, state))
+        matrix[:] = block
+        return matrix
+
+    # Few enough tasks that the destinations are not pickled over and over
+    per_task = max(ORIGINS_PER_TASK, math.ceil(len(origins) / (_pool_workers * TASKS_PER_WORKER)))
+    tasks = [(a, origins[a:a + per_task], state) for a in range(0, len(origins), per_task)]
+    for start, block in pool.map(_origin_rows, tasks):
+        matrix[start:start + len(block)] = block
+    return matrix
+
+
+def _init_worker():
+    """Load the network in a worker (a no-op when it was inherited by fork)"""
+    get_network()
+
+
+def _origin_rows(task):
+    """Matrix rows for a run of origins"""
+    start, origins, (version, destinations, egress_dest, egress_stop, egress_seconds,
+                     departure, max_transfers, max_seconds) = task
+
+    # Workers have no watcher thread: follow the requesting process's database
+    transit_db = get_transit_db()
+    if transit_db.version != version:
+        transit_db.check_for_update(force=True)
+    router = get_network().router
+    block = np.full((len(origins), len(destinations)), UNREACHABLE, dtype=np.int32)
+
+    for row, (lat, lon) in enumerate(origins):
+        t0, arrival = router.reach(lat, lon, departure, max_seconds, max_transfers, MAX_WALK_KM)
+
+        # Sweep all destinations: best (stop arrival + egress walk) each
+        best = np.full(len(destinations), np.iinfo(np.int64).max, dtype=np.int64)
+        np.minimum.at(best, egress_dest, arrival[egress_stop] + egress_seconds)
+        seconds = best - t0
+
+        # Or just walk there
+        walk_km = haversine_km(lat, lon, destinations[:, 0], destinations[:, 1])
+        seconds = np.minimum(seconds, (walk_km / WALK_SPEED_KMH * 3600).astype(np.int64))
+
+        reached = seconds <= max_seconds
+        block[row, reached] = seconds[reached]
+
+    return start, block
@@ -0,0 +1,194 @@
+"""
+Process metrics in the Prometheus text exposition format
+
+Cheap enough to leave on: recording a timing is two perf_counter() calls, a
+bisect over the bucket bounds and one locked increment. Counts live in
+plain lists per label set; nothing is aggregated until /metrics is scraped.
+Values kept elsewhere (plan cache counters, memory, CPU time) are
+read at scrape time rather than tracked on every request.
+
+    with PLANNER_STAGE.time('metro_search'):
+        ...
+    HTTP_LATENCY.observe(seconds, '/api/plan-route', 'POST', '200')
+"""
+
+import os
+import threading
+import time
+from bisect import bisect_left
+
+try:
+    import resource
+except ImportError:     # Windows
+    resource = None
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._series = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Gauge(_Metric):
+    """A value that goes up and down, set by whoever knows it"""
+
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        self._series[labels] = value
+
+    def value(self, *labels):
+        return self._series.get(labels)
+
+    def render(self):
+        lines = self._header()
+        for labels, value in sorted(self._series.items()):
+            if value is not None:
+                lines.append(f"{self.name}{_labels(self.labels, labels)} {_number(value)}")
+        return lines
+
+
+class Counter(Gauge):
+    """A running total; set() mirrors totals counted elsewhere"""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, *labels):
+        with self._lock:
+            self._series[labels] = self._series.get(labels, 0) + amount
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+class Histogram(_Metric):
+    """Observations counted into fixed buckets (cumulative only when rendered)"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def time(self, *labels):
+        """Context manager observing the seconds spent in its block"""
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = self._header()
+        with self._lock:
+            series = [(labels, list(counts), total) for labels, (counts, total) in self._series.items()]
+        for labels, counts, total in sorted(series):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = f'le="{_number(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labels, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, labels)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labels, labels)} {cumulative}")
+        return lines
+
+
+HTTP_LATENCY = Histogram('http_request_duration_seconds', 'Time to answer an API request',
+                         ('endpoint', 'method', 'status'))
+FEED_STAGE = Histogram('feed_stage_duration_seconds',
+                       'Live feed refresh stages: fetch, parse and the per-refresh indexes',
+                       ('stage',))
+PLANNER_STAGE = Histogram('planner_stage_duration_seconds', 'Route planning stages', ('stage',))
+FEED_BYTES = Gauge('feed_snapshot_bytes', 'Size of the last ingested feed message')
+FEED_VEHICLES = Gauge('feed_snapshot_vehicles', 'Vehicles in the last ingested feed message')
+FEED_TIMESTAMP = Gauge('feed_snapshot_timestamp_seconds', 'Header timestamp of the last ingested feed message')
+FEED_AGE = Gauge('feed_snapshot_age_seconds', 'Seconds since the last ingested feed message was produced')
+PLAN_CACHE_LOOKUPS = Counter('plan_cache_lookups_total', 'Plan cache lookups by outcome', ('result',))
+PLAN_CACHE_HIT_RATIO = Gauge('plan_cache_hit_ratio', 'Share of plan cache lookups answered from the cache')
+PLAN_CACHE_ENTRIES = Gauge('plan_cache_entries', 'Plans held in the plan cache')
+MEMORY = Gauge('process_resident_memory_bytes', 'Resident memory of this process')
+MEMORY_PEAK = Gauge('process_max_resident_memory_bytes', 'Peak resident memory of this process')
+CPU = Counter('process_cpu_seconds_total', 'User and system CPU time of this process')
+
+
+def _resident_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def collect(planner=None):
+    """Refresh the values read at scrape time"""
+    if FEED_TIMESTAMP.value() is not None:
+        FEED_AGE.set(round(time.time() - FEED_TIMESTAMP.value(), 3))
+    if planner is not None:
+        stats = planner.plan_cache.stats()
+        PLAN_CACHE_LOOKUPS.set(stats['live_hits'], 'live_hit')
+        PLAN_CACHE_LOOKUPS.set(stats['metro_hits'], 'metro_hit')
+        PLAN_CACHE_LOOKUPS.set(stats['misses'], 'miss')
+        PLAN_CACHE_HIT_RATIO.set(stats['hit_rate'])
+        PLAN_CACHE_ENTRIES.set(stats['entries'])
+    MEMORY.set(_resident_bytes())
+    if resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        MEMORY_PEAK.set(usage.ru_maxrss * 1024)
+        CPU.set(round(usage.ru_utime + usage.ru_stime, 3))
+
+
+def render(planner=None):
+    """Every metric in the Prometheus text format"""
+    collect(planner)
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
@@ -8,6 +8,10 @@ from pathlib import Path
 from geopy.distance import geodesic
 from datetime import datetime, timedelta
 import networkx as nx
+import numpy as np
+from .network import MODES, metro_fare, get_network
+from .gtfs_loader import METRO_ID_PREFIX
+from .tracing import traced
 
 class MetroPlanner:
     """Plans routes using Delhi Metro network"""
@@ -142,6 +146,7 @@ class MetroPlanner:
                                           distance=distance, 
                                           route_id=route_id)
     
+    @traced
     def find_nearest_stations(self, lat, lon, max_distance_km=1.5, limit=5):
         """Find nearest metro stations to a location"""
         distances = []
@@ -158,12 +163,18 @@ class MetroPlanner:
         distances.sort(key=lambda x: x['distance'])
         return distances[:limit]
     
+    @traced
     def plan_metro_route(self, start_lat, start_lon, end_lat, end_lon):
         """
         Plan a metro route between two points
         
         Returns list of possible metro routes
         """
+        # Use the shared bus + metro network (scheduled run times) when loaded
+        network = get_network()
+        if network is not None and network.has_mode('METRO'):
+            return self._plan_on_network(network, start_lat, start_lon, end_lat, end_lon)
+        
         # Find nearest stations to start and end
         start_stations = self.find_nearest_stations(start_lat, start_lon, max_distance_km=2.0, limit=3)
         end_stations = self.find_nearest_stations(end_lat, end_lon, max_distance_km=2.0, limit=3)
@@ -210,41 +221,118 @@ class MetroPlanner:
         
         return routes[:3]  # Return top 3
     
+    @traced
+    def plan_metro_routes(self, start_lat, start_lon, destinations):
+        """
+        Plan metro routes from one origin to many (lat, lon) destinations
+        
+        The origin is searched once and every destination reads the result.
+        Returns one list of routes per destination.
+        """
+        end_lat = np.array([lat for lat, _ in destinations], dtype=np.float64)
+        end_lon = np.array([lon for _, lon in destinations], dtype=np.float64)
+        
+        network = get_network()
+        if network is not None and network.has_mode('METRO'):
+            plans = network.plan_many(
+                start_lat, start_lon, end_lat, end_lon,
+                modes={'METRO', 'WALK'}, max_walk_km=2.0
+            )
+            return [self._routes_from_journeys(journeys, start_lat, start_lon, lat, lon)
+                    for journeys, lat, lon in zip(plans, end_lat.tolist(), end_lon.tolist())]
+        
+        start_stations = self.find_nearest_stations(start_lat, start_lon, max_distance_km=2.0, limit=3)
+        if not start_stations:
+            return [[] for _ in destinations]
+        
+        # One single-source search per start station, shared by all destinations
+        paths = {}
+        for start_station in start_stations:
+            try:
+                paths[start_station['id']] = nx.single_source_dijkstra_path(
+                    self.graph, start_station['id'], weight='distance'
+                )
+            except Exception as e:
+                print(f"Error finding paths: {e}")
+                paths[start_station['id']] = {}
+        
+        results = []
+        for lat, lon in zip(end_lat.tolist(), end_lon.tolist()):
+            routes = []
+            for end_station in self.find_nearest_stations(lat, lon, max_distance_km=2.0, limit=3):
+                for start_station in start_stations:
+                    path = paths[start_station['id']].get(end_station['id'])
+                    if path is None or len(path) < 2:
+                        continue
+                    routes.append(self._create_metro_route(
+                        path, start_lat, start_lon, lat, lon, start_station, end_station
+                    ))
+            routes.sort(key=lambda x: x['totalDuration'])
+            results.append(routes[:3])
+        return results
+    
+    @traced
+    def _plan_on_network(self, network, start_lat, start_lon, end_lat, end_lon):
+        """Metro-only journey over the shared network, with scheduled run times"""
+        journeys = network.plan(
+            start_lat, start_lon, end_lat, end_lon,
+            modes={'METRO', 'WALK'}, max_walk_km=2.0
+        )
+        return self._routes_from_journeys(journeys, start_lat, start_lon, end_lat, end_lon)
+    
+    @traced
+    def _routes_from_journeys(self, journeys, start_lat, start_lon, end_lat, end_lon):
+        """Metro route objects for network journeys"""
+        routes = []
+        for journey in journeys:
+            rides = [leg for leg in journey['legs'] if leg['mode'] == 'METRO']
+            if not rides:
+                continue
+            
+            # Stations in travel order (an interchange station appears once)
+            path = []
+            for leg in rides:
+                for stop in leg['stops']:
+                    if not path or path[-1]['name'] != stop['name']:
+                        path.append(stop)
+            
+            lines_used = []
+            for leg in rides:
+                line_id = leg['route_id'][len(METRO_ID_PREFIX):]
+                name = self.routes.get(line_id, {}).get('name', 'Metro Line')
+                if name not in lines_used:
+                    lines_used.append(name)
+            
+            start_station = {**path[0], 'distance': self._walk_distance(journey['legs'][0], start_lat, start_lon, path[0])}
+            end_station = {**path[-1], 'distance': self._walk_distance(journey['legs'][-1], end_lat, end_lon, path[-1])}
+            metro_time = int((rides[-1]['arrival'] - rides[0]['departure']) / 60)
+            
+            routes.append(self._metro_route_object(
+                path, sum(leg['distance_km'] for leg in rides), metro_time, lines_used,
+                start_lat, start_lon, end_lat, end_lon, start_station, end_station
+            ))
+        
+        return routes
+    
+    def _walk_distance(self, leg, lat, lon, station):
+        """Length of the access/egress walk between a point and a station"""
+        if leg['mode'] == 'WALK':
+            return leg['distance_km']
+        return geodesic((lat, lon), (station['lat'], station['lon'])).km
+    
+    @traced
     def _create_metro_route(self, path, start_lat, start_lon, end_lat, end_lon, 
                            start_station, end_station):
         """Create a route object from a metro path"""
         
-        # Calculate distances
-        walk_to_start = start_station['distance']
-        walk_from_end = end_station['distance']
-        
         # Calculate metro travel distance
         metro_distance = 0
         for i in range(len(path) - 1):
             if self.graph.has_edge(path[i], path[i+1]):
                 metro_distance += self.graph[path[i]][path[i+1]]['distance']
         
-        # Calculate times (metro average: 40 km/h, walking: 5 km/h)
-        metro_time = int((metro_distance / 40.0) * 60)  # minutes
-        walk_time_start = int((walk_to_start / 5.0) * 60)
-        walk_time_end = int((walk_from_end / 5.0) * 60)
-        wait_time = 3  # Metro is more frequent
-        
-        total_duration = metro_time + walk_time_start + walk_time_end + wait_time
-        
-        # Calculate cost (Metro: ₹10-60 based on distance)
-        if metro_distance < 2:
-            cost = 10
-        elif metro_distance < 5:
-            cost = 20
-        elif metro_distance < 12:
-            cost = 30
-        elif metro_distance < 21:
-            cost = 40
-        elif metro_distance < 32:
-            cost = 50
-        else:
-            cost = 60
+        # Calculate time from the metro speed model
+        metro_time = int(MODES['METRO'].travel_seconds(metro_distance) / 60)  # minutes
         
         # Determine which lines are used
         lines_used = set()
@@ -254,6 +342,30 @@ class MetroPlanner:
                 if route_id in self.routes:
                     lines_used.add(self.routes[route_id]['name'])
         
+        stations = [self.stations[stop_id] for stop_id in path]
+        return self._metro_route_object(
+            stations, metro_distance, metro_time, lines_used,
+            start_lat, start_lon, end_lat, end_lon, start_station, end_station
+        )
+    
+    def _metro_route_object(self, stations, metro_distance, metro_time, lines_used,
+                            start_lat, start_lon, end_lat, end_lon, start_station, end_station):
+        """Build the route response for a metro ride between two stations"""
+        
+        # Calculate distances
+        walk_to_start = start_station['distance']
+        walk_from_end = end_station['distance']
+        
+        walk = MODES['WALK']
+        walk_time_start = int(walk.travel_seconds(walk_to_start) / 60)
+        walk_time_end = int(walk.travel_seconds(walk_from_end) / 60)
+        wait_time = int(MODES['METRO'].wait_seconds / 60)  # Metro is more frequent
+        
+        total_duration = metro_time + walk_time_start + walk_time_end + wait_time
+        
+        # Calculate cost (Metro: ₹10-60 based on distance)
+        cost = metro_fare(metro_distance)
+        
         # Build segments
         segments = []
         
@@ -272,8 +384,7 @@ class MetroPlanner:
         
         # Metro journey
         metro_stops = []
-        for stop_id in path:
-            station = self.stations[stop_id]
+        for station in stations:
             metro_stops.append({
                 'name': station['name'],
                 'lat': station['lat'],
@@ -285,7 +396,7 @@ class MetroPlanner:
             'details': f'Delhi Metro: {" → ".join(lines_used)}',
             'duration': metro_time,
             'distance': metro_distance,
-            'realtimeInfo': f'✓ {len(path)} stations, {len(lines_used)} line(s)',
+            'realtimeInfo': f'✓ {len(stations)} stations, {len(lines_used)} line(s)',
             'path': [{'lat': s['lat'], 'lng': s['lon']} for s in metro_stops],
             'stopsList': [
                 {
@@ -324,12 +435,12 @@ class MetroPlanner:
             'totalCost': cost,
             'comfortScore': 9,  # Metro is very comfortable
             'confidenceScore': 0.95,  # High confidence for metro
-            'summary': f'Take Delhi Metro {lines_str} - {metro_distance:.1f} km, {len(path)} stations',
-            'realtimeInfo': f'✓ Metro route via {len(path)} stations',
+            'summary': f'Take Delhi Metro {lines_str} - {metro_distance:.1f} km, {len(stations)} stations',
+            'realtimeInfo': f'✓ Metro route via {len(stations)} stations',
             'routeDetails': {
                 'mode': 'metro',
                 'lines': list(lines_used),
-                'stations': len(path),
+                'stations': len(stations),
                 'distance': metro_distance,
                 'start_station': start_station['name'],
                 'end_station': end_station['name']
@@ -0,0 +1,540 @@
+"""
+Unified bus + metro network model
+
+Both GTFS feeds share one stop index (metro IDs carry METRO_ID_PREFIX), so
+a single graph covers every stop:
+
+- stop nodes, one per stop,
+- route nodes, one per (route, stop) served, so boarding a vehicle costs
+  the mode's wait while staying on it does not,
+- ride edges between consecutive route nodes, timed by the mean scheduled
+  run time (or the mode's speed model when the schedule has none), and
+  board edges from a stop straight to the next route node (wait + ride),
+- walk edges from the precomputed transfer table, including bus <-> metro
+  interchanges.
+
+The network is built once per transit.db version and shared read-only by
+all requests. The RAPTOR router (exact timetable) hangs off it, and the
+graph itself answers schedule-free questions: metro-only paths, estimated
+bus -> metro -> bus journeys and one-to-all searches. When a contraction
+hierarchy has been built offline (see hierarchy.py), all-mode plan()
+queries use it instead of searching the whole graph.
+"""
+
+import heapq
+import threading
+from collections import defaultdict
+import numpy as np
+from datetime import date, datetime
+from .geo import haversine_km, points_within
+from .transfers import WALK_SPEED_KMH, load_transfers
+from .hierarchy import CHANGE, load_hierarchy
+
+MAX_WALK_KM = 1.5           # Access/egress radius around origin and destination
+
+# Edge kinds
+RIDE, BOARD, ALIGHT, WALK = 0, 1, 2, 3
+
+
+def bus_fare(distance_km):
+    """DTC fare estimate: ₹10 base + ₹5 per km"""
+    return 10 + int(distance_km * 5)
+
+
+def metro_fare(distance_km):
+    """DMRC distance-slab fare in rupees (₹10-60)"""
+    if distance_km < 2:
+        return 10
+    elif distance_km < 5:
+        return 20
+    elif distance_km < 12:
+        return 30
+    elif distance_km < 21:
+        return 40
+    elif distance_km < 32:
+        return 50
+    else:
+        return 60
+
+
+class ModeModel:
+    """Average speed, boarding wait and fare of one mode of travel"""
+
+    def __init__(self, name, speed_kmh, wait_seconds, fare):
+        self.name = name
+        self.speed_kmh = speed_kmh
+        self.wait_seconds = wait_seconds
+        self.fare = fare
+
+    def travel_seconds(self, distance_km):
+        return distance_km / self.speed_kmh * 3600
+
+
+MODES = {
+    'BUS': ModeModel('BUS', speed_kmh=20.0, wait_seconds=300, fare=bus_fare),
+    'METRO': ModeModel('METRO', speed_kmh=40.0, wait_seconds=180, fare=metro_fare),
+    'WALK': ModeModel('WALK', speed_kmh=WALK_SPEED_KMH, wait_seconds=0, fare=lambda distance_km: 0),
+}
+
+
+def journey_fare(legs):
+    """
+    Fare of a journey's legs
+
+    Each bus boarding is paid separately; consecutive metro rides (walks
+    between them included) are one DMRC trip priced on their total distance.
+    """
+    cost = 0
+    metro_distance = 0
+    for leg in legs:
+        if leg['mode'] == 'WALK':
+            continue
+        if leg['mode'] == 'METRO':
+            metro_distance += leg['distance_km']
+            continue
+        if metro_distance:
+            cost += metro_fare(metro_distance)
+            metro_distance = 0
+        cost += MODES[leg['mode']].fare(leg['distance_km'])
+    if metro_distance:
+        cost += metro_fare(metro_distance)
+    return cost
+
+
+class TransitNetwork:
+    """Stops, route nodes and ride/board/alight/walk edges of both feeds in CSR form"""
+
+    def __init__(self, timetable, transfers=None, calendar=None):
+        from .raptor import RaptorRouter
+
+        tt = timetable
+        self.timetable = tt
+        self.transfers = transfers
+        self.db_version = tt.db_version
+        self.n_stops = n_stops = tt.n_stops
+        self.stop_ids = tt.stop_ids
+        self.stop_names = tt.stop_names
+        self.stop_lat = tt.stop_lat
+        self.stop_lon = tt.stop_lon
+        self.stop_is_metro = tt.stop_is_metro
+        self.route_ids = tt.route_ids
+        self.route_mode = np.where(tt.route_is_metro, 'METRO', 'BUS')
+
+        # One node per (route, stop) served by some pattern
+        position_pattern = np.repeat(np.arange(tt.n_patterns), tt.pattern_n_stops)
+        position_route = tt.pattern_route[position_pattern].astype(np.int64)
+        keys = position_route * n_stops + tt.pattern_stops
+        node_keys, position_node = np.unique(keys, return_inverse=True)
+        self.node_route = (node_keys // n_stops).astype(np.int32)
+        self.node_stop = (node_keys % n_stops).astype(np.int32)
+        self.n_nodes = n_stops + len(node_keys)
+        position_node = position_node + n_stops
+
+        # Ride edges: mean scheduled run time between consecutive positions
+        column_start = np.repeat(tt.pattern_time_ptr[:-1], tt.pattern_n_stops) + (
+            (np.arange(len(tt.pattern_stops)) - np.repeat(tt.pattern_stop_ptr[:-1], tt.pattern_n_stops))
+            * np.repeat(tt.pattern_n_trips, tt.pattern_n_stops)
+        )
+        n_trips = tt.pattern_n_trips[position_pattern]
+        dep_mean = np.add.reduceat(tt.dep_times.astype(np.int64), column_start) / n_trips
+        arr_mean = np.add.reduceat(tt.arr_times.astype(np.int64), column_start) / n_trips
+        has_next = np.ones(len(tt.pattern_stops), dtype=bool)
+        has_next[tt.pattern_stop_ptr[1:] - 1] = False
+        a = np.flatnonzero(has_next)
+        b = a + 1
+        ride_km = haversine_km(tt.stop_lat[tt.pattern_stops[a]], tt.stop_lon[tt.pattern_stops[a]],
+                               tt.stop_lat[tt.pattern_stops[b]], tt.stop_lon[tt.pattern_stops[b]])
+        ride_seconds = arr_mean[b] - dep_mean[a]
+        modelled = np.where(tt.route_is_metro[position_route[a]],
+                            MODES['METRO'].travel_seconds(ride_km), MODES['BUS'].travel_seconds(ride_km))
+        ride_seconds = np.where(ride_seconds > 0, ride_seconds, modelled)
+
+        # Keep the fastest edge between any two route nodes
+        ride_from, ride_to = position_node[a], position_node[b]
+        order = np.lexsort((ride_seconds, ride_to, ride_from))
+        ride_from, ride_to, ride_seconds, ride_km = (ride_from[order], ride_to[order],
+                                                     ride_seconds[order], ride_km[order])
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (ride_from[1:] != ride_from[:-1]) | (ride_to[1:] != ride_to[:-1])
+        ride_from, ride_to, ride_seconds, ride_km = (ride_from[first], ride_to[first],
+                                                     ride_seconds[first], ride_km[first])
+
+        # Boarding rides at least one stop, so a route node is never a
+        # zero-length detour between two walks
+        route_nodes = np.arange(n_stops, self.n_nodes)
+        board_route = self.node_route[ride_from - n_stops]
+        board_wait = np.where(tt.route_is_metro[board_route],
+                              MODES['METRO'].wait_seconds, MODES['BUS'].wait_seconds)
+
+        parts = [
+            (ride_from, ride_to, ride_seconds, RIDE, ride_km),
+            (self.node_stop[ride_from - n_stops], ride_to, board_wait + ride_seconds, BOARD, ride_km),
+            (route_nodes, self.node_stop, 0, ALIGHT, 0.0),
+        ]
+        if transfers is not None:
+            indptr, indices, walk_seconds = transfers.as_csr()
+            walk_from = np.repeat(np.arange(n_stops), np.diff(indptr))
+            parts.append((walk_from, indices, walk_seconds, WALK, transfers.distance_m / 1000.0))
+
+        src = np.concatenate([np.asarray(p[0], dtype=np.int64) for p in parts])
+        counts = [len(p[0]) for p in parts]
+        dst = np.concatenate([np.asarray(p[1], dtype=np.int64) for p in parts])
+        seconds = np.concatenate([np.broadcast_to(np.asarray(p[2], dtype=np.float64), (n,))
+                                  for p, n in zip(parts, counts)])
+        kind = np.concatenate([np.full(n, p[3], dtype=np.int8) for p, n in zip(parts, counts)])
+        km = np.concatenate([np.broadcast_to(np.asarray(p[4], dtype=np.float64), (n,))
+                             for p, n in zip(parts, counts)])
+
+        order = np.argsort(src, kind='stable')
+        self.edge_ptr = np.concatenate([[0], np.cumsum(np.bincount(src, minlength=self.n_nodes))])
+        self.edge_to = dst[order].astype(np.int32)
+        self.edge_seconds = np.ceil(seconds[order]).astype(np.int32)
+        self.edge_kind = kind[order]
+        self.edge_km = km[order].astype(np.float32)
+        # Mode of the route a ride/board/alight edge belongs to (walks: WALK)
+        route_of_edge = np.where(self.edge_to >= n_stops, self.edge_to, src[order]) - n_stops
+        self.edge_mode = np.where(self.edge_kind == WALK, 'WALK',
+                                  self.route_mode[self.node_route[np.clip(route_of_edge, 0, None)]])
+
+        for name in ['node_route', 'node_stop', 'edge_ptr', 'edge_to', 'edge_seconds',
+                     'edge_kind', 'edge_km', 'edge_mode']:
+            getattr(self, name).flags.writeable = False
+
+        self._adjacency = None
+        self._masks = {}
+        self.hierarchy = None       # ContractionHierarchy, when one has been built offline
+        self._lock = threading.Lock()
+
+        # Exact timetable routing over the same stops
+        self.router = RaptorRouter(tt, calendar, transfers)
+
+    @property
+    def n_edges(self):
+        return len(self.edge_to)
+
+    def count_edges(self, kind):
+        return int(np.count_nonzero(self.edge_kind == kind))
+
+    def has_mode(self, mode):
+        return bool(np.any(self.route_mode == mode))
+
+    def stop_index(self, stop_id):
+        return self.timetable.stop_index(stop_id)
+
+    def nearby_stops(self, lat, lon, max_km, mode=None):
+        """Stops within max_km of a point, nearest first, as (indices, distances_km)"""
+        distances = haversine_km(lat, lon, self.stop_lat, self.stop_lon)
+        within = distances <= max_km
+        if mode == 'METRO':
+            within &= self.stop_is_metro
+        elif mode == 'BUS':
+            within &= ~self.stop_is_metro
+        idx = np.flatnonzero(within)
+        idx = idx[np.argsort(distances[idx], kind='stable')]
+        return idx, distances[idx]
+
+    def search(self, sources, source_seconds, targets=None, modes=None, max_seconds=None):
+        """
+        Schedule-free shortest travel times from several sources at once
+
+        sources/source_seconds are stop indices and their starting costs;
+        targets optionally maps stop index -> extra seconds (e.g. the egress
+        walk), and the search stops once no target can improve. modes limits
+        the edges used (e.g. {'METRO', 'WALK'}). Two walks are never chained.
+
+        Returns (seconds, parent_edge, parent_state) over search states:
+        state s < n_nodes is a node, n_nodes + stop is a stop reached on foot.
+        """
+        indptr, to, weight, kind, allowed = self._adjacency_lists(modes)
+        n_nodes = self.n_nodes
+        walked_base = n_nodes
+        INF = float('inf')
+        seconds = [INF] * (n_nodes + self.n_stops)
+        parent = [-1] * (n_nodes + self.n_stops)
+        previous = [-1] * (n_nodes + self.n_stops)
+        limit = INF if max_seconds is None else max_seconds
+        best_target = INF
+        targets = targets or {}
+
+        # Sources are reached on foot (the access walk)
+        heap = []
+        for stop, cost in zip(np.asarray(sources).tolist(), np.asarray(source_seconds).tolist()):
+            if cost < seconds[walked_base + stop]:
+                seconds[walked_base + stop] = cost
+                heap.append((cost, walked_base + stop))
+        heapq.heapify(heap)
+
+        while heap:
+            cost, state = heapq.heappop(heap)
+            if cost > seconds[state]:
+                continue
+            if cost >= best_target or cost > limit:
+                break
+            walked = state >= walked_base
+            node = state - walked_base if walked else state
+            if node in targets:
+                best_target = min(best_target, cost + targets[node])
+            for e in range(indptr[node], indptr[node + 1]):
+                if not allowed[e]:
+                    continue
+                if kind[e] == WALK:
+                    if walked:
+                        continue
+                    nxt = walked_base + to[e]
+                else:
+                    nxt = to[e]
+                new_cost = cost + weight[e]
+                if new_cost < seconds[nxt]:
+                    seconds[nxt] = new_cost
+                    parent[nxt] = e
+                    previous[nxt] = state
+                    heapq.heappush(heap, (new_cost, nxt))
+
+        return np.array(seconds), np.array(parent, dtype=np.int64), np.array(previous, dtype=np.int64)
+
+    def best_stop_times(self, seconds):
+        """Per-stop arrival cost from search() states (vehicle or on foot)"""
+        return np.minimum(seconds[:self.n_stops], seconds[self.n_nodes:])
+
+    def plan(self, start_lat, start_lon, end_lat, end_lon, departure=None, modes=None,
+             max_walk_km=MAX_WALK_KM):
+        """
+        Fastest journey by scheduled run times and modelled waits
+
+        Returns journeys in the same format as RaptorRouter.plan (at most one).
+        """
+        departure = departure or datetime.now()
+        t0 = departure.hour * 3600 + departure.minute * 60 + departure.second
+        access_mode = 'METRO' if modes and 'BUS' not in modes else None
+
+        access, access_km = self.nearby_stops(start_lat, start_lon, max_walk_km, access_mode)
+        egress, egress_km = self.nearby_stops(end_lat, end_lon, max_walk_km, access_mode)
+        if len(access) == 0 or len(egress) == 0:
+            return []
+
+        walk = MODES['WALK']
+        if modes is None and self.hierarchy is not None:
+            return self._plan_on_hierarchy(access, access_km, egress, egress_km, start_lat, start_lon,
+                                           end_lat, end_lon, t0)
+
+        targets = dict(zip(egress.tolist(), walk.travel_seconds(egress_km).tolist()))
+        seconds, parent, previous = self.search(access, walk.travel_seconds(access_km), targets, modes)
+        return self._journeys(seconds, parent, previous, egress, egress_km, start_lat, start_lon,
+                              end_lat, end_lon, t0)
+
+    def plan_many(self, start_lat, start_lon, end_lat, end_lon, departure=None, modes=None,
+                  max_walk_km=MAX_WALK_KM, egress=None):
+        """
+        plan() from one origin to many destinations with a single search
+
+        egress optionally gives the destinations' already snapped stops as
+        (indices, distances_km) per destination, over all modes.
+        """
+        departure = departure or datetime.now()
+        t0 = departure.hour * 3600 + departure.minute * 60 + departure.second
+        access_mode = 'METRO' if modes and 'BUS' not in modes else None
+        if egress is None:
+            egress = points_within(end_lat, end_lon, self.stop_lat, self.stop_lon, max_walk_km)
+        if access_mode == 'METRO':
+            egress = [(stops[self.stop_is_metro[stops]], km[self.stop_is_metro[stops]]) for stops, km in egress]
+
+        access, access_km = self.nearby_stops(start_lat, start_lon, max_walk_km, access_mode)
+        if len(access) == 0:
+            return [[] for _ in egress]
+
+        seconds, parent, previous = self.search(access, MODES['WALK'].travel_seconds(access_km), modes=modes)
+        return [self._journeys(seconds, parent, previous, stops, km, start_lat, start_lon, lat, lon, t0)
+                if len(stops) else []
+                for (stops, km), lat, lon in zip(egress, end_lat, end_lon)]
+
+    def _journeys(self, seconds, parent, previous, egress, egress_km, start_lat, start_lon,
+                  end_lat, end_lon, t0):
+        """The best journey ending at one of the egress stops, from search() results"""
+        walk = MODES['WALK']
+
+        # Best egress over both ways of reaching each stop
+        candidates = np.concatenate([egress, self.n_nodes + egress])
+        totals = seconds[candidates] + np.tile(walk.travel_seconds(egress_km), 2)
+        i = int(np.argmin(totals))
+        if not np.isfinite(totals[i]):
+            return []
+        state = int(candidates[i])
+        stop = int(egress[i % len(egress)])
+        return self._journey(state, stop, float(egress_km[i % len(egress)]), float(totals[i]),
+                             seconds, parent, previous, start_lat, start_lon, end_lat, end_lon, t0)
+
+    def _plan_on_hierarchy(self, access, access_km, egress, egress_km, start_lat, start_lon,
+                           end_lat, end_lon, t0):
+        """plan() answered by the contraction hierarchy instead of search()"""
+        walk = MODES['WALK']
+        egress_seconds = walk.travel_seconds(egress_km).tolist()
+        targets = {}
+        for stop, cost in zip(egress.tolist(), egress_seconds):
+            targets[stop] = targets[self.n_nodes + stop] = cost
+        result, _ = self.hierarchy.query((self.n_nodes + access).tolist(),
+                                         walk.travel_seconds(access_km).tolist(), targets)
+        if result is None:
+            return []
+        total, state, source, path = result
+
+        # Parent pointers along the unpacked path, in search() terms: a
+        # vehicle change is boarding straight from the stop alighted at
+        seconds = {source: float(walk.travel_seconds(access_km[access == source - self.n_nodes][0]))}
+        parent = defaultdict(lambda: -1)
+        previous = {}
+        changed_at = {}
+        for e, a, b in path:
+            a = changed_at.get(a, a)
+            if e == CHANGE:
+                changed_at[b] = a
+                continue
+            seconds[b] = seconds[a] + int(self.edge_seconds[e])
+            parent[b] = e
+            previous[b] = a
+        state = changed_at.get(state, state)
+        stop = state - self.n_nodes if state >= self.n_nodes else state
+        walk_km = float(egress_km[egress == stop][0])
+        return self._journey(state, stop, walk_km, total, seconds, parent, previous,
+                             start_lat, start_lon, end_lat, end_lon, t0)
+
+    def _journey(self, state, stop, egress_km, total, seconds, parent, previous, start_lat, start_lon,
+                 end_lat, end_lon, t0):
+        """Journey ending with a walk from `stop`, whose search state is `state`"""
+        legs = self._reconstruct(state, seconds, parent, previous, t0, start_lat, start_lon)
+        if not any(leg['mode'] != 'WALK' for leg in legs):
+            return []
+        arrival = t0 + int(round(total))
+        legs.append(self._walk_leg(
+            (self.stop_lat[stop], self.stop_lon[stop], self.stop_names[stop]),
+            (end_lat, end_lon, 'Destination'),
+            egress_km, t0 + int(round(seconds[state])), arrival
+        ))
+        rides = sum(1 for leg in legs if leg['mode'] != 'WALK')
+        return [{
+            'departure': t0,
+            'arrival': arrival,
+            'transfers': rides - 1,
+            'legs': [leg for leg in legs if leg['mode'] != 'WALK' or leg['distance_km'] > 0],
+        }]
+
+    def _reconstruct(self, state, seconds, parent, previous, t0, start_lat, start_lon):
+        """Turn the parent edges of a search state into journey legs"""
+        edges = []
+        while parent[state] >= 0:
+            edges.append((int(parent[state]), int(previous[state]), state))
+            state = int(previous[state])
+        edges.reverse()
+        origin = state - self.n_nodes
+
+        legs = []
+        first_km = float(haversine_km(start_lat, start_lon, self.stop_lat[origin], self.stop_lon[origin]))
+        legs.append(self._walk_leg((start_lat, start_lon, 'Start'),
+                                   (self.stop_lat[origin], self.stop_lon[origin], self.stop_names[origin]),
+                                   first_km, t0, t0 + int(round(seconds[state]))))
+
+        ride = None
+        for e, source, reached in edges:
+            kind = self.edge_kind[e]
+            at = t0 + int(round(seconds[reached]))
+            source_stop = source - self.n_nodes if source >= self.n_nodes else source
+            if kind == BOARD:
+                node = int(self.edge_to[e]) - self.n_stops
+                mode = str(self.route_mode[self.node_route[node]])
+                departure = t0 + int(round(seconds[source])) + MODES[mode].wait_seconds
+                ride = {
+                    'mode': mode,
+                    'route_id': str(self.route_ids[self.node_route[node]]),
+                    'trip_id': None,
+                    'departure': departure,
+                    'distance_km': float(self.edge_km[e]),
+                    'stops': [self._stop_dict(source_stop, departure, departure),
+                              self._stop_dict(self.node_stop[node], at, at)],
+                }
+            elif kind == RIDE:
+                node = int(self.edge_to[e]) - self.n_stops
+                ride['distance_km'] += float(self.edge_km[e])
+                ride['stops'].append(self._stop_dict(self.node_stop[node], at, at))
+            elif kind == ALIGHT:
+                ride['arrival'] = ride['stops'][-1]['arrival']
+                legs.append(ride)
+                ride = None
+            else:
+                target = int(self.edge_to[e])
+                legs.append(self._walk_leg(
+                    (self.stop_lat[source_stop], self.stop_lon[source_stop], self.stop_names[source_stop]),
+                    (self.stop_lat[target], self.stop_lon[target], self.stop_names[target]),
+                    float(self.edge_km[e]), t0 + int(round(seconds[source])), at
+                ))
+        return legs
+
+    def _stop_dict(self, stop, arrival, departure):
+        return {
+            'id': str(self.stop_ids[stop]),
+            'name': str(self.stop_names[stop]),
+            'lat': float(self.stop_lat[stop]),
+            'lon': float(self.stop_lon[stop]),
+            'arrival': int(arrival),
+            'departure': int(departure),
+        }
+
+    def _walk_leg(self, origin, destination, distance_km, departure, arrival):
+        return {
+            'mode': 'WALK',
+            'from': {'lat': float(origin[0]), 'lon': float(origin[1]), 'name': str(origin[2])},
+            'to': {'lat': float(destination[0]), 'lon': float(destination[1]), 'name': str(destination[2])},
+            'distance_km': round(float(distance_km), 3),
+            'departure': int(departure),
+            'arrival': int(arrival),
+        }
+
+    def _adjacency_lists(self, modes):
+        """Python lists of the CSR arrays (fast scalar access) plus an edge filter"""
+        with self._lock:
+            if self._adjacency is None:
+                self._adjacency = (self.edge_ptr.tolist(), self.edge_to.tolist(),
+                                   self.edge_seconds.tolist(), self.edge_kind.tolist())
+            key = frozenset(modes) if modes else None
+            if key not in self._masks:
+                mask = np.isin(self.edge_mode, list(key)) if key else np.ones(self.n_edges, dtype=bool)
+                self._masks[key] = mask.tolist()
+            return (*self._adjacency, self._masks[key])
+
+
+def load_network(transit_db, conn, version):
+    """Build the network from the artifacts stored next to transit.db"""
+    from .raptor import Timetable, timetable_path
+    from .service_calendar import load_service_calendar
+
+    path = timetable_path(transit_db.db_path)
+    if not path.exists():
+        return None
+    timetable = Timetable.load(path)
+    if version and timetable.db_version != version:
+        print(f"⚠ {path.name} does not match transit.db version {version}, ignoring")
+        return None
+    calendar = load_service_calendar(transit_db, conn, version)
+    transfers = load_transfers(transit_db, version, timetable.n_stops)
+
+    network = TransitNetwork(timetable, transfers, calendar)
+    network.hierarchy = load_hierarchy(transit_db, version, network.n_nodes + network.n_stops)
+    # Build today's timetable view now rather than on the first request
+    network.router.day_view(date.today())
+    print(f"✓ Loaded network: {network.n_stops:,} stops "
+          f"({int(network.stop_is_metro.sum()):,} metro), {timetable.n_patterns:,} route patterns, "
+          f"{network.count_edges(RIDE):,} ride links, {network.count_edges(WALK):,} walking transfers"
+          f"{', contraction hierarchy' if network.hierarchy is not None else ''}")
+    return network
+
+# Singleton instance
+_network = None
+_network_lock = threading.Lock()
+
+def get_network():
+    """Get the network for the live transit.db (None until static data is loaded)"""
+    global _network
+    from .transit_db import get_transit_db, DerivedCache
+
+    with _network_lock:
+        if _network is None:
+            _network = DerivedCache(get_transit_db(), load_network)
+    return _network.current
@@ -0,0 +1,61 @@
+"""
+Choosing route options from a Pareto frontier
+
+Route options are compared on four criteria: duration, fare, transfers
+and walking distance. Options beaten on all four by another are dropped;
+a preference only orders what is left, so switching between fastest,
+cheapest and balanced never needs a new search.
+"""
+
+RUPEES_PER_MINUTE = 2.0     # Balanced: value of travel time
+TRANSFER_MINUTES = 5.0      # Balanced: penalty per change of vehicle
+WALK_MINUTES_PER_KM = 5.0   # Balanced: penalty on top of the walking time itself
+MAX_OPTIONS = 5
+
+
+def route_criteria(route):
+    """(duration min, fare, transfers, walking km) of a route option"""
+    segments = route.get('segments', [])
+    transfers = route.get('routeDetails', {}).get('transfers')
+    if transfers is None:
+        transfers = max(0, sum(1 for segment in segments if segment.get('mode') != 'WALK') - 1)
+    walk_km = sum(segment.get('distance') or 0 for segment in segments if segment.get('mode') == 'WALK')
+    return route['totalDuration'], route['totalCost'], transfers, round(walk_km, 2)
+
+
+def _balanced_minutes(criteria):
+    duration, cost, transfers, walk_km = criteria
+    return (duration + cost / RUPEES_PER_MINUTE + transfers * TRANSFER_MINUTES
+            + walk_km * WALK_MINUTES_PER_KM)
+
+
+PREFERENCES = {
+    'fastest': lambda c: (c[0], c[2], c[1], c[3]),
+    'cheapest': lambda c: (c[1], c[0], c[2], c[3]),
+    'balanced': lambda c: (_balanced_minutes(c), c[0]),
+}
+
+
+def pareto_front(routes):
+    """Routes not dominated on all criteria (the first of equal ones is kept)"""
+    criteria = [route_criteria(route) for route in routes]
+    front = []
+    for i, (route, mine) in enumerate(zip(routes, criteria)):
+        dominated = False
+        for j, other in enumerate(criteria):
+            if j == i or not all(o <= m for o, m in zip(other, mine)):
+                continue
+            if other != mine or j < i:
+                dominated = True
+                break
+        if not dominated:
+            front.append((mine, route))
+    return front
+
+
+def select_routes(routes, preference='fastest', limit=MAX_OPTIONS):
+    """The frontier's best `limit` options for a preference"""
+    key = PREFERENCES.get(preference, PREFERENCES['fastest'])
+    front = pareto_front(routes)
+    front.sort(key=lambda entry: key(entry[0]))
+    return [route for _, route in front[:limit]]
@@ -0,0 +1,177 @@
+"""
+Result cache for plan_route()
+
+Popular origins and destinations are requested again and again within the
+same minute. Keys are built from the origin and destination snapped to a
+~100 m grid and a departure time bucket, so nearby requests for the same
+trip share one plan. The cached value is the whole set of route options,
+before a preference picks from it, so all preferences share an entry.
+
+Plans that use any bus leg carry live information and are tied to the
+realtime snapshot they were planned on: a new snapshot drops them. Plans
+made only of metro (and walking) legs without clock times depend on the
+static network alone, so they live in a coarser time bucket and survive
+snapshot changes. Timetable plans show departure times, so they stay in
+the short bucket and also end at `valid_until`, when the first vehicle of
+their earliest option can no longer be caught. Everything is dropped when
+the static data version changes. The cache is an LRU bounded by entry count.
+
+Walking legs start and end at the exact coordinates of the request that
+was planned; a hit moves those endpoints to the current request's.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+CELL_DEG = 0.001            # ~110 m grid for snapping origin/destination
+LIVE_BUCKET_SECONDS = 60
+METRO_BUCKET_SECONDS = 600
+MAX_ENTRIES = 4096
+
+LIVE, METRO = 'live', 'metro'
+
+
+def snap(lat, lon):
+    """Grid cell of a point"""
+    return (round(lat / CELL_DEG), round(lon / CELL_DEG))
+
+
+def plan_kind(result):
+    """METRO if every option only uses metro and walking and shows no clock times, else LIVE"""
+    routes = result.get('routes') or []
+    if routes and all(segment.get('mode') in ('METRO', 'WALK')
+                      for route in routes for segment in route.get('segments', [])):
+        if not any('departure_time' in route.get('routeDetails', {}) for route in routes):
+            return METRO
+    return LIVE
+
+
+def _reanchor(result, planned_from, planned_to, start, end):
+    """The result with its walking legs' endpoints moved from the planned request's to this one's"""
+    if (planned_from, planned_to) == (start, end):
+        return result
+
+    def moved(point, planned, current):
+        if (point.get('lat'), point.get('lng')) == planned:
+            return {**point, 'lat': current[0], 'lng': current[1]}
+        return point
+
+    routes = []
+    for route in result.get('routes') or []:
+        segments = route.get('segments') or []
+        if not any(segment.get('mode') == 'WALK' and segment.get('path') for segment in segments):
+            routes.append(route)
+            continue
+        anchored = []
+        for segment in segments:
+            path = segment.get('path')
+            if segment.get('mode') == 'WALK' and path:
+                path = list(path)
+                path[0] = moved(path[0], planned_from, start)
+                path[-1] = moved(path[-1], planned_to, end)
+                segment = {**segment, 'path': path}
+            anchored.append(segment)
+        routes.append({**route, 'segments': anchored})
+    return {**result, 'routes': routes}
+
+
+class PlanCache:
+    """LRU of plan_route() results with version/snapshot invalidation"""
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()   # key -> (kind, snapshot, result, valid_until, start, end)
+        self._lock = threading.Lock()
+        self._static_version = None
+        self._snapshot = None
+        self.hits = {LIVE: 0, METRO: 0}
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _keys(self, start_lat, start_lon, end_lat, end_lon, now):
+        od = (snap(start_lat, start_lon), snap(end_lat, end_lon))
+        return {
+            LIVE: (LIVE, *od, int(now // LIVE_BUCKET_SECONDS)),
+            METRO: (METRO, *od, int(now // METRO_BUCKET_SECONDS)),
+        }
+
+    def _sync(self, static_version, snapshot):
+        """Drop what a new static version or realtime snapshot made stale"""
+        if static_version != self._static_version:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._static_version = static_version
+        if snapshot != self._snapshot:
+            stale = [key for key, entry in self._entries.items() if entry[0] == LIVE]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+            self._snapshot = snapshot
+
+    def get(self, start_lat, start_lon, end_lat, end_lon, static_version, snapshot, now=None):
+        """Cached result (a shallow copy, walks anchored to this request) or None"""
+        now = now or time.time()
+        keys = self._keys(start_lat, start_lon, end_lat, end_lon, now)
+        with self._lock:
+            self._sync(static_version, snapshot)
+            for kind in (LIVE, METRO):
+                entry = self._entries.get(keys[kind])
+                if entry is None:
+                    continue
+                if entry[3] is not None and now >= entry[3]:
+                    # Its earliest option's first vehicle has left
+                    del self._entries[keys[kind]]
+                    self.invalidations += 1
+                    continue
+                self._entries.move_to_end(keys[kind])
+                self.hits[kind] += 1
+                break
+            else:
+                self.misses += 1
+                return None
+        return _reanchor(dict(entry[2]), entry[4], entry[5], (start_lat, start_lon), (end_lat, end_lon))
+
+    def put(self, start_lat, start_lon, end_lat, end_lon, static_version, snapshot, result,
+            now=None, valid_until=None):
+        """
+        Store a result under the bucket its kind allows
+
+        valid_until (epoch seconds) ends the entry early, e.g. when the
+        result's first scheduled departure has passed.
+        """
+        if 'error' in result:
+            return
+        kind = plan_kind(result)
+        key = self._keys(start_lat, start_lon, end_lat, end_lon, now or time.time())[kind]
+        with self._lock:
+            self._sync(static_version, snapshot)
+            self._entries[key] = (kind, snapshot, dict(result), valid_until,
+                                  (start_lat, start_lon), (end_lat, end_lon))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def stats(self):
+        """Hit/miss counters for monitoring"""
+        with self._lock:
+            hits = sum(self.hits.values())
+            lookups = hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': hits,
+                'live_hits': self.hits[LIVE],
+                'metro_hits': self.hits[METRO],
+                'misses': self.misses,
+                'hit_rate': round(hits / lookups, 3) if lookups else None,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
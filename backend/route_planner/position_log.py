@@ -0,0 +1,203 @@
+"""
+Append-only on-disk log of live vehicle positions
+
+Every feed refresh appends its reports as fixed-width binary records
+(feed timestamp, vehicle, route, lat, lon) to hourly partition files,
+`positions/<YYYYMMDDHH>.bin` next to transit.db, split by each report's own
+timestamp (UTC hour). Vehicle and route IDs are stored as indices into two
+append-only dictionaries (vehicles.txt, routes.txt).
+
+Each partition has a `.idx` sidecar with one (min timestamp, max
+timestamp, first record, record count) entry per appended batch, so a time
+range read only touches the batches that overlap it. Records are read with
+np.fromfile; vehicle filters are one vectorized membership test.
+
+Partitions older than the retention window (POSITION_LOG_RETENTION_HOURS,
+48 by default) are deleted as new hours start.
+On start-up the predictor warm-starts from the last few minutes of the log.
+"""
+
+import os
+import threading
+import time
+import numpy as np
+from pathlib import Path
+from .transit_db import get_transit_db
+
+RECORD = np.dtype([
+    ('timestamp', '<i8'),
+    ('vehicle', '<u4'),
+    ('route', '<u4'),
+    ('lat', '<f4'),
+    ('lon', '<f4'),
+])
+INDEX = np.dtype([
+    ('min_ts', '<i8'),
+    ('max_ts', '<i8'),
+    ('start', '<i8'),
+    ('count', '<i8'),
+])
+RETENTION_HOURS = int(os.environ.get('POSITION_LOG_RETENTION_HOURS', 48))
+WARM_START_MINUTES = 15
+
+
+def log_dir():
+    """Location of the position log alongside the database"""
+    return Path(get_transit_db().db_path).with_name('positions')
+
+
+class _Dictionary:
+    """Append-only string <-> index table backed by a text file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.names = []
+        if path.exists():
+            self.names = path.read_text(encoding='utf-8').split('\n')[:-1]
+        self.index = {name: i for i, name in enumerate(self.names)}
+
+    def encode(self, names):
+        new = []
+        codes = np.empty(len(names), dtype=np.uint32)
+        for i, name in enumerate(names):
+            code = self.index.get(name)
+            if code is None:
+                code = self.index[name] = len(self.names)
+                self.names.append(name)
+                new.append(name)
+            codes[i] = code
+        if new:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(''.join(f"{name}\n" for name in new))
+        return codes
+
+    def decode(self, codes):
+        names = np.array(self.names + [''], dtype=object)
+        return names[np.minimum(codes, len(self.names))]
+
+
+class PositionLog:
+    """Hourly partitioned binary log of (timestamp, vehicle, route, lat, lon)"""
+
+    def __init__(self, directory, retention_hours=RETENTION_HOURS):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.retention_hours = retention_hours
+        self._lock = threading.Lock()
+        self.vehicles = _Dictionary(self.directory / 'vehicles.txt')
+        self.routes = _Dictionary(self.directory / 'routes.txt')
+        self._pruned_hour = None
+
+    def _partition(self, hour):
+        return self.directory / time.strftime('%Y%m%d%H.bin', time.gmtime(hour * 3600))
+
+    def append(self, vehicle_ids, route_ids, lat, lon, timestamps):
+        """Append one feed's reports; returns the number of records written"""
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        if len(timestamps) == 0:
+            return 0
+
+        with self._lock:
+            records = np.empty(len(timestamps), dtype=RECORD)
+            records['timestamp'] = timestamps
+            records['vehicle'] = self.vehicles.encode([str(v) for v in vehicle_ids])
+            records['route'] = self.routes.encode([str(r or '') for r in route_ids])
+            records['lat'] = lat
+            records['lon'] = lon
+            records = records[np.argsort(timestamps, kind='stable')]
+
+            hours = records['timestamp'] // 3600
+            bounds = np.flatnonzero(np.diff(hours)) + 1
+            for batch in np.split(records, bounds):
+                path = self._partition(int(batch['timestamp'][0] // 3600))
+                # Data first, then the index entry that makes it visible
+                with open(path, 'ab') as f:
+                    start = f.tell() // RECORD.itemsize
+                    f.write(batch.tobytes())
+                entry = np.array([(batch['timestamp'][0], batch['timestamp'][-1], start, len(batch))],
+                                 dtype=INDEX)
+                with open(path.with_suffix('.idx'), 'ab') as f:
+                    f.write(entry.tobytes())
+
+            self._prune(int(time.time() // 3600))
+        return len(records)
+
+    def _prune(self, hour):
+        """Delete partitions older than the retention window, once per hour"""
+        if hour == self._pruned_hour:
+            return
+        self._pruned_hour = hour
+        oldest = self._partition(hour - self.retention_hours).name
+        for path in self.directory.glob('*.bin'):
+            if path.name < oldest:
+                path.unlink(missing_ok=True)
+                path.with_suffix('.idx').unlink(missing_ok=True)
+
+    def read(self, start, end, vehicle_ids=None):
+        """
+        Records with start <= timestamp < end, optionally of some vehicles only
+
+        Returns a dict of arrays (timestamp, vehicle_id, route_id, lat, lon)
+        sorted by timestamp.
+        """
+        chunks = []
+        for hour in range(int(start // 3600), int((end - 1) // 3600) + 1):
+            path = self._partition(hour)
+            if path.exists():
+                chunks.extend(self._read_partition(path, start, end))
+        records = np.concatenate(chunks) if chunks else np.empty(0, dtype=RECORD)
+
+        if vehicle_ids is not None:
+            wanted = [self.vehicles.index[v] for v in map(str, vehicle_ids) if v in self.vehicles.index]
+            records = records[np.isin(records['vehicle'], wanted)]
+        records = records[np.argsort(records['timestamp'], kind='stable')]
+
+        return {
+            'timestamp': records['timestamp'],
+            'vehicle_id': self.vehicles.decode(records['vehicle']),
+            'route_id': self.routes.decode(records['route']),
+            'lat': records['lat'].astype(np.float64),
+            'lon': records['lon'].astype(np.float64),
+        }
+
+    def _read_partition(self, path, start, end):
+        index_path = path.with_suffix('.idx')
+        if not index_path.exists():
+            return []
+        index = np.fromfile(index_path, dtype=INDEX)
+        n_records = path.stat().st_size // RECORD.itemsize
+        # Only batches overlapping the range, and fully written
+        hit = index[(index['max_ts'] >= start) & (index['min_ts'] < end)
+                    & (index['start'] + index['count'] <= n_records)]
+        chunks = []
+        with open(path, 'rb') as f:
+            for entry in hit:
+                f.seek(int(entry['start']) * RECORD.itemsize)
+                batch = np.fromfile(f, dtype=RECORD, count=int(entry['count']))
+                chunks.append(batch[(batch['timestamp'] >= start) & (batch['timestamp'] < end)])
+        return chunks
+
+    def read_recent(self, minutes=WARM_START_MINUTES, vehicle_ids=None):
+        """Records of the last `minutes` minutes"""
+        now = int(time.time())
+        return self.read(now - minutes * 60, now + 1, vehicle_ids)
+
+    def stats(self):
+        partitions = sorted(self.directory.glob('*.bin'))
+        return {
+            'partitions': len(partitions),
+            'records': sum(p.stat().st_size for p in partitions) // RECORD.itemsize,
+            'vehicles': len(self.vehicles.names),
+            'retention_hours': self.retention_hours,
+        }
+
+
+# Singleton instance
+_position_log = None
+
+def get_position_log():
+    """Get or create the position log next to the database"""
+    global _position_log
+    if _position_log is None:
+        _position_log = PositionLog(log_dir())
+    return _position_log
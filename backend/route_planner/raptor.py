@@ -0,0 +1,970 @@
+"""
+Round-based public transit routing (RAPTOR) over the static bus + metro GTFS
+
+Trips are grouped into route patterns (same route, same stop sequence, no
+overtaking). Each pattern's timetable is stored column-major in flat
+arrays, so one column holds the departures of all its trips at one stop,
+sorted. Every RAPTOR round then runs as a handful of array operations over
+all queued (pattern, stop) positions at once:
+
+- one searchsorted finds the earliest catchable trip at every position,
+- a segmented running minimum carries the boarded trip along each pattern,
+- a gather reads the arrival times and the improving stops are written back.
+
+Round k finds the best journeys with k vehicles (k - 1 transfers).
+
+Times past 24:00:00 belong to the previous service day, so every search
+scans two views of the timetable: the trips running on the travel date,
+and the previous day's trips still running after midnight with their
+times shifted back by a day.
+
+plan_pareto() runs the multi-criteria variant of the same rounds (McRAPTOR)
+for journeys trading arrival time against fare, transfers and walking.
+"""
+
+import os
+import threading
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta
+from pathlib import Path
+from .geo import haversine_km, points_within
+from .gtfs_loader import METRO_ID_PREFIX
+from .network import MODES
+from .transfers import WALK_SPEED_KMH
+from .shared_snapshot import load_npz
+
+INF = 1 << 40               # "not reached" arrival time
+TIME_KEY = 1 << 20          # > 48 h in seconds: separates columns in search keys
+MIN_CHANGE_SECONDS = 60     # Time to change vehicles at the same stop
+MAX_WALK_KM = 1.5           # Access/egress radius around origin and destination
+DAY_CACHE_SIZE = 4          # Two views (the day and the previous night) per date
+DAY_SECONDS = 86400
+PARETO_SLACK = 1.5          # Multi-criteria horizon: this times the fastest trip...
+PARETO_SLACK_SECONDS = 900  # ...plus this
+FARE_STEP = 10              # Fare resolution (rupees) of multi-criteria labels
+WALK_UNIT_M = 250           # Walking distance resolution of multi-criteria labels
+
+# Parent pointer kinds
+_INHERITED, _ACCESS, _TRIP, _WALK = 0, 1, 2, 3
+
+
+def timetable_path(db_path):
+    """Location of the pattern timetable stored alongside a database"""
+    db_path = Path(db_path)
+    return db_path.with_name(f"{db_path.stem}.timetable.npz")
+
+
+def parse_gtfs_times(values):
+    """Vectorized HH:MM:SS -> seconds after midnight (hours may exceed 24)"""
+    parts = pd.Series(values, dtype=object).str.strip().str.split(':', expand=True)
+    if parts.shape[1] < 3:
+        return np.full(len(values), np.nan)
+    parts = parts.iloc[:, :3].apply(pd.to_numeric, errors='coerce')
+    return (parts[0] * 3600 + parts[1] * 60 + parts[2]).to_numpy(dtype=np.float64)
+
+
+def format_seconds(seconds):
+    """Seconds after midnight -> HH:MM (24h, wrapping past midnight)"""
+    seconds = int(seconds)
+    return f"{seconds // 3600 % 24:02d}:{seconds % 3600 // 60:02d}"
+
+
+def _dominated(bag, key):
+    """True if some label in the bag is no worse on all of a key's criteria"""
+    arrival, fare, walk = key[0], key[1], key[2]
+    for other in bag:
+        other = other[0]
+        if other[0] <= arrival and other[1] <= fare and other[2] <= walk:
+            return True
+    return False
+
+
+def _pareto_insert(bag, label):
+    """Add a multi-criteria label unless dominated, dropping the labels it dominates"""
+    key = label[0]
+    if _dominated(bag, key):
+        return False
+    arrival, fare, walk = key
+    bag[:] = [other for other in bag
+              if not (arrival <= other[0][0] and fare <= other[0][1] and walk <= other[0][2])]
+    bag.append(label)
+    return True
+
+
+def _mc_label(arrival, fare, walk, stop, parent):
+    """
+    Multi-criteria label: (key, stop, parent, arrival, fare, walk)
+
+    Labels are compared on the key, which rounds fare to FARE_STEP so
+    near-identical alternatives do not flood the bags.
+    """
+    return (arrival, fare // FARE_STEP, walk), stop, parent, arrival, fare, walk
+
+
+def _walk_units(distance_km):
+    return int(round(distance_km * 1000 / WALK_UNIT_M))
+
+
+def _csr_gather(ptr, rows):
+    """Flat indices of all entries of the given CSR rows"""
+    starts = ptr[rows]
+    lengths = ptr[rows + 1] - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return np.empty(0, dtype=np.int64), lengths
+    offsets = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.repeat(starts, lengths) + offsets, lengths
+
+
+class Timetable:
+    """Array-backed route patterns built from transit.db"""
+
+    ARRAYS = [
+        'stop_ids', 'stop_names', 'stop_lat', 'stop_lon',
+        'route_ids', 'trip_ids',
+        'pattern_route', 'pattern_stop_ptr', 'pattern_stops',
+        'pattern_trip_ptr', 'pattern_trips', 'pattern_time_ptr',
+        'dep_times', 'arr_times',
+        'stop_pattern_ptr', 'stop_patterns', 'stop_positions',
+    ]
+
+    def __init__(self, db_version=None, **arrays):
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+        self.db_version = db_version
+        self.n_stops = len(self.stop_ids)
+        self.n_patterns = len(self.pattern_route)
+        self.pattern_n_stops = np.diff(self.pattern_stop_ptr)
+        self.pattern_n_trips = np.diff(self.pattern_trip_ptr)
+        self.stop_is_metro = np.char.startswith(self.stop_ids.astype(str), METRO_ID_PREFIX)
+        self.route_is_metro = np.char.startswith(self.route_ids.astype(str), METRO_ID_PREFIX)
+        self._stop_index = None
+        self._pattern_km = None
+
+    @classmethod
+    def build(cls, conn, db_version=None):
+        """Group trips into FIFO route patterns and lay out their timetables"""
+        stops = pd.read_sql_query(
+            "SELECT stop_id, stop_name, stop_lat, stop_lon FROM stops", conn
+        )
+        stops['stop_id'] = stops['stop_id'].astype(str)
+        stops = stops.drop_duplicates('stop_id').reset_index(drop=True)
+        stop_index = pd.Series(np.arange(len(stops)), index=stops['stop_id'])
+
+        trips = pd.read_sql_query("SELECT trip_id, route_id FROM trips ORDER BY rowid", conn)
+        trip_ids = trips['trip_id'].astype(str).to_numpy()
+        route_codes, route_ids = pd.factorize(trips['route_id'].astype(str))
+        trip_index = pd.Series(np.arange(len(trips)), index=trip_ids)
+        trip_index = trip_index[~trip_index.index.duplicated()]
+
+        st = pd.read_sql_query(
+            "SELECT trip_id, stop_id, arrival_time, departure_time, stop_sequence FROM stop_times", conn
+        )
+        st['trip'] = trip_index.reindex(st['trip_id'].astype(str)).to_numpy()
+        st['stop'] = stop_index.reindex(st['stop_id'].astype(str)).to_numpy()
+        arr = parse_gtfs_times(st['arrival_time'])
+        dep = parse_gtfs_times(st['departure_time'])
+        st['arr'] = np.where(np.isnan(arr), dep, arr)
+        st['dep'] = np.where(np.isnan(dep), arr, dep)
+        st = st.dropna(subset=['trip', 'stop'])
+
+        # Trips with untimed stops are skipped rather than guessed
+        untimed = st.loc[st['arr'].isna(), 'trip'].unique()
+        if len(untimed):
+            print(f"  ⚠ Skipping {len(untimed):,} trips with untimed stops")
+            st = st[~st['trip'].isin(untimed)]
+
+        st = st.sort_values(['trip', 'stop_sequence'], kind='stable')
+        trip_col = st['trip'].to_numpy(dtype=np.int64)
+        stop_col = st['stop'].to_numpy(dtype=np.int32)
+        arr_col = st['arr'].to_numpy(dtype=np.int32)
+        dep_col = st['dep'].to_numpy(dtype=np.int32)
+
+        bounds = np.flatnonzero(np.diff(trip_col)) + 1
+        starts = np.concatenate([[0], bounds])
+        ends = np.concatenate([bounds, [len(trip_col)]])
+
+        # Group by (route, stop sequence), then split so trips never overtake
+        groups = {}
+        for a, b in zip(starts, ends):
+            if b - a < 2:
+                continue
+            trip = trip_col[a]
+            key = (route_codes[trip], stop_col[a:b].tobytes())
+            groups.setdefault(key, []).append((dep_col[a], trip, a, b))
+
+        patterns = []
+        for (route, _), members in groups.items():
+            members.sort()
+            sub_patterns = []
+            for _, trip, a, b in members:
+                for sub in sub_patterns:
+                    last_a, last_b = sub[-1][1], sub[-1][2]
+                    if (np.all(dep_col[a:b] >= dep_col[last_a:last_b])
+                            and np.all(arr_col[a:b] >= arr_col[last_a:last_b])):
+                        sub.append((trip, a, b))
+                        break
+                else:
+                    sub_patterns.append([(trip, a, b)])
+            for sub in sub_patterns:
+                patterns.append((route, sub))
+
+        pattern_route = np.array([route for route, _ in patterns], dtype=np.int32)
+        n_stops = np.array([sub[0][2] - sub[0][1] for _, sub in patterns], dtype=np.int64)
+        n_trips = np.array([len(sub) for _, sub in patterns], dtype=np.int64)
+
+        pattern_stop_ptr = np.concatenate([[0], np.cumsum(n_stops)])
+        pattern_trip_ptr = np.concatenate([[0], np.cumsum(n_trips)])
+        pattern_time_ptr = np.concatenate([[0], np.cumsum(n_stops * n_trips)])
+
+        pattern_stops = np.empty(pattern_stop_ptr[-1], dtype=np.int32)
+        pattern_trips = np.empty(pattern_trip_ptr[-1], dtype=np.int32)
+        dep_times = np.empty(pattern_time_ptr[-1], dtype=np.int32)
+        arr_times = np.empty(pattern_time_ptr[-1], dtype=np.int32)
+
+        for p, (_, sub) in enumerate(patterns):
+            rows = np.array([np.arange(a, b) for _, a, b in sub])     # trips x stops
+            pattern_stops[pattern_stop_ptr[p]:pattern_stop_ptr[p + 1]] = stop_col[rows[0]]
+            pattern_trips[pattern_trip_ptr[p]:pattern_trip_ptr[p + 1]] = [trip for trip, _, _ in sub]
+            # Column-major: all trips' times at stop 0, then at stop 1, ...
+            dep_times[pattern_time_ptr[p]:pattern_time_ptr[p + 1]] = dep_col[rows.T].ravel()
+            arr_times[pattern_time_ptr[p]:pattern_time_ptr[p + 1]] = arr_col[rows.T].ravel()
+
+        # Stop -> (pattern, position) lookup
+        entry_pattern = np.repeat(np.arange(len(patterns), dtype=np.int32), n_stops)
+        entry_position = (np.arange(len(pattern_stops))
+                          - np.repeat(pattern_stop_ptr[:-1], n_stops)).astype(np.int32)
+        order = np.argsort(pattern_stops, kind='stable')
+        stop_pattern_ptr = np.concatenate([[0], np.cumsum(np.bincount(pattern_stops, minlength=len(stops)))])
+
+        return cls(
+            db_version=db_version,
+            stop_ids=stops['stop_id'].to_numpy(dtype=str),
+            stop_names=stops['stop_name'].fillna('').astype(str).to_numpy(dtype=str),
+            stop_lat=stops['stop_lat'].to_numpy(dtype=np.float64),
+            stop_lon=stops['stop_lon'].to_numpy(dtype=np.float64),
+            route_ids=np.asarray(route_ids, dtype=str),
+            trip_ids=trip_ids.astype(str),
+            pattern_route=pattern_route,
+            pattern_stop_ptr=pattern_stop_ptr,
+            pattern_stops=pattern_stops,
+            pattern_trip_ptr=pattern_trip_ptr,
+            pattern_trips=pattern_trips,
+            pattern_time_ptr=pattern_time_ptr,
+            dep_times=dep_times,
+            arr_times=arr_times,
+            stop_pattern_ptr=stop_pattern_ptr,
+            stop_patterns=entry_pattern[order],
+            stop_positions=entry_position[order],
+        )
+
+    def save(self, path):
+        """Write atomically (temp file + rename)"""
+        path = Path(path)
+        tmp_path = path.with_name(f"{path.name}.tmp-{os.getpid()}")
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, db_version=np.array(self.db_version or ''),
+                     **{name: getattr(self, name) for name in self.ARRAYS})
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with load_npz(path) as data:
+            arrays = {name: data[name] for name in cls.ARRAYS}
+            return cls(db_version=str(data['db_version']) or None, **arrays)
+
+    def stop_index(self, stop_id):
+        if self._stop_index is None:
+            self._stop_index = {sid: i for i, sid in enumerate(self.stop_ids.tolist())}
+        return self._stop_index.get(str(stop_id))
+
+    def pattern_km(self):
+        """Straight-line distance along each pattern from its first stop, per pattern stop"""
+        if self._pattern_km is None:
+            lat, lon = self.stop_lat[self.pattern_stops], self.stop_lon[self.pattern_stops]
+            step = np.zeros(len(lat))
+            step[1:] = haversine_km(lat[:-1], lon[:-1], lat[1:], lon[1:])
+            starts = self.pattern_stop_ptr[:-1]
+            step[starts[starts < len(step)]] = 0
+            total = np.cumsum(step)
+            self._pattern_km = total - np.repeat(total[starts], self.pattern_n_stops)
+        return self._pattern_km
+
+    def nearby_stops(self, lat, lon, max_km):
+        """Stops within max_km of a point, as (indices, distances_km)"""
+        distances = haversine_km(lat, lon, self.stop_lat, self.stop_lon)
+        idx = np.flatnonzero(distances <= max_km)
+        return idx, distances[idx]
+
+
+class _DayView:
+    """
+    The timetable restricted to the trips running on one service day
+
+    With shift=DAY_SECONDS it holds only the trips still running after the
+    day's midnight, timed from the next midnight (negative before it).
+    """
+
+    def __init__(self, tt, active_trips, shift=0):
+        keep_slot = active_trips[tt.pattern_trips]
+        slot_pattern = np.repeat(np.arange(tt.n_patterns), tt.pattern_n_trips)
+        if shift:
+            # Arrival of each trip at its pattern's last stop
+            within = np.arange(len(slot_pattern)) - tt.pattern_trip_ptr[slot_pattern]
+            last = (tt.pattern_time_ptr[slot_pattern]
+                    + (tt.pattern_n_stops[slot_pattern] - 1) * tt.pattern_n_trips[slot_pattern] + within)
+            keep_slot = keep_slot & (tt.arr_times[last] > shift)
+
+        # Expand the per-trip mask to the column-major time entries
+        n_entries = tt.pattern_n_stops * tt.pattern_n_trips
+        entry_pattern = np.repeat(np.arange(tt.n_patterns), n_entries)
+        within = np.arange(len(tt.dep_times)) - tt.pattern_time_ptr[entry_pattern]
+        keep_entry = keep_slot[tt.pattern_trip_ptr[entry_pattern] + within % tt.pattern_n_trips[entry_pattern]]
+
+        self.dep = tt.dep_times[keep_entry].astype(np.int64) - shift
+        self.arr = tt.arr_times[keep_entry].astype(np.int64) - shift
+
+        self.n_trips = np.bincount(slot_pattern, weights=keep_slot, minlength=tt.n_patterns).astype(np.int64)
+        self.trips = tt.pattern_trips[keep_slot]
+        self.trip_ptr = np.concatenate([[0], np.cumsum(self.n_trips)])
+
+        # Column c = pattern_stop_ptr[p] + position; each holds n_trips[p] sorted times
+        col_pattern = np.repeat(np.arange(tt.n_patterns), tt.pattern_n_stops)
+        col_len = self.n_trips[col_pattern]
+        self.col_start = np.concatenate([[0], np.cumsum(col_len)[:-1]])
+        # Shifted times stay above -TIME_KEY / 2, so columns never overlap
+        self.keys = np.repeat(np.arange(len(col_len), dtype=np.int64), col_len) * TIME_KEY + self.dep
+
+
+class _Labels:
+    """Per-round arrival labels and parent pointers of one search"""
+
+    def __init__(self, rounds, n_stops):
+        shape = (rounds + 1, n_stops)
+        self.rounds = rounds
+        self.completed = 0          # Rounds that improved some stop
+        self.tau = np.full(shape, INF, dtype=np.int64)
+        self.best = np.full(n_stops, INF, dtype=np.int64)
+        # Vehicle arrivals are labelled separately: the walking table is not
+        # transitively closed, so a stop reached earlier on foot must not hide
+        # a later vehicle arrival that can still walk on to somewhere else
+        self.ride = np.full(shape, INF, dtype=np.int64)
+        self.best_ride = np.full(n_stops, INF, dtype=np.int64)
+        self.kind = np.zeros(shape, dtype=np.int8)
+        self.par_pattern = np.zeros(shape, dtype=np.int32)
+        self.par_trip = np.zeros(shape, dtype=np.int32)
+        self.par_board = np.zeros(shape, dtype=np.int32)
+        self.par_alight = np.zeros(shape, dtype=np.int32)
+        self.par_from = np.zeros(shape, dtype=np.int32)
+        self.par_day = np.zeros(shape, dtype=np.int8)     # Index of the day view ridden
+
+
+class RaptorRouter:
+    """Earliest-arrival journeys with up to N transfers"""
+
+    def __init__(self, timetable, calendar=None, transfers=None):
+        self.tt = timetable
+        self.calendar = calendar
+        self.transfers = transfers      # TransferTable over the same stops, optional
+        self._days = {}
+        self._days_lock = threading.Lock()
+        self._pattern_km = None
+
+    def day_view(self, day, overnight=False):
+        """
+        Cached timetable of trips active on a date
+
+        With overnight, only that date's trips still running after midnight,
+        timed from the next day's midnight.
+        """
+        with self._days_lock:
+            view = self._days.get((day, overnight))
+            if view is None:
+                if self.calendar is not None and self.calendar.day_index(day) is not None:
+                    active = self.calendar.active_trips(day)
+                else:
+                    active = np.ones(len(self.tt.trip_ids), dtype=bool)
+                view = _DayView(self.tt, active, DAY_SECONDS if overnight else 0)
+                if len(self._days) >= DAY_CACHE_SIZE:
+                    self._days.pop(next(iter(self._days)))
+                self._days[(day, overnight)] = view
+            return view
+
+    def service_days(self, day):
+        """Views to search for a departure on a date: its trips, then last night's"""
+        days = [self.day_view(day)]
+        overnight = self.day_view(day - timedelta(days=1), overnight=True)
+        if len(overnight.trips):
+            days.append(overnight)
+        return days
+
+    def plan(self, start_lat, start_lon, end_lat, end_lon, departure=None,
+             max_transfers=3, max_walk_km=MAX_WALK_KM):
+        """
+        Plan journeys departing at `departure` (default: now)
+
+        Returns a list of journeys, one per number of vehicles that improves
+        the arrival time, each with its legs in travel order.
+        """
+        tt = self.tt
+        departure = departure or datetime.now()
+        days = self.service_days(departure.date())
+        t0 = departure.hour * 3600 + departure.minute * 60 + departure.second
+
+        access, access_km = tt.nearby_stops(start_lat, start_lon, max_walk_km)
+        egress, egress_km = tt.nearby_stops(end_lat, end_lon, max_walk_km)
+        if len(access) == 0 or len(egress) == 0:
+            return []
+
+        access_time = t0 + (access_km / WALK_SPEED_KMH * 3600).astype(np.int64)
+        egress_seconds = (egress_km / WALK_SPEED_KMH * 3600).astype(np.int64)
+        labels, found = self._run(days, access, access_time, max_transfers,
+                                  egress=egress, egress_seconds=egress_seconds)
+        return self._journeys(days, labels, found, egress, egress_km, start_lat, start_lon,
+                              end_lat, end_lon, t0)
+
+    def plan_many(self, start_lat, start_lon, end_lat, end_lon, departure=None,
+                  max_transfers=3, max_walk_km=MAX_WALK_KM, egress=None):
+        """
+        Plan from one origin to many destinations with a single search
+
+        end_lat/end_lon are sequences; egress optionally gives their already
+        snapped stops as (indices, distances_km) per destination. Returns one
+        journey list per destination, as plan() would.
+        """
+        tt = self.tt
+        departure = departure or datetime.now()
+        days = self.service_days(departure.date())
+        t0 = departure.hour * 3600 + departure.minute * 60 + departure.second
+        if egress is None:
+            egress = points_within(end_lat, end_lon, tt.stop_lat, tt.stop_lon, max_walk_km)
+
+        access, access_km = tt.nearby_stops(start_lat, start_lon, max_walk_km)
+        if len(access) == 0:
+            return [[] for _ in egress]
+
+        # One unpruned search; every destination then reads its labels
+        access_time = t0 + (access_km / WALK_SPEED_KMH * 3600).astype(np.int64)
+        labels, _ = self._run(days, access, access_time, max_transfers)
+
+        plans = []
+        for (stops, km), lat, lon in zip(egress, end_lat, end_lon):
+            if len(stops) == 0:
+                plans.append([])
+                continue
+            arrivals = labels.tau[1:labels.completed + 1, stops] + (km / WALK_SPEED_KMH * 3600).astype(np.int64)
+            found = []
+            target = INF
+            for k, row in enumerate(arrivals, start=1):
+                i = int(np.argmin(row))
+                if row[i] < target:
+                    target = int(row[i])
+                    found.append((k, i, target))
+            plans.append(self._journeys(days, labels, found, stops, km, start_lat, start_lon, lat, lon, t0))
+        return plans
+
+    def _journeys(self, days, labels, found, egress, egress_km, start_lat, start_lon, end_lat, end_lon, t0):
+        """Journeys for the (round, egress position, arrival) improvements of a search"""
+        tt = self.tt
+        journeys = []
+        for k, i, arrival in found:
+            stop = int(egress[i])
+            legs = self._reconstruct(k, stop, days, labels, start_lat, start_lon, t0)
+            legs.append(self._walk_leg(
+                (tt.stop_lat[stop], tt.stop_lon[stop], tt.stop_names[stop]),
+                (end_lat, end_lon, 'Destination'),
+                float(egress_km[i]), labels.tau[k, stop], arrival
+            ))
+            journeys.append({
+                'departure': t0,
+                'arrival': arrival,
+                'transfers': k - 1,
+                'legs': [leg for leg in legs if leg['mode'] != 'WALK' or leg['distance_km'] > 0],
+            })
+        return journeys
+
+    def plan_pareto(self, start_lat, start_lon, end_lat, end_lon, departure=None,
+                    max_transfers=3, max_walk_km=MAX_WALK_KM):
+        """
+        Pareto-optimal journeys on arrival time, fare, transfers and walking
+
+        Every stop keeps a bag of labels none of which is beaten on all of
+        arrival, fare and walking distance; round k holds the journeys with
+        k vehicles, so transfers come from the round. Fares are charged per
+        ride during the search (consecutive metro rides are priced as one
+        trip only once the journey is costed). The search is bounded by
+        PARETO_SLACK times the fastest journey found by the plain rounds.
+
+        Returns the journeys of the frontier, as plan() does, by arrival.
+        """
+        tt = self.tt
+        departure = departure or datetime.now()
+        days = self.service_days(departure.date())
+        t0 = departure.hour * 3600 + departure.minute * 60 + departure.second
+
+        access, access_km = tt.nearby_stops(start_lat, start_lon, max_walk_km)
+        egress, egress_km = tt.nearby_stops(end_lat, end_lon, max_walk_km)
+        if len(access) == 0 or len(egress) == 0:
+            return []
+
+        access_time = t0 + (access_km / WALK_SPEED_KMH * 3600).astype(np.int64)
+        egress_seconds = (egress_km / WALK_SPEED_KMH * 3600).astype(np.int64)
+        _, found = self._run(days, access, access_time, max_transfers,
+                             egress=egress, egress_seconds=egress_seconds)
+        if not found:
+            return []
+        limit = t0 + int((found[-1][2] - t0) * PARETO_SLACK) + PARETO_SLACK_SECONDS
+
+        best = defaultdict(list)         # Stop -> labels not dominated so far
+        best_ride = defaultdict(list)    # Stop -> vehicle arrivals, which may walk on
+        results = []                     # Destination labels of all rounds
+        marked = {}
+        for stop, km, arrival in zip(access.tolist(), access_km.tolist(), access_time.tolist()):
+            label = _mc_label(arrival, 0, _walk_units(km), stop, (_ACCESS,))
+            best[stop].append(label)
+            marked[stop] = [label]
+        egress_at = {stop: i for i, stop in enumerate(egress.tolist())}
+
+        # Round 0 walks through a stop near both ends, as plan() does
+        for k in range(0, max_transfers + 2):
+            if k == 0:
+                improved = marked
+            else:
+                rode, improved = self._scan_patterns_pareto(k, days, marked, best, best_ride, results, limit)
+                walked = self._relax_footpaths_pareto(rode, best, results, limit)
+                for stop, labels in walked.items():
+                    improved[stop].extend(labels)
+
+            # Journeys with k vehicles never replace ones with fewer
+            arrived = []
+            for stop, labels in improved.items():
+                i = egress_at.get(stop)
+                if i is None:
+                    continue
+                for label in labels:
+                    destination = _mc_label(label[3] + int(egress_seconds[i]), label[4],
+                                            label[5] + _walk_units(egress_km[i]), i, (k, label))
+                    if not _dominated(results, destination[0]):
+                        _pareto_insert(arrived, destination)
+            results.extend(arrived)
+
+            if not improved:
+                break
+            marked = improved
+
+        journeys = []
+        for _, i, (k, label), arrival, _, _ in sorted(results, key=lambda r: (r[3], r[4], r[5])):
+            stop = int(egress[i])
+            legs = self._reconstruct_pareto(label, start_lat, start_lon, t0)
+            legs.append(self._walk_leg(
+                (tt.stop_lat[stop], tt.stop_lon[stop], tt.stop_names[stop]),
+                (end_lat, end_lon, 'Destination'),
+                float(egress_km[i]), label[3], arrival
+            ))
+            journeys.append({
+                'departure': t0,
+                'arrival': arrival,
+                'transfers': max(k - 1, 0),
+                'legs': [leg for leg in legs if leg['mode'] != 'WALK' or leg['distance_km'] > 0],
+            })
+        return journeys
+
+    def reach(self, lat, lon, departure=None, max_seconds=3600, max_transfers=3,
+              max_walk_km=MAX_WALK_KM):
+        """
+        Earliest arrival at every stop from one origin (a one-to-all search)
+
+        Returns (t0, arrival) where arrival[stop] is in seconds after midnight
+        of the service day, INF for stops not reached within max_seconds.
+        """
+        tt = self.tt
+        departure = departure or datetime.now()
+        days = self.service_days(departure.date())
+        t0 = departure.hour * 3600 + departure.minute * 60 + departure.second
+
+        arrival = np.full(tt.n_stops, INF, dtype=np.int64)
+        access, access_km = tt.nearby_stops(lat, lon, max_walk_km)
+        access_time = t0 + (access_km / WALK_SPEED_KMH * 3600).astype(np.int64)
+        keep = access_time < t0 + max_seconds
+        access, access_time = access[keep], access_time[keep]
+        if len(access) == 0:
+            return t0, arrival
+
+        labels, _ = self._run(days, access, access_time, max_transfers, limit=t0 + max_seconds)
+        return t0, labels.best
+
+    def _run(self, days, access, access_time, max_transfers, limit=INF, egress=None, egress_seconds=None):
+        """
+        RAPTOR rounds from access stops reached at access_time
+
+        Labels at or after `limit` are pruned. With egress stops the bound
+        tightens each time the destination is reached sooner; those
+        improvements are returned as (round, egress position, arrival).
+        """
+        labels = _Labels(max_transfers + 1, self.tt.n_stops)
+        labels.tau[0, access] = access_time
+        labels.best[access] = access_time
+        labels.kind[0, access] = _ACCESS
+
+        target = limit
+        found = []
+        marked = access
+
+        for k in range(1, labels.rounds + 1):
+            labels.tau[k] = labels.tau[k - 1]
+            alighted, improved = self._scan_patterns(k, days, marked, labels, target)
+            if len(alighted):
+                walked = self._relax_footpaths(k, alighted, labels, target)
+                improved = np.union1d(improved, walked)
+            if len(improved) == 0:
+                break
+            labels.completed = k
+            marked = improved
+
+            if egress is not None:
+                arrivals = labels.tau[k, egress] + egress_seconds
+                i = int(np.argmin(arrivals))
+                if arrivals[i] < target:
+                    target = int(arrivals[i])
+                    found.append((k, i, target))
+
+        return labels, found
+
+    def _scan_patterns(self, k, days, marked, labels, target):
+        """
+        Scan every pattern serving a marked stop, all at once (per day view)
+
+        Returns (stops with an improved vehicle arrival, stops whose overall
+        arrival improved).
+        """
+        tt = self.tt
+        tau, best, ride, best_ride = labels.tau, labels.best, labels.ride, labels.best_ride
+        empty = np.empty(0, dtype=np.int64)
+        flat, _ = _csr_gather(tt.stop_pattern_ptr, marked)
+        if len(flat) == 0:
+            return empty, empty
+
+        # Earliest marked position per pattern
+        queue_from = np.full(tt.n_patterns, np.iinfo(np.int32).max, dtype=np.int64)
+        np.minimum.at(queue_from, tt.stop_patterns[flat], tt.stop_positions[flat])
+
+        alighted = []
+        for d, day in enumerate(days):
+            s = self._scan_day(k, d, day, queue_from, labels, target)
+            if len(s):
+                alighted.append(s)
+        if not alighted:
+            return empty, empty
+
+        alighted = np.unique(np.concatenate(alighted))
+        improved = alighted[ride[k, alighted] < best[alighted]]
+        tau[k, improved] = ride[k, improved]
+        best[improved] = ride[k, improved]
+        labels.kind[k, improved] = _TRIP
+        return alighted, improved
+
+    def _scan_day(self, k, d, day, queue_from, labels, target):
+        """Vehicle arrivals of round k on the queued patterns of one day view"""
+        tt = self.tt
+        tau, ride, best_ride = labels.tau, labels.ride, labels.best_ride
+        empty = np.empty(0, dtype=np.int64)
+
+        # Patterns with a marked stop and trips on this day
+        queued = np.flatnonzero((queue_from < np.iinfo(np.int32).max) & (day.n_trips > 0))
+        if len(queued) == 0:
+            return empty
+
+        # One element per (queued pattern, position from the first marked stop on)
+        first = queue_from[queued]
+        lengths = tt.pattern_n_stops[queued] - first
+        seg = np.repeat(np.arange(len(queued)), lengths)
+        offset = np.arange(int(lengths.sum())) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        pattern = queued[seg]
+        position = first[seg] + offset
+        col = tt.pattern_stop_ptr[pattern] + position
+        stop = tt.pattern_stops[col]
+        n_trips = day.n_trips[pattern]
+
+        # Earliest trip catchable at each position (n_trips when none)
+        ready = tau[k - 1, stop] + (MIN_CHANGE_SECONDS if k > 1 else 0)
+        ready = np.minimum(ready, TIME_KEY - 1)
+        catchable = np.searchsorted(day.keys, col * TIME_KEY + ready) - day.col_start[col]
+
+        # Running minimum along each pattern: the trip we are on at each position.
+        # Lowering the baseline per segment makes the accumulate restart there.
+        base = seg.astype(np.int64) * TIME_KEY
+        on_trip = np.minimum.accumulate(catchable - base) + base
+
+        # Where that trip was boarded (latest position achieving the minimum)
+        index = np.arange(len(stop))
+        boarded_at = np.maximum.accumulate(np.where((catchable == on_trip) & (catchable < n_trips), index, -1))
+
+        # A stop is reached by the trip boarded strictly before it
+        trip = np.empty_like(on_trip)
+        trip[1:] = on_trip[:-1]
+        board = np.empty_like(boarded_at)
+        board[1:] = boarded_at[:-1]
+        starts = offset == 0
+        trip[starts] = n_trips[starts]
+
+        valid = np.flatnonzero(trip < n_trips)
+        arrival = day.arr[day.col_start[col[valid]] + trip[valid]]
+        better = (arrival < best_ride[stop[valid]]) & (arrival < target)
+        valid, arrival = valid[better], arrival[better]
+        if len(valid) == 0:
+            return empty
+
+        # Write worst first so the best label per stop wins
+        order = np.argsort(-arrival, kind='stable')
+        valid, arrival = valid[order], arrival[order]
+        s = stop[valid]
+        ride[k, s] = arrival
+        best_ride[s] = arrival
+        labels.par_day[k, s] = d
+        labels.par_pattern[k, s] = pattern[valid]
+        labels.par_trip[k, s] = trip[valid]
+        labels.par_board[k, s] = position[board[valid]]
+        labels.par_alight[k, s] = position[valid]
+        return s
+
+    def _relax_footpaths(self, k, sources, labels, target):
+        """Walk from stops reached by vehicle in this round to nearby stops"""
+        if self.transfers is None:
+            return np.empty(0, dtype=np.int64)
+        indptr, indices, walk_seconds = self.transfers.as_csr()
+        flat, lengths = _csr_gather(indptr, sources)
+        if len(flat) == 0:
+            return flat
+
+        src = np.repeat(sources, lengths)
+        dst = indices[flat]
+        arrival = labels.ride[k, src] + walk_seconds[flat]
+        better = (arrival < labels.best[dst]) & (arrival < target)
+        src, dst, arrival = src[better], dst[better], arrival[better]
+        if len(dst) == 0:
+            return dst
+
+        order = np.argsort(-arrival, kind='stable')
+        src, dst, arrival = src[order], dst[order], arrival[order]
+        labels.tau[k, dst] = arrival
+        labels.best[dst] = arrival
+        labels.kind[k, dst] = _WALK
+        labels.par_from[k, dst] = src
+        return np.unique(dst)
+
+    def _scan_patterns_pareto(self, k, days, marked, best, best_ride, results, limit):
+        """
+        Multi-criteria pattern scan of round k
+
+        Returns (vehicle labels added per stop, labels that entered the
+        stop's overall bag per stop).
+        """
+        tt = self.tt
+        rode = defaultdict(list)
+        improved = defaultdict(list)
+        flat, _ = _csr_gather(tt.stop_pattern_ptr, np.fromiter(marked, dtype=np.int64))
+        queue_from = np.full(tt.n_patterns, np.iinfo(np.int32).max, dtype=np.int64)
+        np.minimum.at(queue_from, tt.stop_patterns[flat], tt.stop_positions[flat])
+
+        pattern_km = self._cumulative_pattern_km()
+        change = MIN_CHANGE_SECONDS if k > 1 else 0
+        for day in days:
+            queued = np.flatnonzero((queue_from < np.iinfo(np.int32).max) & (day.n_trips > 0))
+            self._scan_day_pareto(day, queued, queue_from, change, pattern_km, marked,
+                                  best, best_ride, results, limit, rode, improved)
+        return rode, improved
+
+    def _scan_day_pareto(self, day, queued, queue_from, change, pattern_km, marked,
+                         best, best_ride, results, limit, rode, improved):
+        """Multi-criteria scan of the queued patterns on one day view"""
+        tt = self.tt
+        for pattern, first in zip(queued.tolist(), queue_from[queued].tolist()):
+            n_stops = int(tt.pattern_n_stops[pattern])
+            n_trips = int(day.n_trips[pattern])
+            base = int(tt.pattern_stop_ptr[pattern])
+            start = int(day.col_start[base])
+            dep = day.dep[start:start + n_stops * n_trips].reshape(n_stops, n_trips)
+            arr = day.arr[start:start + n_stops * n_trips].reshape(n_stops, n_trips)
+            stops = tt.pattern_stops[base:base + n_stops].tolist()
+            km = pattern_km[base:base + n_stops]
+            fare = MODES['METRO' if tt.route_is_metro[tt.pattern_route[pattern]] else 'BUS'].fare
+
+            # Labels riding this pattern: (trip, boarding position, label boarded from)
+            riding = []
+            for position in range(first, n_stops):
+                stop = stops[position]
+                fares = []
+                for trip, board, label in riding:
+                    ride_fare = label[4] + fare(km[position] - km[board])
+                    fares.append(ride_fare)
+                    arrival = arr.item(position, trip)
+                    if arrival >= limit:
+                        continue
+                    alighted = _mc_label(arrival, ride_fare, label[5],
+                                         stop, (_TRIP, label, day, pattern, trip, board, position))
+                    if _dominated(results, alighted[0]):
+                        continue
+                    if _pareto_insert(best_ride[stop], alighted):
+                        rode[stop].append(alighted)
+                        if _pareto_insert(best[stop], alighted):
+                            improved[stop].append(alighted)
+
+                # Riding labels compete on trip, fare so far and walking
+                boarding_fare = fare(0)
+                for label in marked.get(stop, ()):
+                    trip = int(dep[position].searchsorted(label[3] + change))
+                    if trip >= n_trips:
+                        continue
+                    ride_fare, walk = label[4] + boarding_fare, label[5]
+                    if any(t <= trip and f <= ride_fare and l[5] <= walk
+                           for (t, _, l), f in zip(riding, fares)):
+                        continue
+                    keep = [not (trip <= t and ride_fare <= f and walk <= l[5])
+                            for (t, _, l), f in zip(riding, fares)]
+                    riding = [entry for entry, kept in zip(riding, keep) if kept]
+                    fares = [f for f, kept in zip(fares, keep) if kept]
+                    riding.append((trip, position, label))
+                    fares.append(ride_fare)
+
+    def _relax_footpaths_pareto(self, rode, best, results, limit):
+        """Walk on from this round's vehicle labels"""
+        walked = defaultdict(list)
+        if self.transfers is None:
+            return walked
+        indptr, indices, walk_seconds = self.transfers.as_csr()
+        for stop, labels in rode.items():
+            lo, hi = indptr[stop], indptr[stop + 1]
+            for target, seconds in zip(indices[lo:hi].tolist(), walk_seconds[lo:hi].tolist()):
+                walk = _walk_units(seconds / 3600 * WALK_SPEED_KMH)
+                for label in labels:
+                    arrival = label[3] + seconds
+                    if arrival >= limit:
+                        continue
+                    label = _mc_label(arrival, label[4], label[5] + walk, target, (_WALK, label))
+                    if not _dominated(results, label[0]) and _pareto_insert(best[target], label):
+                        walked[target].append(label)
+        return walked
+
+    def _cumulative_pattern_km(self):
+        """Distance along each pattern from its first stop, per pattern stop"""
+        if self._pattern_km is None:
+            self._pattern_km = self.tt.pattern_km().tolist()
+        return self._pattern_km
+
+    def _reconstruct_pareto(self, label, start_lat, start_lon, t0):
+        """Follow a multi-criteria label's parents back to the origin"""
+        tt = self.tt
+        legs = []
+        while True:
+            _, stop, parent, arrival, _, _ = label
+            if parent[0] == _ACCESS:
+                walk_km = float(haversine_km(start_lat, start_lon, tt.stop_lat[stop], tt.stop_lon[stop]))
+                legs.append(self._walk_leg(
+                    (start_lat, start_lon, 'Start'),
+                    (tt.stop_lat[stop], tt.stop_lon[stop], tt.stop_names[stop]),
+                    walk_km, t0, arrival
+                ))
+                break
+            label = parent[1]
+            if parent[0] == _WALK:
+                source = label[1]
+                walk_km = float(haversine_km(tt.stop_lat[source], tt.stop_lon[source],
+                                             tt.stop_lat[stop], tt.stop_lon[stop]))
+                legs.append(self._walk_leg(
+                    (tt.stop_lat[source], tt.stop_lon[source], tt.stop_names[source]),
+                    (tt.stop_lat[stop], tt.stop_lon[stop], tt.stop_names[stop]),
+                    walk_km, label[3], arrival
+                ))
+            else:
+                legs.append(self._ride_leg(*parent[2:]))
+        legs.reverse()
+        return legs
+
+    def _reconstruct(self, k, stop, days, labels, start_lat, start_lon, t0):
+        """Follow parent pointers back to the origin"""
+        tt = self.tt
+        tau, ride, kind = labels.tau, labels.ride, labels.kind
+        par_pattern, par_trip, par_board, par_alight = (labels.par_pattern, labels.par_trip,
+                                                        labels.par_board, labels.par_alight)
+        legs = []
+        label = kind[k, stop]
+        while True:
+            if label == _INHERITED:
+                k -= 1
+                label = kind[k, stop]
+            elif label == _ACCESS:
+                walk_km = float(haversine_km(start_lat, start_lon, tt.stop_lat[stop], tt.stop_lon[stop]))
+                legs.append(self._walk_leg(
+                    (start_lat, start_lon, 'Start'),
+                    (tt.stop_lat[stop], tt.stop_lon[stop], tt.stop_names[stop]),
+                    walk_km, t0, tau[k, stop]
+                ))
+                break
+            elif label == _WALK:
+                source = labels.par_from[k, stop]
+                walk_km = float(haversine_km(tt.stop_lat[source], tt.stop_lon[source],
+                                             tt.stop_lat[stop], tt.stop_lon[stop]))
+                legs.append(self._walk_leg(
+                    (tt.stop_lat[source], tt.stop_lon[source], tt.stop_names[source]),
+                    (tt.stop_lat[stop], tt.stop_lon[stop], tt.stop_names[stop]),
+                    walk_km, ride[k, source], tau[k, stop]
+                ))
+                # Footpaths always start from this round's vehicle arrival
+                stop = source
+                label = _TRIP
+            else:
+                day = days[labels.par_day[k, stop]]
+                legs.append(self._ride_leg(day, par_pattern[k, stop], par_trip[k, stop],
+                                           par_board[k, stop], par_alight[k, stop]))
+                stop = tt.pattern_stops[tt.pattern_stop_ptr[par_pattern[k, stop]] + par_board[k, stop]]
+                k -= 1
+                label = kind[k, stop]
+        legs.reverse()
+        return legs
+
+    def _ride_leg(self, day, pattern, trip, board, alight):
+        tt = self.tt
+        cols = tt.pattern_stop_ptr[pattern] + np.arange(board, alight + 1)
+        stops = tt.pattern_stops[cols]
+        times = day.col_start[cols] + trip
+        lat, lon = tt.stop_lat[stops], tt.stop_lon[stops]
+        route_id = str(tt.route_ids[tt.pattern_route[pattern]])
+        return {
+            'mode': 'METRO' if tt.route_is_metro[tt.pattern_route[pattern]] else 'BUS',
+            'route_id': route_id,
+            'trip_id': str(tt.trip_ids[day.trips[day.trip_ptr[pattern] + trip]]),
+            'departure': int(day.dep[times[0]]),
+            'arrival': int(day.arr[times[-1]]),
+            'distance_km': float(haversine_km(lat[:-1], lon[:-1], lat[1:], lon[1:]).sum()),
+            'stops': [
+                {
+                    'id': str(tt.stop_ids[s]),
+                    'name': str(tt.stop_names[s]),
+                    'lat': float(tt.stop_lat[s]),
+                    'lon': float(tt.stop_lon[s]),
+                    'arrival': int(day.arr[t]),
+                    'departure': int(day.dep[t]),
+                }
+                for s, t in zip(stops, times)
+            ],
+        }
+
+    def _walk_leg(self, origin, destination, distance_km, departure, arrival):
+        return {
+            'mode': 'WALK',
+            'from': {'lat': float(origin[0]), 'lon': float(origin[1]), 'name': str(origin[2])},
+            'to': {'lat': float(destination[0]), 'lon': float(destination[1]), 'name': str(destination[2])},
+            'distance_km': round(float(distance_km), 3),
+            'departure': int(departure),
+            'arrival': int(arrival),
+        }
+
+
+def get_raptor_router():
+    """Get the router of the shared network (None until static data is loaded)"""
+    from .network import get_network
+
+    network = get_network()
+    return network.router if network is not None else None
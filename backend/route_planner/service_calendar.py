@@ -0,0 +1,232 @@
+"""
+Per-service-day active trip sets from calendar.txt and calendar_dates.txt
+
+Service validity is resolved once, when the database is built, into one
+bitset per date over service_ids and one over trips (in trips table rowid
+order). A router filters to a day's trips with a single mask lookup
+instead of evaluating calendars per trip at query time.
+
+Note that GTFS times past 24:00:00 belong to the previous service day, so
+early-morning queries should also consider the previous day's mask.
+"""
+
+import os
+import threading
+import numpy as np
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from .shared_snapshot import load_npz
+
+MAX_DAYS = 366          # Length of the precomputed window
+LOOKBACK_DAYS = 7       # Keep a few past days for after-midnight trips
+
+WEEKDAY_COLUMNS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+
+def service_days_path(db_path):
+    """Location of the service-day bitsets stored alongside a database"""
+    db_path = Path(db_path)
+    return db_path.with_name(f"{db_path.stem}.service_days.npz")
+
+
+def _parse_date(value):
+    return datetime.strptime(str(int(value)), "%Y%m%d").date()
+
+
+class ServiceCalendar:
+    """Packed per-day bitsets of active services and trips"""
+
+    def __init__(self, start_date, service_ids, trip_ids, trip_service, service_bits,
+                 trip_bits, db_version=None):
+        self.start_date = start_date
+        self.service_ids = service_ids
+        self.trip_ids = trip_ids
+        self.trip_service = trip_service
+        self.service_bits = service_bits
+        self.trip_bits = trip_bits
+        self.db_version = db_version
+        self.n_days = service_bits.shape[0]
+        self._trip_index = None
+
+    @classmethod
+    def build(cls, conn, db_version=None, today=None):
+        """Resolve calendar/calendar_dates for every trip in the database"""
+        today = today or date.today()
+
+        trip_rows = conn.execute(
+            "SELECT trip_id, service_id FROM trips ORDER BY rowid"
+        ).fetchall()
+        trip_ids = np.array([str(r[0]) for r in trip_rows])
+        trip_service_ids = [str(r[1]) for r in trip_rows]
+
+        calendar = _fetch_if_exists(conn, "calendar", [
+            'service_id', *WEEKDAY_COLUMNS, 'start_date', 'end_date'
+        ])
+        exceptions = _fetch_if_exists(conn, "calendar_dates", ['service_id', 'date', 'exception_type'])
+
+        service_ids = sorted(
+            set(trip_service_ids)
+            | {str(r[0]) for r in calendar}
+            | {str(r[0]) for r in exceptions}
+        )
+        service_index = {sid: i for i, sid in enumerate(service_ids)}
+        trip_service = np.array([service_index[s] for s in trip_service_ids], dtype=np.int32)
+
+        # Validity window: the feed's own range, clipped around today
+        feed_dates = [_parse_date(r[8]) for r in calendar] + [_parse_date(r[9]) for r in calendar]
+        feed_dates += [_parse_date(r[1]) for r in exceptions]
+        start_date = today - timedelta(days=LOOKBACK_DAYS)
+        if feed_dates:
+            start_date = max(min(feed_dates), start_date)
+            end_date = min(max(feed_dates), start_date + timedelta(days=MAX_DAYS - 1))
+            end_date = max(end_date, start_date)
+        else:
+            end_date = start_date + timedelta(days=MAX_DAYS - 1)
+        n_days = (end_date - start_date).days + 1
+
+        day_ordinals = start_date.toordinal() + np.arange(n_days)
+        day_weekdays = (start_date.weekday() + np.arange(n_days)) % 7
+
+        if calendar or exceptions:
+            active = np.zeros((n_days, len(service_ids)), dtype=bool)
+        else:
+            # No calendar at all: every service runs every day
+            active = np.ones((n_days, len(service_ids)), dtype=bool)
+
+        if calendar:
+            cal_service = np.array([service_index[str(r[0])] for r in calendar])
+            cal_weekdays = np.array([[int(v) for v in r[1:8]] for r in calendar], dtype=bool)
+            cal_start = np.array([_parse_date(r[8]).toordinal() for r in calendar])
+            cal_end = np.array([_parse_date(r[9]).toordinal() for r in calendar])
+
+            # days x calendar rows, evaluated in one broadcast
+            in_range = (day_ordinals[:, None] >= cal_start) & (day_ordinals[:, None] <= cal_end)
+            runs = in_range & cal_weekdays[:, day_weekdays].T
+            for col, service in enumerate(cal_service):
+                active[:, service] |= runs[:, col]
+
+        for service_id, exception_date, exception_type in exceptions:
+            day = _parse_date(exception_date).toordinal() - start_date.toordinal()
+            if 0 <= day < n_days:
+                active[day, service_index[str(service_id)]] = int(exception_type) == 1
+
+        trip_active = active[:, trip_service]
+
+        return cls(
+            start_date=start_date,
+            service_ids=np.array(service_ids),
+            trip_ids=trip_ids,
+            trip_service=trip_service,
+            service_bits=np.packbits(active, axis=1),
+            trip_bits=np.packbits(trip_active, axis=1),
+            db_version=db_version,
+        )
+
+    def save(self, path):
+        """Write atomically (temp file + rename)"""
+        path = Path(path)
+        tmp_path = path.with_name(f"{path.name}.tmp-{os.getpid()}")
+        with open(tmp_path, 'wb') as f:
+            np.savez(
+                f,
+                start_date=np.array(self.start_date.toordinal()),
+                service_ids=self.service_ids,
+                trip_ids=self.trip_ids,
+                trip_service=self.trip_service,
+                service_bits=self.service_bits,
+                trip_bits=self.trip_bits,
+                db_version=np.array(self.db_version or ''),
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with load_npz(path) as data:
+            return cls(
+                start_date=date.fromordinal(int(data['start_date'])),
+                service_ids=data['service_ids'],
+                trip_ids=data['trip_ids'],
+                trip_service=data['trip_service'],
+                service_bits=data['service_bits'],
+                trip_bits=data['trip_bits'],
+                db_version=str(data['db_version']) or None,
+            )
+
+    @property
+    def end_date(self):
+        return self.start_date + timedelta(days=self.n_days - 1)
+
+    def day_index(self, day):
+        """Row of the bitsets for a date, or None outside the window"""
+        if isinstance(day, datetime):
+            day = day.date()
+        offset = (day - self.start_date).days
+        if 0 <= offset < self.n_days:
+            return offset
+        return None
+
+    def active_trips(self, day):
+        """Boolean mask over trips (trips table order) running on a date"""
+        d = self.day_index(day)
+        if d is None:
+            return np.zeros(len(self.trip_ids), dtype=bool)
+        return np.unpackbits(self.trip_bits[d], count=len(self.trip_ids)).view(bool)
+
+    def active_services(self, day):
+        """Boolean mask over service_ids running on a date"""
+        d = self.day_index(day)
+        if d is None:
+            return np.zeros(len(self.service_ids), dtype=bool)
+        return np.unpackbits(self.service_bits[d], count=len(self.service_ids)).view(bool)
+
+    def trip_index(self, trip_id):
+        """Position of a trip in the masks, or None if unknown"""
+        if self._trip_index is None:
+            self._trip_index = {tid: i for i, tid in enumerate(self.trip_ids.tolist())}
+        return self._trip_index.get(str(trip_id))
+
+    def is_trip_active(self, trip_id, day):
+        d = self.day_index(day)
+        i = self.trip_index(trip_id)
+        if d is None or i is None:
+            return False
+        return bool(self.trip_bits[d, i >> 3] & (0x80 >> (i & 7)))
+
+
+def _fetch_if_exists(conn, table, columns):
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).fetchone()
+    if not exists:
+        return []
+    return conn.execute(f"SELECT {', '.join(columns)} FROM {table}").fetchall()
+
+
+def load_service_calendar(transit_db, conn, version):
+    """Load the bitsets stored next to transit.db if they match its version"""
+    path = service_days_path(transit_db.db_path)
+    if not path.exists():
+        return None
+    calendar = ServiceCalendar.load(path)
+    if version and calendar.db_version != version:
+        print(f"⚠ {path.name} does not match transit.db version {version}, ignoring")
+        return None
+    return calendar
+
+# Singleton instance
+_calendar = None
+_calendar_lock = threading.Lock()
+
+def get_service_calendar():
+    """
+    Get the service calendar for the live transit.db (None if unavailable)
+
+    The calendar is swapped automatically when a rebuilt database is published.
+    """
+    global _calendar
+    from .transit_db import get_transit_db, DerivedCache
+
+    with _calendar_lock:
+        if _calendar is None:
+            _calendar = DerivedCache(get_transit_db(), load_service_calendar)
+    return _calendar.current
@@ -0,0 +1,324 @@
+"""
+Map-matching of live vehicles onto their trip's route shape
+
+Shape polylines (shapes.txt, or the stop sequence of trips without a
+shape) are indexed once, when the database is built: every segment is
+registered in the grid cells its bounding box covers, keyed by
+(shape, cell). Matching a feed snapshot then looks up only the segments
+of each vehicle's own shape in the 3x3 cells around it and projects the
+vehicle onto all of them in one vectorized pass.
+
+The result per vehicle is its distance along the shape and its progress
+(0..1) through the trip, instead of a free-floating point.
+"""
+
+import os
+import threading
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from .geo import project_m
+from .shared_snapshot import load_npz
+
+MATCH_RADIUS_M = 200        # Vehicles further than this from their shape are left unmatched
+
+# Keys of shapes built from stop sequences of trips without shapes.txt geometry
+PATTERN_SHAPE_PREFIX = "stops:"
+
+
+def shape_index_path(db_path):
+    """Location of the shape index stored alongside a database"""
+    db_path = Path(db_path)
+    return db_path.with_name(f"{db_path.stem}.shapes.npz")
+
+
+class ShapeIndex:
+    """Route shapes with cumulative distances and a (shape, cell) segment index"""
+
+    ARRAYS = [
+        'shape_ids', 'shape_ptr', 'pt_lat', 'pt_lon', 'pt_x', 'pt_y', 'pt_dist_m',
+        'cell_keys', 'cell_ptr', 'cell_segments',
+        'trip_ids', 'trip_shape', 'route_ids', 'route_shape', 'grid',
+    ]
+
+    def __init__(self, db_version=None, **arrays):
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+        self.db_version = db_version
+        self.n_shapes = len(self.shape_ids)
+        self.shape_length_m = self.pt_dist_m[self.shape_ptr[1:] - 1] if self.n_shapes else np.empty(0)
+        # origin_lat, origin_lon, x_min, y_min, cell_m, n_cx, n_cy
+        self.origin_lat, self.origin_lon, self.x_min, self.y_min, self.cell_m = self.grid[:5]
+        self.n_cx, self.n_cy = int(self.grid[5]), int(self.grid[6])
+        self._trip_lookup = None
+        self._route_lookup = None
+        self._shape_lookup = None
+
+    @classmethod
+    def build(cls, conn, timetable, db_version=None, cell_m=MATCH_RADIUS_M):
+        """Index shapes.txt, falling back to stop sequences for trips without a shape"""
+        trip_columns = {row[1] for row in conn.execute("PRAGMA table_info(trips)")}
+        shape_column = 'shape_id' if 'shape_id' in trip_columns else 'NULL'
+        trips = pd.read_sql_query(
+            f"SELECT trip_id, route_id, {shape_column} AS shape_id FROM trips ORDER BY rowid", conn
+        )
+        trip_ids = trips['trip_id'].astype(str).to_numpy()
+
+        # shapes.txt polylines, in sequence order
+        has_shapes = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'shapes'"
+        ).fetchone()
+        if has_shapes:
+            points = pd.read_sql_query(
+                "SELECT shape_id, shape_pt_lat, shape_pt_lon, shape_pt_sequence FROM shapes", conn
+            )
+            points['shape_id'] = points['shape_id'].astype(str)
+            points = points.dropna().sort_values(['shape_id', 'shape_pt_sequence'], kind='stable')
+            counts = points.groupby('shape_id', sort=True).size()
+            points = points[points['shape_id'].isin(counts.index[counts >= 2])]
+        else:
+            points = pd.DataFrame(columns=['shape_id', 'shape_pt_lat', 'shape_pt_lon'])
+
+        shape_codes, shape_ids = pd.factorize(points['shape_id'], sort=True)
+        shape_ids = list(shape_ids)
+        lat_parts = [points['shape_pt_lat'].to_numpy(dtype=np.float64)]
+        lon_parts = [points['shape_pt_lon'].to_numpy(dtype=np.float64)]
+        lengths = [np.bincount(shape_codes, minlength=len(shape_ids))]
+
+        shape_lookup = pd.Series(np.arange(len(shape_ids)), index=pd.Index(shape_ids, dtype=object))
+        trip_shape = shape_lookup.reindex(trips['shape_id'].astype(str)).fillna(-1).to_numpy(dtype=np.int64)
+
+        # Trips without usable geometry follow the stops of their route pattern
+        trip_pattern = np.full(len(trip_ids), -1, dtype=np.int64)
+        trip_pattern[timetable.pattern_trips] = np.repeat(np.arange(timetable.n_patterns),
+                                                          timetable.pattern_n_trips)
+        pattern_shape = {}
+        for trip in np.flatnonzero((trip_shape < 0) & (trip_pattern >= 0)):
+            stops = timetable.pattern_stops[timetable.pattern_stop_ptr[trip_pattern[trip]]:
+                                            timetable.pattern_stop_ptr[trip_pattern[trip] + 1]]
+            key = stops.tobytes()
+            if key not in pattern_shape:
+                pattern_shape[key] = len(shape_ids)
+                shape_ids.append(f"{PATTERN_SHAPE_PREFIX}{trip_pattern[trip]}")
+                lat_parts.append(timetable.stop_lat[stops])
+                lon_parts.append(timetable.stop_lon[stops])
+                lengths.append([len(stops)])
+            trip_shape[trip] = pattern_shape[key]
+
+        pt_lat = np.concatenate(lat_parts)
+        pt_lon = np.concatenate(lon_parts)
+        shape_ptr = np.concatenate([[0], np.cumsum(np.concatenate(lengths))]).astype(np.int64)
+        n_shapes = len(shape_ids)
+        point_shape = np.repeat(np.arange(n_shapes), np.diff(shape_ptr))
+
+        # Planar coordinates and distance along each shape
+        origin_lat = float(np.mean(pt_lat)) if len(pt_lat) else 0.0
+        origin_lon = float(np.mean(pt_lon)) if len(pt_lon) else 0.0
+        pt_x, pt_y = project_m(pt_lat, pt_lon, origin_lat, origin_lon)
+        step = np.zeros(len(pt_x))
+        step[1:] = np.hypot(np.diff(pt_x), np.diff(pt_y))
+        step[shape_ptr[:-1]] = 0.0
+        cumulative = np.cumsum(step)
+        pt_dist_m = cumulative - np.repeat(cumulative[shape_ptr[:-1]], np.diff(shape_ptr))
+
+        # Register each segment (point i -> i + 1) in every cell its bounding box covers
+        x_min = float(pt_x.min()) if len(pt_x) else 0.0
+        y_min = float(pt_y.min()) if len(pt_y) else 0.0
+        seg = np.flatnonzero(point_shape[:-1] == point_shape[1:]) if n_shapes else np.empty(0, dtype=np.int64)
+        cx = np.floor((pt_x - x_min) / cell_m).astype(np.int64)
+        cy = np.floor((pt_y - y_min) / cell_m).astype(np.int64)
+        n_cx = int(cx.max()) + 1 if len(cx) else 1
+        n_cy = int(cy.max()) + 1 if len(cy) else 1
+        cx0, cx1 = np.minimum(cx[seg], cx[seg + 1]), np.maximum(cx[seg], cx[seg + 1])
+        cy0, cy1 = np.minimum(cy[seg], cy[seg + 1]), np.maximum(cy[seg], cy[seg + 1])
+        span_y = cy1 - cy0 + 1
+        counts = (cx1 - cx0 + 1) * span_y
+        offsets = np.arange(int(counts.sum())) - np.repeat(np.cumsum(counts) - counts, counts)
+        span_y = np.repeat(span_y, counts)
+        keys = ((point_shape[np.repeat(seg, counts)] * n_cx + np.repeat(cx0, counts) + offsets // span_y) * n_cy
+                + np.repeat(cy0, counts) + offsets % span_y)
+        segments = np.repeat(seg, counts)
+        order = np.argsort(keys, kind='stable')
+        keys, segments = keys[order], segments[order]
+        cell_keys, cell_start = np.unique(keys, return_index=True)
+
+        # Most common shape per route, for vehicles reporting no known trip
+        route_ids = trips['route_id'].astype(str).to_numpy()
+        known = trip_shape >= 0
+        route_shape = (pd.DataFrame({'route': route_ids[known], 'shape': trip_shape[known]})
+                       .groupby('route')['shape'].agg(lambda s: s.value_counts().index[0]))
+
+        return cls(
+            db_version=db_version,
+            shape_ids=np.asarray(shape_ids, dtype=str),
+            shape_ptr=shape_ptr,
+            pt_lat=pt_lat,
+            pt_lon=pt_lon,
+            pt_x=pt_x,
+            pt_y=pt_y,
+            pt_dist_m=pt_dist_m,
+            cell_keys=cell_keys.astype(np.int64),
+            cell_ptr=np.concatenate([cell_start, [len(keys)]]).astype(np.int64),
+            cell_segments=segments.astype(np.int64),
+            trip_ids=trip_ids.astype(str),
+            trip_shape=trip_shape,
+            route_ids=route_shape.index.to_numpy(dtype=str),
+            route_shape=route_shape.to_numpy(dtype=np.int64),
+            grid=np.array([origin_lat, origin_lon, x_min, y_min, cell_m, n_cx, n_cy], dtype=np.float64),
+        )
+
+    def save(self, path):
+        """Write atomically (temp file + rename)"""
+        path = Path(path)
+        tmp_path = path.with_name(f"{path.name}.tmp-{os.getpid()}")
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, db_version=np.array(self.db_version or ''),
+                     **{name: getattr(self, name) for name in self.ARRAYS})
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with load_npz(path) as data:
+            arrays = {name: data[name] for name in cls.ARRAYS}
+            return cls(db_version=str(data['db_version']) or None, **arrays)
+
+    @property
+    def n_segments(self):
+        return len(self.pt_x) - self.n_shapes
+
+    def find_shape(self, shape_id):
+        """Index of a shape by its ID, or None if unknown"""
+        if shape_id is None:
+            return None
+        if self._shape_lookup is None:
+            self._shape_lookup = {sid: i for i, sid in enumerate(self.shape_ids.tolist())}
+        return self._shape_lookup.get(str(shape_id))
+
+    def shapes_for(self, trip_ids, route_ids):
+        """Shape index per vehicle from its trip (or else its route), -1 if unknown"""
+        if self._trip_lookup is None:
+            self._trip_lookup = dict(zip(self.trip_ids.tolist(), self.trip_shape.tolist()))
+            self._route_lookup = dict(zip(self.route_ids.tolist(), self.route_shape.tolist()))
+        trips, routes = self._trip_lookup, self._route_lookup
+        return np.array([
+            trips.get(trip, -1) if trips.get(trip, -1) >= 0 else routes.get(route, -1)
+            for trip, route in zip(trip_ids, route_ids)
+        ], dtype=np.int64)
+
+    def match(self, lat, lon, shapes, max_offset_m=None):
+        """
+        Project vehicles onto their shapes
+
+        Returns a dict of arrays, one entry per vehicle: segment (start point
+        index, -1 when unmatched), distance_m along the shape, progress (0..1)
+        and offset_m from the shape.
+        """
+        max_offset_m = max_offset_m or self.cell_m
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        shapes = np.asarray(shapes, dtype=np.int64)
+        n = len(lat)
+        result = {
+            'segment': np.full(n, -1, dtype=np.int64),
+            'distance_m': np.full(n, np.nan),
+            'progress': np.full(n, np.nan),
+            'offset_m': np.full(n, np.nan),
+        }
+
+        x, y = project_m(lat, lon, self.origin_lat, self.origin_lon)
+        cx = np.floor((x - self.x_min) / self.cell_m)
+        cy = np.floor((y - self.y_min) / self.cell_m)
+        usable = (shapes >= 0) & np.isfinite(cx) & np.isfinite(cy)
+
+        vehicle_parts, segment_parts = [], []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                ncx, ncy = cx + dx, cy + dy
+                inside = usable & (ncx >= 0) & (ncx < self.n_cx) & (ncy >= 0) & (ncy < self.n_cy)
+                vehicles = np.flatnonzero(inside)
+                keys = ((shapes[vehicles] * self.n_cx + ncx[vehicles].astype(np.int64)) * self.n_cy
+                        + ncy[vehicles].astype(np.int64))
+                slot = np.searchsorted(self.cell_keys, keys)
+                slot = np.minimum(slot, len(self.cell_keys) - 1)
+                found = self.cell_keys[slot] == keys if len(self.cell_keys) else np.zeros(len(keys), bool)
+                vehicles, slot = vehicles[found], slot[found]
+                starts = self.cell_ptr[slot]
+                counts = self.cell_ptr[slot + 1] - starts
+                offsets = np.arange(int(counts.sum())) - np.repeat(np.cumsum(counts) - counts, counts)
+                vehicle_parts.append(np.repeat(vehicles, counts))
+                segment_parts.append(self.cell_segments[np.repeat(starts, counts) + offsets])
+
+        vehicle = np.concatenate(vehicle_parts)
+        segment = np.concatenate(segment_parts)
+        if len(vehicle) == 0:
+            return result
+
+        # Closest point on every candidate segment
+        ax, ay = self.pt_x[segment], self.pt_y[segment]
+        bx, by = self.pt_x[segment + 1], self.pt_y[segment + 1]
+        px, py = x[vehicle], y[vehicle]
+        dx, dy = bx - ax, by - ay
+        length_sq = dx * dx + dy * dy
+        t = np.where(length_sq > 0, ((px - ax) * dx + (py - ay) * dy) / np.maximum(length_sq, 1e-9), 0.0)
+        t = np.clip(t, 0.0, 1.0)
+        offset = np.hypot(ax + t * dx - px, ay + t * dy - py)
+
+        # Best candidate per vehicle
+        order = np.lexsort((offset, vehicle))
+        vehicle, segment, t, offset = vehicle[order], segment[order], t[order], offset[order]
+        first = np.concatenate([[True], vehicle[1:] != vehicle[:-1]])
+        first &= offset <= max_offset_m
+        vehicle, segment, t, offset = vehicle[first], segment[first], t[first], offset[first]
+
+        distance = self.pt_dist_m[segment] + t * (self.pt_dist_m[segment + 1] - self.pt_dist_m[segment])
+        length = self.shape_length_m[shapes[vehicle]]
+        result['segment'][vehicle] = segment
+        result['distance_m'][vehicle] = distance
+        result['progress'][vehicle] = np.where(length > 0, distance / np.maximum(length, 1e-9), 0.0)
+        result['offset_m'][vehicle] = offset
+        return result
+
+    def match_vehicles(self, trip_ids, route_ids, lat, lon):
+        """Resolve each vehicle's shape and project it, as match() plus a 'shape' array"""
+        shapes = self.shapes_for(trip_ids, route_ids)
+        result = self.match(lat, lon, shapes)
+        result['shape'] = np.where(result['segment'] >= 0, shapes, -1)
+        return result
+
+    def path_between(self, shape, start_m, end_m):
+        """Shape points between two distances along it, as [(lat, lon), ...]"""
+        a, b = self.shape_ptr[shape], self.shape_ptr[shape + 1]
+        dist = self.pt_dist_m[a:b]
+        lat, lon = self.pt_lat[a:b], self.pt_lon[a:b]
+        inner = np.flatnonzero((dist > start_m) & (dist < end_m))
+        ends_lat = np.interp([start_m, end_m], dist, lat)
+        ends_lon = np.interp([start_m, end_m], dist, lon)
+        path_lat = np.concatenate([[ends_lat[0]], lat[inner], [ends_lat[1]]])
+        path_lon = np.concatenate([[ends_lon[0]], lon[inner], [ends_lon[1]]])
+        return list(zip(path_lat.tolist(), path_lon.tolist()))
+
+
+def load_shape_index(transit_db, conn, version):
+    """Load the shape index stored next to transit.db if it matches its version"""
+    path = shape_index_path(transit_db.db_path)
+    if not path.exists():
+        return None
+    index = ShapeIndex.load(path)
+    if version and index.db_version != version:
+        print(f"⚠ {path.name} does not match transit.db version {version}, ignoring")
+        return None
+    return index
+
+# Singleton instance
+_index = None
+_index_lock = threading.Lock()
+
+def get_shape_index():
+    """Get the shape index for the live transit.db (None until static data is loaded)"""
+    global _index
+    from .transit_db import get_transit_db, DerivedCache
+
+    with _index_lock:
+        if _index is None:
+            _index = DerivedCache(get_transit_db(), load_shape_index)
+    return _index.current
@@ -0,0 +1,224 @@
+"""
+Shared snapshots for multi-worker deployments
+
+By default every server process polls the Delhi feed itself and loads its
+own copy of the static network. With SHARED_SNAPSHOTS=1 the work is split:
+
+- One ingest process (`python -m route_planner.shared_snapshot publish`)
+  polls the feed, keeps the position log and speed profiles, and publishes
+  each raw snapshot to `live_feed.bin` next to transit.db: a small header
+  (magic, version counter, fetch time, length) followed by the message,
+  replaced atomically so readers see whole snapshots only.
+- Workers never contact the Delhi API. They check the file's identity on
+  each request (one stat), map it read-only when it changed, and ingest the
+  snapshot only if its version is newer than the last one they saw.
+- The static network's arrays (timetable, transfers, shapes, service
+  calendar, hierarchy) are memory-mapped from the uncompressed .npz files
+  instead of read into each process, so all workers share one copy in the
+  page cache. The mappings stay valid when a rebuild replaces the files.
+
+Upstream traffic no longer grows with the worker count, and the largest
+static arrays are held once per machine rather than once per worker.
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import zipfile
+import numpy as np
+import requests
+from pathlib import Path
+
+MAGIC = b'PTOFEED1'
+HEADER = struct.Struct('<8sQdQ')    # magic, version, fetch time, message length
+PUBLISH_INTERVAL_SECONDS = 30
+
+
+def shared_mode():
+    """True when this process should read shared snapshots instead of the live feed"""
+    return os.environ.get('SHARED_SNAPSHOTS', '').lower() in ('1', 'true', 'yes')
+
+
+def feed_path():
+    """Location of the published feed snapshot alongside the database"""
+    from .transit_db import get_transit_db
+
+    return Path(get_transit_db().db_path).with_name('live_feed.bin')
+
+
+class FeedPublisher:
+    """Writes feed snapshots for workers to pick up, with an increasing version"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.version = 0
+        try:
+            with open(self.path, 'rb') as f:
+                magic, version, _, _ = HEADER.unpack(f.read(HEADER.size))
+            if magic == MAGIC:
+                self.version = version
+        except (OSError, struct.error):
+            pass
+
+    def publish(self, content, fetched_at=None):
+        """Write atomically (temp file + rename); returns the snapshot's version"""
+        self.version += 1
+        tmp_path = self.path.with_name(f"{self.path.name}.tmp-{os.getpid()}")
+        with open(tmp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, self.version, fetched_at or time.time(), len(content)))
+            f.write(content)
+        os.replace(tmp_path, self.path)
+        return self.version
+
+
+class FeedReader:
+    """Read-only view of the published snapshot, reread only when it changes"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.version = 0
+        self.fetched_at = None
+        self.content = None
+        self._identity = None
+        self._lock = threading.Lock()
+
+    def read_if_newer(self):
+        """The snapshot's message if it is newer than the last one returned, else None"""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        identity = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if identity == self._identity:
+            return None
+        with self._lock:
+            if identity == self._identity:
+                return None
+            with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if len(mm) < HEADER.size:
+                    return None
+                magic, version, fetched_at, length = HEADER.unpack_from(mm)
+                if magic != MAGIC or len(mm) < HEADER.size + length:
+                    return None
+                self._identity = identity
+                if version <= self.version:
+                    return None
+                content = mm[HEADER.size:HEADER.size + length]
+            self.version = version
+            self.fetched_at = fetched_at
+            self.content = content
+            return content
+
+    def stats(self):
+        return {
+            'path': str(self.path),
+            'version': self.version,
+            'age_seconds': round(time.time() - self.fetched_at, 1) if self.fetched_at else None,
+            'bytes': len(self.content) if self.content is not None else 0,
+        }
+
+
+class _MappedNpz:
+    """Members of an uncompressed .npz as read-only memory maps (np.load's interface)"""
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._zip = zipfile.ZipFile(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._zip.close()
+
+    def __getitem__(self, name):
+        info = self._zip.getinfo(f"{name}.npy")
+        if info.compress_type != zipfile.ZIP_STORED:
+            return self._read(info)
+        with open(self.path, 'rb') as f:
+            # Local file header: 30 bytes, then the name and extra field
+            f.seek(info.header_offset + 26)
+            name_len, extra_len = struct.unpack('<HH', f.read(4))
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            offset = f.tell()
+        if dtype.hasobject or not shape or 0 in shape:
+            return self._read(info)
+        return np.memmap(self.path, dtype=dtype, mode='r', offset=offset, shape=shape,
+                         order='F' if fortran_order else 'C').view(np.ndarray)
+
+    def _read(self, info):
+        with self._zip.open(info) as f:
+            return np.lib.format.read_array(f, allow_pickle=False)
+
+
+def load_npz(path):
+    """np.load of a derived .npz, memory-mapped read-only in shared mode"""
+    if shared_mode():
+        return _MappedNpz(path)
+    return np.load(path)
+
+
+def publish(interval=PUBLISH_INTERVAL_SECONDS):
+    """
+    Run the ingest process: poll the feed, ingest it once, publish it for workers
+
+    Also builds the static network up front, so workers start by mapping
+    files that already exist rather than each building them.
+    """
+    from .network import get_network
+    from .simple_planner import get_planner, REALTIME_API
+    from .transit_db import get_transit_db
+
+    if shared_mode():
+        print("✗ Unset SHARED_SNAPSHOTS for the ingest process; it is the one that fetches the feed")
+        return
+    get_network()
+    planner = get_planner()
+    planner.fetch_on_demand = False
+    get_transit_db().start_watcher()
+    planner.arrival_predictor.start_cleanup()
+    publisher = FeedPublisher(feed_path())
+    print(f"✓ Publishing {REALTIME_API.split('?')[0]} to {publisher.path} every {interval:g}s")
+    last_digest = None
+
+    try:
+        while True:
+            tick = time.time()
+            try:
+                response = requests.get(REALTIME_API, timeout=10)
+                response.raise_for_status()
+                digest = hashlib.sha256(response.content).digest()
+                if digest != last_digest:
+                    n = planner.ingest_feed(response.content)
+                    version = publisher.publish(response.content, tick)
+                    last_digest = digest
+                    print(f"✓ Snapshot {version}: {n} vehicles, {len(response.content):,} bytes")
+            except Exception as e:
+                print(f"⚠ Feed refresh failed: {e}")
+            time.sleep(max(0.0, interval - (time.time() - tick)))
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+    """Command line entry point"""
+    if len(sys.argv) < 2 or sys.argv[1] != 'publish':
+        print("Usage: python -m route_planner.shared_snapshot publish [interval_s]")
+        return
+    publish(float(sys.argv[2]) if len(sys.argv) > 2 else PUBLISH_INTERVAL_SECONDS)
+
+
+if __name__ == "__main__":
+    main()
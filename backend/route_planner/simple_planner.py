@@ -1,17 +1,42 @@
 """
 Simplified route planner using real-time bus data
-This works WITHOUT GTFS static data as an interim solution
+Uses the static bus + metro timetable (RAPTOR) when transit.db is loaded,
+and works WITHOUT GTFS static data by inferring routes from live buses
 """
 
+import os
 import requests
+import numpy as np
 from geopy.distance import geodesic
 from datetime import datetime, timedelta
 import math
+import time
 from .gtfs_route_mapper import get_route_mapper
 from .metro_planner import get_metro_planner
 from .arrival_predictor import get_arrival_predictor
+from .raptor import get_raptor_router, format_seconds
+from .network import MODES, MAX_WALK_KM, journey_fare, get_network
+from .geo import points_within
+from .gtfs_loader import METRO_ID_PREFIX
+from .shape_index import get_shape_index
+from .plan_cache import PlanCache
+from .pareto import select_routes
+from .transit_db import get_transit_db
+from .position_log import get_position_log
+from .arrival_boards import ArrivalBoards
+from . import metrics, tracing
+from .tracing import traced
+from .shared_snapshot import FeedReader, feed_path, shared_mode
 
-REALTIME_API = "https://otd.delhi.gov.in/api/realtime/VehiclePositions.pb?key=mt2giIBCJY1tOjhmMIwfTaTwAXTfPpYR"
+# REALTIME_API_URL points the planner at another feed, e.g. a feed_replay stand-in
+REALTIME_API = os.environ.get(
+    'REALTIME_API_URL',
+    "https://otd.delhi.gov.in/api/realtime/VehiclePositions.pb?key=mt2giIBCJY1tOjhmMIwfTaTwAXTfPpYR"
+)
+
+# PARETO_SEARCH=1 plans with the multi-criteria (fare, walking) search: more
+# options, but often tens of times slower than the default earliest-arrival rounds
+PARETO_SEARCH = os.environ.get('PARETO_SEARCH', '').lower() in ('1', 'true', 'yes')
 
 class SimpleRoutePlanner:
     """
@@ -23,21 +48,71 @@ class SimpleRoutePlanner:
         self.buses = []
         self.routes = {}
         self.last_update = None
+        self.fetch_on_demand = True     # False when something else keeps the feed fresh
+        self.pareto_search = PARETO_SEARCH
         self.route_mapper = get_route_mapper()
         self.metro_planner = get_metro_planner()
         self.arrival_predictor = get_arrival_predictor()
+        self.plan_cache = PlanCache()
+        self.position_log = get_position_log()
+        self.arrival_boards = ArrivalBoards(self.route_mapper)
+        
+        # Shared mode: the ingest process fetches the feed, logs positions
+        # and saves speed profiles; this process only reads its snapshots
+        self.shared_feed = FeedReader(feed_path()) if shared_mode() else None
+        if self.shared_feed is not None:
+            self.arrival_predictor.profiles.path = None
+        self._warm_start()
     
     def update_realtime_data(self):
-        """Fetch latest bus positions"""
+        """Fetch latest bus positions (in shared mode, read the published snapshot)"""
+        if self.shared_feed is not None:
+            return self.ingest_shared() is not None
         try:
-            from google.transit import gtfs_realtime_pb2
-            
-            response = requests.get(REALTIME_API, timeout=10)
+            with metrics.FEED_STAGE.time('fetch'):
+                response = requests.get(REALTIME_API, timeout=10)
             if response.status_code != 200:
                 return False
             
+            self.ingest_feed(response.content)
+            return True
+            
+        except Exception as e:
+            print(f"Error updating realtime data: {e}")
+            return False
+    
+    @traced
+    def refresh_if_stale(self):
+        """Fetch the feed if the last update is over a minute old (and fetching on demand)"""
+        if self.shared_feed is not None:
+            self.ingest_shared()
+        elif self.fetch_on_demand and (not self.last_update or (datetime.now() - self.last_update).seconds > 60):
+            self.update_realtime_data()
+    
+    def ingest_shared(self):
+        """Ingest the published snapshot if it is new; returns its content or None"""
+        try:
+            content = self.shared_feed.read_if_newer()
+            if content is not None:
+                self.ingest_feed(content)
+            return content
+        except Exception as e:
+            print(f"⚠ Could not read shared feed snapshot: {e}")
+            return None
+    
+    @traced
+    def ingest_feed(self, content):
+        """
+        Replace the live bus state with a raw GTFS-RT VehiclePositions message
+        
+        update_realtime_data() feeds it from the live API; recorded snapshots
+        can be injected directly (see feed_replay). Raises on a bad message.
+        """
+        from google.transit import gtfs_realtime_pb2
+        
+        with metrics.FEED_STAGE.time('parse'):
             feed = gtfs_realtime_pb2.FeedMessage()
-            feed.ParseFromString(response.content)
+            feed.ParseFromString(content)
             
             self.buses = []
             self.routes = {}
@@ -50,6 +125,7 @@ class SimpleRoutePlanner:
                         "lat": v.position.latitude,
                         "lon": v.position.longitude,
                         "route_id": v.trip.route_id,
+                        "trip_id": v.trip.trip_id,
                         "timestamp": v.timestamp,
                     }
                     self.buses.append(bus_data)
@@ -59,14 +135,78 @@ class SimpleRoutePlanner:
                     if route_id not in self.routes:
                         self.routes[route_id] = []
                     self.routes[route_id].append(bus_data)
-            
-            self.last_update = datetime.now()
-            return True
-            
+        
+        with metrics.FEED_STAGE.time('match_shapes'):
+            self._match_to_shapes()
+        
+        # Every report feeds the speed history, not just those asked about,
+        # and new ones the on-disk position log (kept by the ingest process
+        # in shared mode); repeats of a vehicle's last report are not logged
+        feed_time = feed.header.timestamp or int(time.time())
+        with metrics.FEED_STAGE.time('predictor'):
+            recorded = self.arrival_predictor.update_from_feed(self.buses, feed_time)
+        if self.shared_feed is None:
+            try:
+                with metrics.FEED_STAGE.time('position_log'):
+                    new = [self.buses[i] for i in recorded.tolist()]
+                    self.position_log.append(
+                        [bus['id'] for bus in new],
+                        [bus['route_id'] for bus in new],
+                        [bus['lat'] for bus in new],
+                        [bus['lon'] for bus in new],
+                        [bus['timestamp'] or feed_time for bus in new]
+                    )
+            except Exception as e:
+                print(f"⚠ Could not log vehicle positions: {e}")
+        
+        # Arrival queries read boards computed here, once per refresh
+        try:
+            with metrics.FEED_STAGE.time('arrival_boards'):
+                self.arrival_boards.refresh(self.buses, self.arrival_predictor, feed_time)
         except Exception as e:
-            print(f"Error updating realtime data: {e}")
-            return False
+            print(f"⚠ Could not refresh arrival boards: {e}")
+        
+        metrics.FEED_BYTES.set(len(content))
+        metrics.FEED_VEHICLES.set(len(self.buses))
+        metrics.FEED_TIMESTAMP.set(feed_time)
+        self.last_update = datetime.now()
+        return len(self.buses)
+    
+    def _warm_start(self):
+        """Seed the arrival predictor with the last few minutes of logged positions"""
+        try:
+            n = self.arrival_predictor.warm_start(self.position_log.read_recent())
+            if n:
+                print(f"✓ Warm-started vehicle history from {n:,} logged positions")
+        except Exception as e:
+            print(f"⚠ Could not warm-start vehicle history: {e}")
+    
+    def _match_to_shapes(self):
+        """Place every live bus on its trip's route shape, in one vectorized pass"""
+        shape_index = get_shape_index()
+        if shape_index is None or not self.buses:
+            return
+        
+        try:
+            matches = shape_index.match_vehicles(
+                [bus['trip_id'] for bus in self.buses],
+                [bus['route_id'] for bus in self.buses],
+                np.array([bus['lat'] for bus in self.buses]),
+                np.array([bus['lon'] for bus in self.buses])
+            )
+        except Exception as e:
+            print(f"Map-matching error: {e}")
+            return
+        
+        shape_ids = shape_index.shape_ids
+        for bus, shape, distance_m, progress in zip(
+                self.buses, matches['shape'].tolist(), matches['distance_m'].tolist(), matches['progress'].tolist()):
+            if shape >= 0:
+                bus['shape_id'] = shape_ids[shape]
+                bus['shape_dist_km'] = round(distance_m / 1000.0, 3)
+                bus['progress'] = round(progress, 3)
     
+    @traced
     def find_nearby_buses(self, lat, lon, radius_km=2.0):
         """Find buses within radius of a location"""
         nearby = []
@@ -83,6 +223,7 @@ class SimpleRoutePlanner:
         nearby.sort(key=lambda x: x['distance_km'])
         return nearby
     
+    @traced
     def find_routes_between_points(self, start_lat, start_lon, end_lat, end_lon, max_distance_km=3.0):
         """Find routes that pass near both start and end points"""
         routes_near_start = {}
@@ -163,6 +304,7 @@ class SimpleRoutePlanner:
         
         return results
     
+    @traced
     def plan_route(self, start_lat, start_lon, end_lat, end_lon, preference='fastest'):
         """
         Plan a route using available real-time bus data
@@ -174,57 +316,341 @@ class SimpleRoutePlanner:
         """
         
         # Update data if stale
-        if not self.last_update or (datetime.now() - self.last_update).seconds > 60:
-            self.update_realtime_data()
+        self.refresh_if_stale()
+        
+        # Nearby requests for the same trip in the same time bucket share
+        # their options; the preference only picks from them
+        static_version = get_transit_db().version
+        result = self.plan_cache.get(start_lat, start_lon, end_lat, end_lon,
+                                     static_version, self.last_update)
+        if result is None:
+            result = self._plan_route(start_lat, start_lon, end_lat, end_lon)
+            valid_until = result.pop('valid_until', None)
+            self.plan_cache.put(start_lat, start_lon, end_lat, end_lon,
+                                static_version, self.last_update, result, valid_until=valid_until)
+        with tracing.stage('ranking'):
+            return self._select(result, preference)
+    
+    @traced
+    def _plan_route(self, start_lat, start_lon, end_lat, end_lon):
+        """
+        All route options on the current live data, not yet ranked
         
+        Scheduled options come with 'valid_until', the epoch time after
+        which the earliest one can no longer be caught.
+        """
         # Calculate direct distance
         direct_distance = geodesic((start_lat, start_lon), (end_lat, end_lon)).km
         
-        # Find routes that pass near both points
-        candidate_routes = self.find_routes_between_points(start_lat, start_lon, end_lat, end_lon, max_distance_km=2.0)
+        # Use the static bus + metro timetable when it is loaded
+        router = get_raptor_router()
+        if router is not None:
+            routes, valid_until = self._plan_with_timetable(router, start_lat, start_lon, end_lat, end_lon)
+            if routes:
+                return {'routes': routes, 'valid_until': valid_until}
+        
+        # Fall back to estimates: bus/metro combinations from scheduled run
+        # times, and routes inferred from live bus positions
+        network_routes, valid_until = [], None
+        network = get_network()
+        if network is not None:
+            network_routes, valid_until = self._plan_on_network(network, start_lat, start_lon, end_lat, end_lon)
+        
+        result = self._plan_estimated(start_lat, start_lon, end_lat, end_lon, direct_distance,
+                                      network_routes)
+        if valid_until is not None and result.get('routes'):
+            result['valid_until'] = valid_until
+        return result
+    
+    def plan_routes_batch(self, pairs, preference='fastest'):
+        """
+        Plan many (start_lat, start_lon, end_lat, end_lon) pairs, sharing work
         
-        if not candidate_routes:
-            # Try with larger radius
-            candidate_routes = self.find_routes_between_points(start_lat, start_lon, end_lat, end_lon, max_distance_km=4.0)
+        Live data is refreshed at most once, destinations are snapped to stops
+        in one vectorized pass, and pairs sharing an origin share one timetable,
+        network and metro search. Yields (index, result) as each origin's group
+        completes, where result is what plan_route() returns for that pair.
+        """
+        self.refresh_if_stale()
+        
+        pairs = np.asarray(pairs, dtype=np.float64).reshape(-1, 4)
+        groups = {}
+        for i, origin in enumerate(np.round(pairs[:, :2], 5).tolist()):
+            groups.setdefault(tuple(origin), []).append(i)
+        
+        router = get_raptor_router()
+        network = get_network()
+        egress = None
+        if network is not None:
+            egress = points_within(pairs[:, 2], pairs[:, 3], network.stop_lat, network.stop_lon, MAX_WALK_KM)
+        departure = datetime.now()
+        
+        for members in groups.values():
+            start_lat, start_lon = pairs[members[0], 0], pairs[members[0], 1]
+            end_lat, end_lon = pairs[members, 2], pairs[members, 3]
+            group_egress = [egress[i] for i in members] if egress is not None else None
+            
+            timetable_routes = [[] for _ in members]
+            if router is not None:
+                try:
+                    with tracing.stage('timetable_search'):
+                        plans = router.plan_many(start_lat, start_lon, end_lat, end_lon, departure,
+                                                 egress=group_egress)
+                    with tracing.stage('response_building'):
+                        timetable_routes = [[self._create_transit_route(journey, i + 1)
+                                             for i, journey in enumerate(journeys)] for journeys in plans]
+                except Exception as e:
+                    print(f"Timetable planning error: {e}")
+            
+            # Estimated fallbacks, searched once for every pair still without a route
+            missing = [j for j, routes in enumerate(timetable_routes) if not routes]
+            network_routes = {}
+            metro_routes = {}
+            if missing and network is not None:
+                try:
+                    with tracing.stage('network_search'):
+                        plans = network.plan_many(start_lat, start_lon, end_lat[missing], end_lon[missing],
+                                                  departure, egress=[group_egress[j] for j in missing])
+                    with tracing.stage('response_building'):
+                        network_routes = dict(zip(missing, (self._network_routes(journeys) for journeys in plans)))
+                except Exception as e:
+                    print(f"Network planning error: {e}")
+            if missing:
+                try:
+                    with tracing.stage('metro_search'):
+                        plans = self.metro_planner.plan_metro_routes(
+                            start_lat, start_lon, list(zip(end_lat[missing], end_lon[missing]))
+                        )
+                    metro_routes = dict(zip(missing, plans))
+                except Exception as e:
+                    print(f"Metro planning error: {e}")
+            
+            for j, i in enumerate(members):
+                try:
+                    if timetable_routes[j]:
+                        result = {'routes': timetable_routes[j]}
+                    else:
+                        direct_distance = geodesic((start_lat, start_lon), (end_lat[j], end_lon[j])).km
+                        result = self._plan_estimated(
+                            start_lat, start_lon, end_lat[j], end_lon[j], direct_distance,
+                            network_routes.get(j, []), metro_routes.get(j, [])
+                        )
+                    with tracing.stage('ranking'):
+                        result = self._select(result, preference)
+                except Exception as e:
+                    result = {'error': str(e)}
+                yield i, result
+    
+    @traced
+    def _plan_estimated(self, start_lat, start_lon, end_lat, end_lon, direct_distance,
+                        network_routes, metro_routes=None):
+        """Combine network estimates with live-bus and metro routes"""
+        routes = list(network_routes)
         
-        if not candidate_routes:
+        # Find routes that pass near both points
+        with tracing.stage('candidate_search'):
+            candidate_routes = self.find_routes_between_points(start_lat, start_lon, end_lat, end_lon, max_distance_km=2.0)
+            
+            if not candidate_routes:
+                # Try with larger radius
+                with tracing.span('retry_4km'):
+                    candidate_routes = self.find_routes_between_points(start_lat, start_lon, end_lat, end_lon, max_distance_km=4.0)
+        
+        if not candidate_routes and not routes:
             # No direct routes found - provide alternatives
             return self._create_no_route_response(start_lat, start_lon, end_lat, end_lon, direct_distance)
         
         # Create route options from candidates (up to 3)
-        routes = []
-        for i, candidate in enumerate(candidate_routes[:3]):
-            route = self._create_bus_route_v2(
-                candidate, 
-                start_lat, start_lon, 
-                end_lat, end_lon,
-                direct_distance,
-                i + 1
-            )
-            routes.append(route)
+        with tracing.stage('response_building'):
+            for i, candidate in enumerate(candidate_routes[:3]):
+                route = self._create_bus_route_v2(
+                    candidate, 
+                    start_lat, start_lon, 
+                    end_lat, end_lon,
+                    direct_distance,
+                    i + 1
+                )
+                routes.append(route)
         
         # Also try to find metro routes
+        if metro_routes is None:
+            try:
+                with tracing.stage('metro_search'):
+                    metro_routes = self.metro_planner.plan_metro_route(
+                        start_lat, start_lon, 
+                        end_lat, end_lon
+                    )
+            except Exception as e:
+                print(f"Metro planning error: {e}")
+                metro_routes = []
+        routes.extend(metro_routes)
+        
+        # All options (mix of bus and metro); the preference picks from them
+        return {'routes': routes}
+    
+    def _select(self, result, preference):
+        """Top options of the result's Pareto frontier for the user's preference"""
+        if 'routes' not in result:
+            return result
+        return {**result, 'routes': select_routes(result['routes'], preference)}
+    
+    @traced
+    def _plan_with_timetable(self, router, start_lat, start_lon, end_lat, end_lon, max_transfers=3):
+        """
+        Plan bus + metro journeys with the RAPTOR router, and their valid_until
+        
+        One journey per number of transfers that arrives sooner; with
+        pareto_search, the full frontier on arrival, fare and walking.
+        """
+        departure = datetime.now()
+        search = router.plan_pareto if self.pareto_search else router.plan
         try:
-            metro_routes = self.metro_planner.plan_metro_route(
-                start_lat, start_lon, 
-                end_lat, end_lon
-            )
-            routes.extend(metro_routes)
+            with tracing.stage('timetable_search'):
+                journeys = search(
+                    start_lat, start_lon,
+                    end_lat, end_lon,
+                    departure=departure,
+                    max_transfers=max_transfers
+                )
         except Exception as e:
-            print(f"Metro planning error: {e}")
-        
-        # Sort by preference
-        if preference == 'fastest':
-            routes.sort(key=lambda x: x['totalDuration'])
-        elif preference == 'cheapest':
-            routes.sort(key=lambda x: x['totalCost'])
-        elif preference == 'balanced':
-            # Balance between time and cost
-            routes.sort(key=lambda x: x['totalDuration'] * 0.6 + x['totalCost'] * 0.4)
-        
-        # Return top 5 routes (mix of bus and metro)
-        return {'routes': routes[:5]}
+            print(f"Timetable planning error: {e}")
+            return [], None
+        
+        with tracing.stage('response_building'):
+            routes = [self._create_transit_route(journey, i + 1) for i, journey in enumerate(journeys)]
+        return routes, self._valid_until(journeys, departure)
+    
+    @traced
+    def _plan_on_network(self, network, start_lat, start_lon, end_lat, end_lon):
+        """Plan a bus + metro journey on the network's scheduled run times and modelled waits"""
+        departure = datetime.now()
+        try:
+            with tracing.stage('network_search'):
+                journeys = network.plan(start_lat, start_lon, end_lat, end_lon, departure=departure)
+        except Exception as e:
+            print(f"Network planning error: {e}")
+            return [], None
+        with tracing.stage('response_building'):
+            routes = self._network_routes(journeys)
+        return routes, self._valid_until(journeys, departure)
+    
+    def _valid_until(self, journeys, departure):
+        """Epoch time of the last moment to leave for the earliest first vehicle, or None"""
+        leave_by = []
+        for journey in journeys:
+            walked = journey['departure']
+            for leg in journey['legs']:
+                if leg['mode'] != 'WALK':
+                    # Its departure minus the walk to it
+                    leave_by.append(leg['departure'] - (walked - journey['departure']))
+                    break
+                walked = leg['arrival']
+        if not leave_by:
+            return None
+        return departure.timestamp() + min(leave_by) - journeys[0]['departure']
+    
+    @traced
+    def _network_routes(self, journeys):
+        """Route objects for network journeys, marked as estimates"""
+        routes = []
+        for i, journey in enumerate(journeys):
+            route = self._create_transit_route(journey, i + 1, source='GTFS network (estimated waits)')
+            route['id'] = f'network-{i + 1}'
+            route['confidenceScore'] = 0.6
+            route['realtimeInfo'] = '✓ Estimated from scheduled run times and typical waits'
+            routes.append(route)
+        return routes
     
+    @traced
+    def _create_transit_route(self, journey, route_num, source='Static GTFS timetable (RAPTOR)'):
+        """Create a route object from a RAPTOR (or network) journey"""
+        segments = []
+        names = []
+        
+        for leg in journey['legs']:
+            duration = max(0, int(round((leg['arrival'] - leg['departure']) / 60)))
+            
+            if leg['mode'] == 'WALK':
+                segments.append({
+                    'mode': 'WALK',
+                    'details': f"Walk to {leg['to']['name']} ({leg['distance_km']:.2f} km)",
+                    'duration': duration,
+                    'distance': leg['distance_km'],
+                    'path': [
+                        {'lat': leg['from']['lat'], 'lng': leg['from']['lon']},
+                        {'lat': leg['to']['lat'], 'lng': leg['to']['lon']}
+                    ]
+                })
+                continue
+            
+            stops = leg['stops']
+            if leg['mode'] == 'METRO':
+                line_id = leg['route_id'][len(METRO_ID_PREFIX):]
+                display_name = self.route_mapper.get_route_name(line_id, mode='metro')
+                details = f'Delhi Metro: {display_name}'
+                realtime_info = f'✓ {len(stops)} stations, scheduled service'
+            else:
+                route_info = self.route_mapper.get_route_info(leg['route_id'], mode='bus')
+                route_number = route_info.get('route_number') or leg['route_id']
+                display_name = f"DTC Bus {route_number}"
+                details = display_name
+                live_buses = len(self.routes.get(leg['route_id'], []))
+                realtime_info = (f'✓ Live tracking: {live_buses} buses on this route' if live_buses
+                                 else '✓ Scheduled service')
+            names.append(display_name)
+            
+            segments.append({
+                'mode': leg['mode'],
+                'details': details,
+                'duration': duration,
+                'distance': round(leg['distance_km'], 2),
+                'realtimeInfo': realtime_info,
+                'path': [{'lat': stop['lat'], 'lng': stop['lon']} for stop in stops],
+                'stopsList': [
+                    {
+                        'name': stops[0]['name'],
+                        'arrivalTime': format_seconds(stops[0]['departure']),
+                        'platform': 'Check station signage' if leg['mode'] == 'METRO' else f'Look for {display_name}'
+                    },
+                    {
+                        'name': stops[-1]['name'],
+                        'arrivalTime': format_seconds(stops[-1]['arrival']),
+                        'platform': ''
+                    }
+                ],
+                'stations': [stop['name'] for stop in stops]
+            })
+        
+        # Bus fare per boarding, DMRC slab fare per metro trip
+        cost = journey_fare(journey['legs'])
+        
+        modes = {leg['mode'] for leg in journey['legs'] if leg['mode'] != 'WALK'}
+        transfers = journey['transfers']
+        total_duration = int(round((journey['arrival'] - journey['departure']) / 60))
+        route_name = ' → '.join(names)
+        
+        return {
+            'id': f'transit-{route_num}',
+            'routeName': route_name,
+            'totalDuration': total_duration,
+            'totalCost': cost,
+            'comfortScore': max(4, (9 if modes == {'METRO'} else 7) - transfers),
+            'confidenceScore': 0.85,
+            'summary': f"{route_name} - arrive {format_seconds(journey['arrival'])}, "
+                       f"{transfers} transfer{'s' if transfers != 1 else ''}",
+            'realtimeInfo': f"✓ Timetable route departing {format_seconds(journey['departure'])}",
+            'routeDetails': {
+                'mode': 'multimodal' if len(modes) > 1 else next(iter(modes), 'walk').lower(),
+                'transfers': transfers,
+                'departure_time': format_seconds(journey['departure']),
+                'arrival_time': format_seconds(journey['arrival']),
+                'is_realtime': False,
+                'source': source
+            },
+            'segments': segments
+        }
+    
+    @traced
     def _create_bus_route_v2(self, candidate, start_lat, start_lon, end_lat, end_lon, distance, route_num):
         """Create a route object from a candidate (v2 with improved data)"""
         
@@ -232,26 +658,45 @@ class SimpleRoutePlanner:
         start_bus = candidate['start_bus']
         end_bus = candidate['end_bus']
         
-        # Calculate actual bus travel distance (between the two bus positions)
-        bus_distance = geodesic(
-            (start_bus['lat'], start_bus['lon']),
-            (end_bus['lat'], end_bus['lon'])
-        ).km
+        # Calculate actual bus travel distance (between the two bus positions):
+        # along the route shape when both buses are matched onto the same one
+        bus_path = [
+            {'lat': start_bus['lat'], 'lng': start_bus['lon']},
+            {'lat': end_bus['lat'], 'lng': end_bus['lon']}
+        ]
+        shape_index = get_shape_index()
+        shape = shape_index.find_shape(start_bus.get('shape_id')) if shape_index is not None else None
+        if (shape is not None and start_bus['shape_id'] == end_bus.get('shape_id')
+                and end_bus['shape_dist_km'] > start_bus['shape_dist_km']):
+            bus_distance = round(end_bus['shape_dist_km'] - start_bus['shape_dist_km'], 3)
+            bus_path = [
+                {'lat': lat, 'lng': lon}
+                for lat, lon in shape_index.path_between(
+                    shape, start_bus['shape_dist_km'] * 1000, end_bus['shape_dist_km'] * 1000
+                )
+            ]
+        else:
+            bus_distance = geodesic(
+                (start_bus['lat'], start_bus['lon']),
+                (end_bus['lat'], end_bus['lon'])
+            ).km
         
         # Calculate walking distance to boarding point
         walk_to_start = start_bus['distance_to_start']
         walk_from_end = end_bus['distance_to_end']
         
-        # Estimate travel time (assuming 20 km/h average speed in Delhi traffic)
-        travel_time_min = int((bus_distance / 20.0) * 60)
-        wait_time_min = 5  # Assume 5 min wait
-        walk_time_start = int(walk_to_start * 12)  # 12 min per km walking
-        walk_time_end = int(walk_from_end * 12)
+        # Estimate travel time from the route's observed speed at this time
+        # of week, and the walking and waiting models
+        bus, walk = MODES['BUS'], MODES['WALK']
+        travel_time_min = int(bus_distance / self.arrival_predictor.profiles.speed(route_id) * 60)
+        wait_time_min = int(bus.wait_seconds / 60)
+        walk_time_start = int(walk.travel_seconds(walk_to_start) / 60)
+        walk_time_end = int(walk.travel_seconds(walk_from_end) / 60)
         
         total_duration = travel_time_min + wait_time_min + walk_time_start + walk_time_end
         
         # Estimate cost (₹10 base + ₹5 per km for bus)
-        cost = 10 + int(bus_distance * 5)
+        cost = bus.fare(bus_distance)
         
         # Get route name from GTFS data
         route_info = self.route_mapper.get_route_info(route_id, mode='bus')
@@ -288,10 +733,7 @@ class SimpleRoutePlanner:
             'duration': travel_time_min,
             'distance': bus_distance,
             'realtimeInfo': f'✓ Live tracking: {candidate["total_buses"]} buses on this route',
-            'path': [
-                {'lat': start_bus['lat'], 'lng': start_bus['lon']},
-                {'lat': end_bus['lat'], 'lng': end_bus['lon']}
-            ],
+            'path': bus_path,
             'stopsList': [
                 {
                     'name': f'Board near {self._get_area_name(start_bus["lat"], start_bus["lon"])}',
@@ -349,6 +791,7 @@ class SimpleRoutePlanner:
         # For now, just return coordinates
         return f"({lat:.4f}, {lon:.4f})"
     
+    @traced
     def get_realtime_arrivals(self, lat, lon, route_id=None, limit=5):
         """
         Get real-time arrival predictions for buses near a location
@@ -362,46 +805,80 @@ class SimpleRoutePlanner:
             List of arrival predictions with ETA
         """
         # Update data if stale
-        if not self.last_update or (datetime.now() - self.last_update).seconds > 60:
-            self.update_realtime_data()
-        
-        # Find nearby buses
-        nearby_buses = self.find_nearby_buses(lat, lon, radius_km=3.0)
-        
-        # Filter by route if specified
-        if route_id:
-            nearby_buses = [b for b in nearby_buses if b['route_id'] == route_id]
+        self.refresh_if_stale()
+        
+        # Near a stop: read the precomputed boards of the stops around it.
+        # Boards only hold buses placed on a pattern, so buses on routes or
+        # trips missing from the static data are predicted one by one
+        stops = self.arrival_boards.stops_near(lat, lon)
+        if len(stops):
+            arrivals = self.arrival_boards.arrivals(stops, limit, route_id)
+            if len(arrivals) < limit:
+                on_board = {arrival['bus_id'] for arrival in arrivals}
+                arrivals += self._predicted_arrivals(lat, lon, route_id, limit, exclude=on_board)
+                arrivals.sort(key=lambda arrival: arrival['eta_minutes'])
+            return arrivals[:limit]
+        
+        return self._predicted_arrivals(lat, lon, route_id, limit)
+    
+    def _predicted_arrivals(self, lat, lon, route_id, limit, exclude=()):
+        """Arrivals of nearby buses predicted from their positions, skipping the ids in exclude"""
+        # Candidate buses: every vehicle of the route, or all of them
+        buses = self.routes.get(route_id, []) if route_id else self.buses
+        if exclude:
+            buses = [bus for bus in buses if bus['id'] not in exclude]
+        if not buses:
+            return []
+        
+        # Predict all candidates at once; keep nearby buses that are
+        # approaching (or unknown) with a reasonable ETA
+        prediction = self.arrival_predictor.predict_batch(buses, lat, lon)
+        keep = np.flatnonzero(
+            (prediction['distance_km'] <= 3.0)
+            & np.isin(prediction['status'], ['approaching', 'unknown'])
+            & (prediction['eta_minutes'] < 60)
+        )
+        keep = keep[np.argsort(prediction['eta_minutes'][keep], kind='stable')][:limit]
         
-        # Get arrival predictions
         arrivals = []
-        for bus in nearby_buses[:limit * 2]:  # Get more to filter
-            prediction = self.arrival_predictor.predict_arrival_time(bus, lat, lon)
+        for i in keep.tolist():
+            bus = buses[i]
+            eta_minutes = int(prediction['eta_minutes'][i])
+            route_info = self.route_mapper.get_route_info(bus['route_id'], mode='bus')
             
-            # Only include buses that are approaching or have reasonable ETA
-            if prediction['status'] in ['approaching', 'unknown'] and prediction['eta_minutes'] < 60:
-                route_info = self.route_mapper.get_route_info(bus['route_id'], mode='bus')
-                
-                arrivals.append({
-                    'route_id': bus['route_id'],
-                    'route_name': route_info.get('name', f"Bus {bus['route_id']}"),
-                    'bus_id': bus['id'],
-                    'eta_minutes': prediction['eta_minutes'],
-                    'eta_formatted': self.arrival_predictor.format_arrival_time(prediction['eta_minutes']),
-                    'confidence': prediction['confidence'],
-                    'status': prediction['status'],
-                    'speed_kmh': prediction['speed_kmh'],
-                    'distance_km': prediction['distance_km'],
-                    'current_position': {
-                        'lat': bus['lat'],
-                        'lon': bus['lon']
-                    }
-                })
+            arrivals.append({
+                'route_id': bus['route_id'],
+                'route_name': route_info.get('name', f"Bus {bus['route_id']}"),
+                'bus_id': bus['id'],
+                'eta_minutes': eta_minutes,
+                'eta_formatted': self.arrival_predictor.format_arrival_time(eta_minutes),
+                'confidence': float(prediction['confidence'][i]),
+                'status': str(prediction['status'][i]),
+                'speed_kmh': float(prediction['speed_kmh'][i]),
+                'distance_km': float(prediction['distance_km'][i]),
+                'current_position': {
+                    'lat': bus['lat'],
+                    'lon': bus['lon']
+                }
+            })
+        
+        return arrivals
+    
+    @traced
+    def get_stop_arrivals(self, stop_id, route_id=None, limit=5):
+        """
+        Get real-time arrival predictions at a stop, from its arrival board
         
-        # Sort by ETA
-        arrivals.sort(key=lambda x: x['eta_minutes'])
+        Returns None for an unknown stop, else a list as get_realtime_arrivals
+        """
+        self.refresh_if_stale()
         
-        return arrivals[:limit]
+        stop = self.arrival_boards.stop_index(stop_id)
+        if stop is None:
+            return None
+        return self.arrival_boards.arrivals([stop], limit, route_id)
     
+    @traced
     def _create_no_route_response(self, start_lat, start_lon, end_lat, end_lon, distance):
         """Create response when no direct routes are found"""
         
@@ -0,0 +1,173 @@
+"""
+Observed bus speeds per route and 15-minute time-of-week bucket
+
+Every feed refresh adds the measured speed of each vehicle that reported a
+new position to its route's bucket (and to a city-wide row), as a running
+mean whose weight is capped so profiles keep adapting. Lookups are a few
+array reads: the route's bucket when it has enough samples (or the one
+before it), else the city-wide bucket, else the time-of-day default.
+
+The table is saved next to transit.db every few minutes and reloaded at
+start-up, so predictions do not start cold after a restart.
+"""
+
+import os
+import threading
+import time
+import numpy as np
+from pathlib import Path
+from .transit_db import get_transit_db
+
+BUCKET_MINUTES = 15
+BUCKETS_PER_WEEK = 7 * 24 * 60 // BUCKET_MINUTES
+UTC_OFFSET_SECONDS = 5 * 3600 + 30 * 60     # Buckets are in Delhi local time (IST)
+MIN_SAMPLES = 3             # Samples a bucket needs before it is trusted
+MAX_WEIGHT = 500            # Older samples count as at most this many
+MIN_SPEED_KMH = 1.0         # Slower reports are layovers, not traffic
+MAX_SPEED_KMH = 80.0        # Faster ones are GPS jumps
+SAVE_INTERVAL_SECONDS = 300
+CITY = ''                   # Row of the city-wide profile
+INITIAL_ROWS = 256
+
+
+def week_bucket(epoch_seconds):
+    """Time-of-week bucket (Monday 00:00 local = 0) of epoch seconds"""
+    local = np.asarray(epoch_seconds, dtype=np.int64) + UTC_OFFSET_SECONDS
+    weekday = (local // 86400 + 3) % 7      # 1970-01-01 was a Thursday
+    return weekday * (BUCKETS_PER_WEEK // 7) + local % 86400 // (BUCKET_MINUTES * 60)
+
+
+def default_speed(epoch_seconds):
+    """Speed (km/h) by time of day when nothing has been observed yet"""
+    hour = (np.asarray(epoch_seconds, dtype=np.int64) + UTC_OFFSET_SECONDS) % 86400 // 3600
+    # Peak hours: slower; mid-day: moderate; night: faster
+    peak = ((hour >= 8) & (hour <= 10)) | ((hour >= 17) & (hour <= 20))
+    return np.where(peak, 15.0, np.where((hour > 10) & (hour < 17), 22.0, 30.0))
+
+
+def profiles_path():
+    """Location of the speed profiles stored alongside the database"""
+    return Path(get_transit_db().db_path).with_name('speed_profiles.npz')
+
+
+class SpeedProfiles:
+    """Running mean speed per (route, time-of-week bucket)"""
+
+    def __init__(self, path=None):
+        self.path = Path(path) if path is not None else None
+        self._rows = {}
+        self.mean = np.zeros((0, BUCKETS_PER_WEEK), dtype=np.float32)
+        self.count = np.zeros((0, BUCKETS_PER_WEEK), dtype=np.uint32)
+        self._lock = threading.Lock()
+        self.samples = 0
+        self.last_save = time.time()
+        if self.path is not None and self.path.exists():
+            try:
+                self.load(self.path)
+            except Exception as e:
+                print(f"⚠ Could not load speed profiles from {self.path}: {e}")
+        self._row(CITY)
+
+    def _row(self, key):
+        row = self._rows.get(key)
+        if row is None:
+            row = len(self._rows)
+            if row == len(self.mean):
+                capacity = max(INITIAL_ROWS, 2 * row)
+                self.mean = np.resize(self.mean, (capacity, BUCKETS_PER_WEEK))
+                self.count = np.resize(self.count, (capacity, BUCKETS_PER_WEEK))
+                self.mean[row:] = 0
+                self.count[row:] = 0
+            self._rows[key] = row
+        return row
+
+    def add(self, route_ids, speeds, timestamps):
+        """Merge one feed's measured speeds into the profiles"""
+        speeds = np.asarray(speeds, dtype=np.float64)
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        valid = np.flatnonzero(np.isfinite(speeds) & (speeds >= MIN_SPEED_KMH) & (speeds <= MAX_SPEED_KMH))
+        if len(valid) == 0:
+            return 0
+
+        with self._lock:
+            rows = np.array([self._row(route_ids[i] or CITY) for i in valid.tolist()], dtype=np.int64)
+            buckets = week_bucket(timestamps[valid])
+            values = speeds[valid]
+            cells = np.concatenate([rows, np.full(len(rows), self._rows[CITY])]) * BUCKETS_PER_WEEK \
+                + np.tile(buckets, 2)
+            self._merge(cells, np.tile(values, 2))
+            self.samples += len(valid)
+        return len(valid)
+
+    def _merge(self, cells, values):
+        cells, inverse = np.unique(cells, return_inverse=True)
+        added = np.bincount(inverse)
+        total = np.bincount(inverse, weights=values)
+        mean, count = self.mean.reshape(-1), self.count.reshape(-1)
+        weight = np.minimum(count[cells], MAX_WEIGHT).astype(np.float64)
+        mean[cells] = (mean[cells] * weight + total) / (weight + added)
+        count[cells] = weight + added
+
+    def speeds(self, route_ids, when=None):
+        """Expected speed (km/h) per route at `when` (epoch seconds, default now)"""
+        when = time.time() if when is None else when
+        bucket = int(week_bucket(when))
+        city = self._rows[CITY]
+        rows = np.array([self._rows.get(route_id, city) for route_id in route_ids], dtype=np.int64)
+        speed = np.asarray(default_speed(when), dtype=np.float64) * np.ones(len(rows))
+        # Later lookups win: the route before the city, this bucket before the previous one
+        previous = (bucket - 1) % BUCKETS_PER_WEEK
+        for row_set in (np.full(len(rows), city), rows):
+            for b in (previous, bucket):
+                known = self.count[row_set, b] >= MIN_SAMPLES
+                speed[known] = self.mean[row_set[known], b]
+        return speed
+
+    def speed(self, route_id, when=None):
+        return float(self.speeds([route_id], when)[0])
+
+    def maybe_save(self):
+        """Save if SAVE_INTERVAL_SECONDS have passed since the last save"""
+        if self.path is not None and time.time() - self.last_save >= SAVE_INTERVAL_SECONDS:
+            try:
+                self.save(self.path)
+            except Exception as e:
+                print(f"⚠ Could not save speed profiles: {e}")
+
+    def save(self, path):
+        """Write atomically (temp file + rename)"""
+        path = Path(path)
+        with self._lock:
+            n = len(self._rows)
+            keys = sorted(self._rows, key=self._rows.get)
+            tmp_path = path.with_name(f"{path.name}.tmp-{os.getpid()}")
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, keys=np.array(keys, dtype=str), mean=self.mean[:n], count=self.count[:n])
+            os.replace(tmp_path, path)
+            self.last_save = time.time()
+
+    def load(self, path):
+        with np.load(path) as data:
+            keys = data['keys'].tolist()
+            self.mean = data['mean'].astype(np.float32)
+            self.count = data['count'].astype(np.uint32)
+        self._rows = {key: row for row, key in enumerate(keys)}
+
+    def stats(self):
+        observed = self.count[:len(self._rows)] > 0
+        return {
+            'routes': len(self._rows) - 1,
+            'buckets_observed': int(observed.sum()),
+            'samples_added': self.samples,
+        }
+
+
+# Singleton instance
+_profiles = None
+
+def get_speed_profiles():
+    """Get or create the speed profile store"""
+    global _profiles
+    if _profiles is None:
+        _profiles = SpeedProfiles(profiles_path())
+    return _profiles
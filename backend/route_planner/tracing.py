@@ -0,0 +1,189 @@
+"""
+Opt-in per-request traces and sampled profiles
+
+With REQUEST_TRACE=1, a request that asks for it (`?trace=1` or an
+`X-Trace: 1` header) gets `metadata.trace` back: nested spans with their
+milliseconds, through SimpleRoutePlanner, MetroPlanner, ArrivalPredictor
+and GTFSRouteMapper. Repeated calls under the same parent (route name
+lookups, one per option) merge into one span with a call count.
+
+Spans come from @traced methods and from stage() blocks; stages also feed
+the planner stage histograms in metrics, traced or not. Without an active
+trace a @traced call costs one ContextVar lookup.
+
+With PROFILE_SAMPLE_RATE > 0, that share of requests runs under cProfile
+(one at a time); profiles of requests slower than PROFILE_SLOW_SECONDS are
+kept in `profiles/` next to transit.db, newest MAX_PROFILES only:
+
+    python -m pstats profiles/<time>-plan-route-<ms>ms.prof
+"""
+
+import cProfile
+import contextvars
+import functools
+import os
+import random
+import threading
+import time
+from pathlib import Path
+from . import metrics
+
+ENABLED = os.environ.get('REQUEST_TRACE', '').lower() in ('1', 'true', 'yes')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_SLOW_SECONDS = float(os.environ.get('PROFILE_SLOW_SECONDS', 1.0))
+MAX_PROFILES = 100
+
+_active = contextvars.ContextVar('trace_span', default=None)
+_profiling = threading.Lock()
+
+
+class Span:
+    """Time spent in one named block under a parent, over all its calls"""
+
+    __slots__ = ('name', 'seconds', 'calls', 'children', '_by_name')
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.calls = 0
+        self.children = []
+        self._by_name = {}
+
+    def child(self, name):
+        span = self._by_name.get(name)
+        if span is None:
+            span = self._by_name[name] = Span(name)
+            self.children.append(span)
+        return span
+
+    def to_dict(self):
+        span = {'name': self.name, 'ms': round(self.seconds * 1000, 3)}
+        if self.calls != 1:
+            span['calls'] = self.calls
+        if self.children:
+            span['children'] = [child.to_dict() for child in self.children]
+        return span
+
+
+class _Block:
+    __slots__ = ('name', 'histogram', 'span', 'token', 'started')
+
+    def __init__(self, name, histogram=None):
+        self.name = name
+        self.histogram = histogram
+        self.span = None
+
+    def __enter__(self):
+        parent = _active.get()
+        if parent is not None:
+            self.span = parent.child(self.name)
+            self.token = _active.set(self.span)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.started
+        if self.histogram is not None:
+            self.histogram.observe(elapsed, self.name)
+        if self.span is not None:
+            self.span.seconds += elapsed
+            self.span.calls += 1
+            _active.reset(self.token)
+
+
+def span(name):
+    """Context manager timing a block as a child of the active span"""
+    return _Block(name)
+
+
+def stage(name):
+    """A planner stage: a span that is also observed by metrics.PLANNER_STAGE"""
+    return _Block(name, metrics.PLANNER_STAGE)
+
+
+def traced(method):
+    """Record calls to a method (by qualified name) while a trace is active"""
+    name = method.__qualname__
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        if _active.get() is None:
+            return method(*args, **kwargs)
+        with _Block(name):
+            return method(*args, **kwargs)
+    return wrapper
+
+
+def profile_dir():
+    """Location of kept profiles alongside the database"""
+    from .transit_db import get_transit_db
+
+    return Path(get_transit_db().db_path).with_name('profiles')
+
+
+class RequestTrace:
+    """
+    Root of one request: its trace when asked for (and enabled), and the
+    sampled profile. Use as a context manager around the request's work.
+    """
+
+    def __init__(self, name, trace=False):
+        self.name = name
+        self.root = Span(name) if trace and ENABLED else None
+        self.profile = None
+        self.profile_path = None
+
+    @property
+    def active(self):
+        return self.root is not None
+
+    def __enter__(self):
+        if self.root is not None:
+            self._token = _active.set(self.root)
+        if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE and _profiling.acquire(blocking=False):
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.started
+        if self.profile is not None:
+            self.profile.disable()
+            _profiling.release()
+            if elapsed >= PROFILE_SLOW_SECONDS:
+                self._keep_profile(elapsed)
+        if self.root is not None:
+            self.root.seconds = elapsed
+            self.root.calls = 1
+            _active.reset(self._token)
+
+    def call(self, fn, *args, **kwargs):
+        """fn(*args, **kwargs) inside this trace, e.g. on a worker thread"""
+        with self:
+            return fn(*args, **kwargs)
+
+    def _keep_profile(self, elapsed):
+        try:
+            directory = profile_dir()
+            directory.mkdir(parents=True, exist_ok=True)
+            path = directory / f"{int(time.time() * 1000)}-{self.name}-{int(elapsed * 1000)}ms.prof"
+            self.profile.dump_stats(path)
+            self.profile_path = path
+            for old in sorted(directory.glob('*.prof'))[:-MAX_PROFILES]:
+                old.unlink()
+            print(f"⚠ Slow request ({elapsed:.2f}s) profiled to {path}")
+        except Exception as e:
+            print(f"⚠ Could not save request profile: {e}")
+
+    def to_dict(self):
+        trace = self.root.to_dict() if self.root is not None else {}
+        if self.profile_path is not None:
+            trace['profile'] = self.profile_path.name
+        return trace or None
+
+
+def requested(args, headers):
+    """Whether a request's query string or headers ask for a trace"""
+    flag = args.get('trace') or headers.get('X-Trace') or ''
+    return ENABLED and flag.lower() in ('1', 'true', 'yes')
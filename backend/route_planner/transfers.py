@@ -0,0 +1,154 @@
+"""
+Precomputed stop-to-stop walking transfers
+
+All stop pairs within a walking radius are found once, when the database
+is built, with a uniform grid spatial index (cell size = radius, so only
+the 3x3 neighbouring cells need to be compared). The result is stored as a
+compact CSR table next to transit.db: for stop i, its neighbours are
+indices[indptr[i]:indptr[i + 1]], with walk times in walk_seconds.
+
+Stops of both feeds are indexed together, so bus stop <-> metro station
+interchanges come out of the same pass.
+"""
+
+import os
+import numpy as np
+from pathlib import Path
+from .geo import haversine_km, project_m
+from .shared_snapshot import load_npz
+
+DEFAULT_RADIUS_M = 500
+WALK_SPEED_KMH = 5.0        # 12 min per km, as elsewhere in the planner
+
+
+def transfers_path(db_path):
+    """Location of the transfer table stored alongside a database"""
+    db_path = Path(db_path)
+    return db_path.with_name(f"{db_path.stem}.transfers.npz")
+
+
+class TransferTable:
+    """Walking links between nearby stops in CSR form"""
+
+    def __init__(self, indptr, indices, walk_seconds, distance_m, radius_m, db_version=None):
+        self.indptr = indptr
+        self.indices = indices
+        self.walk_seconds = walk_seconds
+        self.distance_m = distance_m
+        self.radius_m = radius_m
+        self.db_version = db_version
+
+    @property
+    def n_stops(self):
+        return len(self.indptr) - 1
+
+    @property
+    def n_links(self):
+        return len(self.indices)
+
+    @classmethod
+    def build(cls, stop_lat, stop_lon, radius_m=DEFAULT_RADIUS_M, walk_speed_kmh=WALK_SPEED_KMH,
+              db_version=None):
+        """Find all stop pairs within radius_m of each other"""
+        stop_lat = np.asarray(stop_lat, dtype=np.float64)
+        stop_lon = np.asarray(stop_lon, dtype=np.float64)
+        n = len(stop_lat)
+        if n == 0:
+            return cls(np.zeros(1, dtype=np.int64), np.empty(0, dtype=np.int32),
+                       np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32), radius_m, db_version)
+
+        # Grid index: bucket stops by radius-sized cells, sorted by cell key
+        x, y = project_m(stop_lat, stop_lon, np.mean(stop_lat), np.mean(stop_lon))
+        cx = np.floor((x - x.min()) / radius_m).astype(np.int64)
+        cy = np.floor((y - y.min()) / radius_m).astype(np.int64)
+        width = int(cy.max()) + 3
+        keys = cx * width + cy
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+
+        src_parts, dst_parts = [], []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                neighbour = (cx + dx) * width + (cy + dy)
+                lo = np.searchsorted(sorted_keys, neighbour, side='left')
+                hi = np.searchsorted(sorted_keys, neighbour, side='right')
+                counts = hi - lo
+                total = int(counts.sum())
+                if total == 0:
+                    continue
+                src = np.repeat(np.arange(n), counts)
+                offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+                dst = order[np.repeat(lo, counts) + offsets]
+                src_parts.append(src)
+                dst_parts.append(dst)
+
+        src = np.concatenate(src_parts)
+        dst = np.concatenate(dst_parts)
+        keep = src != dst
+        src, dst = src[keep], dst[keep]
+
+        distance_m = haversine_km(stop_lat[src], stop_lon[src], stop_lat[dst], stop_lon[dst]) * 1000.0
+        keep = distance_m <= radius_m
+        src, dst, distance_m = src[keep], dst[keep], distance_m[keep]
+
+        order = np.lexsort((distance_m, src))
+        src, dst, distance_m = src[order], dst[order], distance_m[order]
+        walk_seconds = np.ceil(distance_m / 1000.0 / walk_speed_kmh * 3600).astype(np.int32)
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(src, minlength=n))]).astype(np.int64)
+
+        return cls(indptr, dst.astype(np.int32), walk_seconds, distance_m.astype(np.float32),
+                   radius_m, db_version)
+
+    def neighbours(self, stop):
+        """(stop indices, walk seconds) reachable on foot from a stop"""
+        a, b = self.indptr[stop], self.indptr[stop + 1]
+        return self.indices[a:b], self.walk_seconds[a:b]
+
+    def as_csr(self):
+        """(indptr, indices, walk_seconds) as used by the router"""
+        return self.indptr, self.indices, self.walk_seconds
+
+    def count_between(self, is_group):
+        """Number of links joining a stop in a group to one outside it"""
+        src = np.repeat(np.arange(self.n_stops), np.diff(self.indptr))
+        return int(np.count_nonzero(is_group[src] != is_group[self.indices]))
+
+    def save(self, path):
+        """Write atomically (temp file + rename)"""
+        path = Path(path)
+        tmp_path = path.with_name(f"{path.name}.tmp-{os.getpid()}")
+        with open(tmp_path, 'wb') as f:
+            np.savez(
+                f,
+                indptr=self.indptr,
+                indices=self.indices,
+                walk_seconds=self.walk_seconds,
+                distance_m=self.distance_m,
+                radius_m=np.array(self.radius_m),
+                db_version=np.array(self.db_version or ''),
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with load_npz(path) as data:
+            return cls(
+                indptr=data['indptr'],
+                indices=data['indices'],
+                walk_seconds=data['walk_seconds'],
+                distance_m=data['distance_m'],
+                radius_m=float(data['radius_m']),
+                db_version=str(data['db_version']) or None,
+            )
+
+
+def load_transfers(transit_db, version, n_stops):
+    """Load the transfer table stored next to transit.db if it matches"""
+    path = transfers_path(transit_db.db_path)
+    if not path.exists():
+        return None
+    table = TransferTable.load(path)
+    if (version and table.db_version != version) or table.n_stops != n_stops:
+        print(f"⚠ {path.name} does not match transit.db version {version}, ignoring")
+        return None
+    return table
@@ -0,0 +1,184 @@
+"""
+Read-only access to transit.db that follows atomic rebuilds
+
+GTFSLoader publishes a new database by renaming a fully built file over
+transit.db. Open connections keep reading the old file (its inode stays
+alive until they close), so running servers only need to notice the new
+inode, rebuild their derived caches and then switch over.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from .gtfs_loader import DB_PATH
+
+
+class TransitDB:
+    """Tracks the current transit.db version and hands out connections to it"""
+
+    def __init__(self, db_path=DB_PATH, check_interval=5.0):
+        self.db_path = db_path
+        self.check_interval = check_interval
+        self.version = None
+        self._identity = None       # (st_dev, st_ino, st_mtime_ns) of the live file
+        self._last_check = 0.0
+        self._listeners = []
+        self._local = threading.local()
+        self._reload_lock = threading.Lock()
+        self._watcher = None
+        self.check_for_update(force=True)
+
+    def exists(self):
+        """True once a database has been published"""
+        return self._identity is not None
+
+    def connection(self):
+        """
+        Get a read-only connection to the current database version
+
+        Connections are per thread and are reopened lazily after a reload,
+        so requests already in flight finish on the version they started with.
+        """
+        if self._watcher is None:
+            self.check_for_update()
+
+        identity = self._identity
+        if identity is None:
+            return None
+
+        cached = getattr(self._local, 'conn', None)
+        if cached is not None and cached[0] == identity:
+            return cached[1]
+
+        if cached is not None:
+            cached[1].close()
+        conn = self._open(self.db_path)
+        self._local.conn = (identity, conn)
+        return conn
+
+    def add_reload_listener(self, callback):
+        """
+        Register callback(transit_db, conn) to rebuild derived caches
+
+        Listeners run before the switch, with a connection to the new file,
+        so they can build replacement caches while requests keep using the
+        old ones. Listeners should swap their caches in with a single
+        assignment at the end.
+        """
+        self._listeners.append(callback)
+
+    def check_for_update(self, force=False):
+        """Reload if transit.db was replaced since the last check"""
+        now = time.monotonic()
+        if not force and now - self._last_check < self.check_interval:
+            return False
+        self._last_check = now
+
+        identity = self._stat_identity()
+        if identity is None or identity == self._identity:
+            return False
+
+        with self._reload_lock:
+            if identity == self._identity:
+                return False
+            return self._reload(identity)
+
+    def start_watcher(self, interval=None):
+        """
+        Poll for new versions on a background thread
+
+        With the watcher running, cache rebuilds never happen on a request
+        thread, so a reload causes no latency spike.
+        """
+        if self._watcher is not None:
+            return self._watcher
+
+        interval = interval or self.check_interval
+
+        def watch():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.check_for_update(force=True)
+                except Exception as e:
+                    print(f"⚠ transit.db reload failed: {e}")
+
+        self._watcher = threading.Thread(target=watch, name="transit-db-watcher", daemon=True)
+        self._watcher.start()
+        return self._watcher
+
+    def _reload(self, identity):
+        """Open the new file, let listeners rebuild, then switch over"""
+        try:
+            conn = self._open(self.db_path)
+        except sqlite3.Error as e:
+            print(f"⚠ Could not open {self.db_path}: {e}")
+            return False
+
+        try:
+            version = self.read_version(conn)
+            for listener in self._listeners:
+                listener(self, conn)
+        finally:
+            conn.close()
+
+        first_load = self._identity is None
+        self.version = version
+        self._identity = identity
+
+        if not first_load:
+            print(f"✓ Switched to transit.db version {version}")
+        return True
+
+    def _stat_identity(self):
+        try:
+            st = os.stat(self.db_path)
+        except FileNotFoundError:
+            return None
+        return (st.st_dev, st.st_ino, st.st_mtime_ns)
+
+    def _open(self, path):
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def read_version(self, conn):
+        """Version stamped by GTFSLoader into a database connection"""
+        try:
+            row = conn.execute("SELECT version FROM db_version LIMIT 1").fetchone()
+        except sqlite3.Error:
+            # Databases built before versioning was added
+            return None
+        return row[0] if row else None
+
+
+class DerivedCache:
+    """
+    An object derived from transit.db that is rebuilt when the database changes
+
+    build(transit_db, conn, version) returns the new object (or None when it
+    cannot be built); readers use `.current`, which is replaced in a single
+    assignment once the rebuild has finished.
+    """
+
+    def __init__(self, transit_db, build):
+        self._build = build
+        self.current = None
+        if transit_db.exists():
+            conn = transit_db.connection()
+            self.current = build(transit_db, conn, transit_db.version)
+        transit_db.add_reload_listener(self._reload)
+
+    def _reload(self, transit_db, conn):
+        self.current = self._build(transit_db, conn, transit_db.read_version(conn))
+
+# Singleton instance
+_transit_db = None
+
+def get_transit_db():
+    """Get or create transit database instance"""
+    global _transit_db
+    if _transit_db is None:
+        _transit_db = TransitDB()
+    return _transit_db
@@ -0,0 +1,276 @@
+"""
+Recent positions of every live vehicle, in fixed-size ring buffers
+
+Each vehicle gets a slot: one row of preallocated NumPy arrays holding its
+last HISTORY_DEPTH reports (feed timestamp, lat, lon). Every feed refresh
+writes all vehicles at once, skipping reports whose timestamp is not newer
+than the vehicle's latest (the feed repeats positions between GPS fixes),
+and then recomputes speed and heading for all updated vehicles in one
+vectorized step.
+
+Memory is bounded: the arrays never grow past `max_bytes`, and when they
+are full the least recently seen vehicles give up their slots. A
+background evictor frees vehicles not seen within the TTL on a timer,
+independent of whether feed updates arrive.
+"""
+
+import threading
+import time
+import numpy as np
+from .geo import haversine_km, bearing_deg
+
+HISTORY_DEPTH = 16          # Reports kept per vehicle
+SPEED_SPAN = 3              # Speed is measured over the last this many reports
+MIN_MOVE_KM = 0.01          # Below this a report does not change the heading
+INITIAL_SLOTS = 1024
+MEMORY_BUDGET_BYTES = 16 * 1024 * 1024
+TTL_SECONDS = 30 * 60       # Vehicles not seen for this long are forgotten
+EVICT_INTERVAL_SECONDS = 60
+
+
+class VehicleHistory:
+    """Per-vehicle ring buffers of (feed timestamp, lat, lon)"""
+
+    def __init__(self, depth=HISTORY_DEPTH, capacity=INITIAL_SLOTS, max_bytes=MEMORY_BUDGET_BYTES):
+        self.depth = depth
+        self._slots = {}            # vehicle id -> slot
+        self._ids = []              # slot -> vehicle id (None when free)
+        self._free = []
+        self._lock = threading.Lock()
+        self.capacity = 0
+        self.max_bytes = max_bytes
+        self.max_slots = max(1, max_bytes // self.slot_bytes(depth))
+        self.evicted_ttl = 0
+        self.evicted_budget = 0
+        self.rejected = 0
+        self._evictor = None
+        self._grow(min(capacity, self.max_slots))
+
+    @staticmethod
+    def slot_bytes(depth=HISTORY_DEPTH):
+        """Array bytes per vehicle: depth x (time, lat, lon) plus head, count, last seen, speed, heading"""
+        return depth * (8 + 4 + 4) + 2 + 2 + 8 + 4 + 4
+
+    def _grow(self, capacity):
+        """Reallocate the arrays for `capacity` slots, keeping their contents"""
+        def resized(old, shape, fill, dtype):
+            new = np.full(shape, fill, dtype=dtype)
+            if old is not None:
+                new[:len(old)] = old
+            return new
+
+        n = self.capacity
+        keep = n > 0
+        # float32 coordinates are good to about a metre
+        self.times = resized(self.times if keep else None, (capacity, self.depth), 0, np.int64)
+        self.lat = resized(self.lat if keep else None, (capacity, self.depth), np.nan, np.float32)
+        self.lon = resized(self.lon if keep else None, (capacity, self.depth), np.nan, np.float32)
+        self.head = resized(self.head if keep else None, capacity, 0, np.int16)
+        self.count = resized(self.count if keep else None, capacity, 0, np.int16)
+        self.last_seen = resized(self.last_seen if keep else None, capacity, 0.0, np.float64)
+        self.speed_kmh = resized(self.speed_kmh if keep else None, capacity, np.nan, np.float32)
+        self.heading = resized(self.heading if keep else None, capacity, np.nan, np.float32)
+        self._ids.extend([None] * (capacity - n))
+        self._free.extend(range(capacity - 1, n - 1, -1))
+        self.capacity = capacity
+
+    def _slot(self, vehicle_id):
+        """Slot of a vehicle, allocating one if there is room, else -1"""
+        slot = self._slots.get(vehicle_id)
+        if slot is None:
+            if not self._free:
+                return -1
+            slot = self._free.pop()
+            self._slots[vehicle_id] = slot
+            self._ids[slot] = vehicle_id
+        return slot
+
+    def _make_room(self, vehicle_ids):
+        """Free enough slots for a batch's new vehicles, within the memory budget"""
+        new = len(set(v for v in vehicle_ids if v not in self._slots))
+        if new <= len(self._free):
+            return
+        if self.capacity < self.max_slots:
+            needed = self.capacity + new - len(self._free)
+            self._grow(min(self.max_slots, max(needed, self.capacity * 2)))
+        short = new - len(self._free)
+        if short > 0:
+            # Least recently seen vehicles that are not in this batch
+            batch = set(vehicle_ids)
+            others = [v for v in self._slots if v not in batch]
+            seen = self.last_seen[[self._slots[v] for v in others]]
+            oldest = np.argsort(seen, kind='stable')[:short]
+            self.evicted_budget += self._release([others[i] for i in oldest.tolist()])
+
+    def _release(self, vehicle_ids):
+        for vehicle_id in vehicle_ids:
+            slot = self._slots.pop(vehicle_id)
+            self._ids[slot] = None
+            self.count[slot] = 0
+            self.head[slot] = 0
+            self.speed_kmh[slot] = np.nan
+            self.heading[slot] = np.nan
+            self._free.append(slot)
+        return len(vehicle_ids)
+
+    def ingest(self, vehicle_ids, lat, lon, timestamps, received=None):
+        """
+        Record one feed's reports; returns the indices of those recorded
+
+        timestamps are the feed's epoch seconds per report. Reports that are
+        not newer than what the vehicle already has are dropped, as are all
+        but the newest report of a vehicle within the batch. New vehicles
+        that do not fit the memory budget even after evicting everyone else
+        are dropped too.
+        """
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        received = time.time() if received is None else received
+        if len(timestamps) == 0:
+            return np.empty(0, dtype=np.int64)
+
+        with self._lock:
+            self._make_room(vehicle_ids)
+            slots = np.fromiter((self._slot(v) for v in vehicle_ids), dtype=np.int64, count=len(timestamps))
+            placed = np.flatnonzero(slots >= 0)
+            if len(placed) < len(slots):
+                self.rejected += len(slots) - len(placed)
+
+            # Newest report per vehicle in this batch
+            order = placed[np.lexsort((timestamps[placed], slots[placed]))]
+            last = np.ones(len(order), dtype=bool)
+            last[:-1] = slots[order][1:] != slots[order][:-1]
+            rows = order[last]
+            slots = slots[rows]
+
+            # ...and only if newer than the vehicle's latest
+            latest = self.times[slots, (self.head[slots] - 1) % self.depth]
+            fresh = (self.count[slots] == 0) | (timestamps[rows] > latest)
+            rows, slots = rows[fresh], slots[fresh]
+            self.last_seen[slots] = received
+            if len(slots) == 0:
+                return rows
+
+            column = self.head[slots]
+            self.times[slots, column] = timestamps[rows]
+            self.lat[slots, column] = lat[rows]
+            self.lon[slots, column] = lon[rows]
+            self.head[slots] = (column + 1) % self.depth
+            self.count[slots] = np.minimum(self.count[slots] + 1, self.depth)
+            self._update_motion(slots)
+            return rows
+
+    def _update_motion(self, slots):
+        """Speed over the last SPEED_SPAN reports and heading of the last move"""
+        count = self.count[slots]
+        current = (self.head[slots] - 1) % self.depth
+        span = np.minimum(count - 1, SPEED_SPAN - 1)
+        back = (current - span) % self.depth
+        previous = (current - 1) % self.depth
+
+        lat, lon, times = self.lat, self.lon, self.times
+        km = np.zeros(len(slots))
+        for step in range(1, SPEED_SPAN):
+            # Path length, not displacement: sum the hops within the span
+            inside = span >= step
+            a = (current - step + 1) % self.depth
+            b = (current - step) % self.depth
+            hop = haversine_km(lat[slots, b], lon[slots, b], lat[slots, a], lon[slots, a])
+            km += np.where(inside, np.nan_to_num(hop), 0.0)
+        seconds = (times[slots, current] - times[slots, back]).astype(np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.speed_kmh[slots] = np.where((span > 0) & (seconds > 0), km / seconds * 3600, np.nan)
+
+        moved = (count > 1) & (haversine_km(lat[slots, previous], lon[slots, previous],
+                                            lat[slots, current], lon[slots, current]) >= MIN_MOVE_KM)
+        moved_slots = slots[moved]
+        self.heading[moved_slots] = bearing_deg(lat[moved_slots, previous[moved]], lon[moved_slots, previous[moved]],
+                                                lat[moved_slots, current[moved]], lon[moved_slots, current[moved]])
+
+    def slot_of(self, vehicle_id):
+        return self._slots.get(vehicle_id)
+
+    def sample_count(self, vehicle_id):
+        slot = self._slots.get(vehicle_id)
+        return 0 if slot is None else int(self.count[slot])
+
+    def speed(self, vehicle_id):
+        """Latest measured speed in km/h, or None"""
+        slot = self._slots.get(vehicle_id)
+        if slot is None or np.isnan(self.speed_kmh[slot]):
+            return None
+        return float(self.speed_kmh[slot])
+
+    def recent(self, vehicle_id, n=2):
+        """The vehicle's last n reports as (timestamps, lat, lon), oldest first"""
+        slot = self._slots.get(vehicle_id)
+        if slot is None:
+            return np.empty(0, dtype=np.int64), np.empty(0), np.empty(0)
+        n = min(n, int(self.count[slot]))
+        columns = (self.head[slot] - np.arange(n, 0, -1)) % self.depth
+        return self.times[slot, columns], self.lat[slot, columns], self.lon[slot, columns]
+
+    def slots(self, vehicle_ids):
+        """Slot of each vehicle id, -1 for vehicles without history"""
+        get = self._slots.get
+        return np.fromiter((get(v, -1) for v in vehicle_ids), dtype=np.int64, count=len(vehicle_ids))
+
+    def motion(self, slots):
+        """(speed km/h, report count) per slot; NaN/0 for slots of -1"""
+        known = slots >= 0
+        safe = np.where(known, slots, 0)
+        return (np.where(known, self.speed_kmh[safe], np.nan),
+                np.where(known, self.count[safe], 0))
+
+    def positions(self, slots, back=0):
+        """(lat, lon) per slot `back` reports before the latest, NaN where unknown"""
+        safe = np.where(slots >= 0, slots, 0)
+        have = (slots >= 0) & (self.count[safe] > back)
+        column = (self.head[safe] - 1 - back) % self.depth
+        return (np.where(have, self.lat[safe, column], np.nan),
+                np.where(have, self.lon[safe, column], np.nan))
+
+    def evict_older_than(self, cutoff):
+        """Free the slots of vehicles last reported before `cutoff` (epoch seconds)"""
+        with self._lock:
+            stale = [v for v, slot in self._slots.items() if self.last_seen[slot] < cutoff]
+            evicted = self._release(stale)
+            self.evicted_ttl += evicted
+            return evicted
+
+    def start_evictor(self, ttl=TTL_SECONDS, interval=EVICT_INTERVAL_SECONDS):
+        """Evict vehicles not seen for `ttl` seconds every `interval` seconds, on a background thread"""
+        if self._evictor is not None:
+            return self._evictor
+
+        def evict():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.evict_older_than(time.time() - ttl)
+                except Exception as e:
+                    print(f"⚠ Vehicle history eviction failed: {e}")
+
+        self._evictor = threading.Thread(target=evict, name="vehicle-history-evictor", daemon=True)
+        self._evictor.start()
+        return self._evictor
+
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.times, self.lat, self.lon, self.head, self.count,
+                                      self.last_seen, self.speed_kmh, self.heading))
+
+    def stats(self):
+        return {
+            'vehicles': len(self._slots),
+            'capacity': self.capacity,
+            'max_vehicles': self.max_slots,
+            'bytes': self.nbytes(),
+            'max_bytes': self.max_bytes,
+            'evicted_ttl': self.evicted_ttl,
+            'evicted_budget': self.evicted_budget,
+            'rejected': self.rejected,
+        }
+
+    def __len__(self):
+        return len(self._slots)
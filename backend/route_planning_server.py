@@ -3,35 +3,74 @@ Route planning server with real transit data
 This replaces the AI-generated fake routes with real route planning
 """
 
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, request, stream_with_context
 from flask_cors import CORS
+from werkzeug.serving import is_running_from_reloader
 import requests
+import json
 from google.transit import gtfs_realtime_pb2
+import os
 import sys
 from pathlib import Path
 from datetime import datetime
+import time
 
 # Add route_planner to path
 sys.path.insert(0, str(Path(__file__).parent))
 
 from route_planner.simple_planner import get_planner
+from route_planner.arrival_predictor import get_arrival_predictor
+from route_planner.transit_db import get_transit_db
+from route_planner.network import get_network
+from route_planner.isochrone import compute_isochrone, MAX_MINUTES
+from route_planner.matrix import start_pool, travel_time_matrix, UNREACHABLE
+from route_planner import metrics, tracing
+import io
+import numpy as np
 
 app = Flask(__name__)
 CORS(app)
 
+# Largest number of OD pairs accepted by /api/plan-route/batch
+MAX_BATCH_PAIRS = 10000
+
+# Largest travel-time matrix accepted by /api/matrix
+MAX_MATRIX_CELLS = 1000000
+
 # Delhi Transit API endpoint
 DELHI_API_URL = "https://otd.delhi.gov.in/api/realtime/VehiclePositions.pb?key=mt2giIBCJY1tOjhmMIwfTaTwAXTfPpYR"
 
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+@app.after_request
+def record_latency(response):
+    # Labelled by route pattern, so unknown paths share one series
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.HTTP_LATENCY.observe(time.perf_counter() - g.started, endpoint, request.method,
+                                 str(response.status_code))
+    return response
+
 @app.route("/api/live", methods=["GET"])
 def get_live_bus_data():
     """Get live bus positions (existing endpoint)"""
     try:
-        response = requests.get(DELHI_API_URL)
-        if response.status_code != 200:
-            return jsonify({"error": f"Delhi API returned {response.status_code}"}), 500
+        planner = get_planner()
+        if planner.shared_feed is not None:
+            # Shared mode: serve the ingest process's snapshot
+            planner.refresh_if_stale()
+            content = planner.shared_feed.content
+            if content is None:
+                return jsonify({"error": "No feed snapshot published yet"}), 503
+        else:
+            response = requests.get(DELHI_API_URL)
+            if response.status_code != 200:
+                return jsonify({"error": f"Delhi API returned {response.status_code}"}), 500
+            content = response.content
 
         feed = gtfs_realtime_pb2.FeedMessage()
-        feed.ParseFromString(response.content)
+        feed.ParseFromString(content)
 
         buses = []
         for entity in feed.entity:
@@ -95,35 +134,84 @@ def plan_route():
         # Get planner instance
         planner = get_planner()
         
-        # Plan route
-        result = planner.plan_route(
-            start['lat'], start['lon'],
-            end['lat'], end['lon'],
-            preference=preference
-        )
-        
-        # Add metadata
-        result['metadata'] = {
-            'start_name': start.get('name', 'Start Location'),
-            'end_name': end.get('name', 'End Location'),
-            'preference': preference,
-            'data_source': 'Delhi Open Transit Data (Real-time) + DMRC GTFS',
-            'last_updated': planner.last_update.isoformat() if planner.last_update else None,
-            'note': 'Showing both DTC bus routes and Delhi Metro options',
-            'features': [
-                'Real-time bus tracking (2,600+ buses)',
-                'Delhi Metro network integration',
-                'Multi-modal route suggestions',
-                'Direction-validated bus routes',
-                'Confidence scoring'
-            ]
-        }
+        # Plan route (with a span breakdown when asked for: ?trace=1 or X-Trace: 1)
+        with tracing.RequestTrace('plan-route', tracing.requested(request.args, request.headers)) as trace:
+            result = planner.plan_route(
+                start['lat'], start['lon'],
+                end['lat'], end['lon'],
+                preference=preference
+            )
+            
+            # Add metadata
+            result['metadata'] = {
+                'start_name': start.get('name', 'Start Location'),
+                'end_name': end.get('name', 'End Location'),
+                'preference': preference,
+                'data_source': 'Delhi Open Transit Data (Real-time) + DMRC GTFS',
+                'last_updated': planner.last_update.isoformat() if planner.last_update else None,
+                'note': 'Showing both DTC bus routes and Delhi Metro options',
+                'features': [
+                    'Real-time bus tracking (2,600+ buses)',
+                    'Delhi Metro network integration',
+                    'Multi-modal route suggestions',
+                    'Direction-validated bus routes',
+                    'Confidence scoring'
+                ]
+            }
+            
+            if trace.active:
+                with tracing.span('serialize'):
+                    json.dumps(result)
+        if trace.active:
+            result['metadata']['trace'] = trace.to_dict()
         
         return jsonify(result)
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route("/api/plan-route/batch", methods=["POST"])
+def plan_route_batch():
+    """
+    Plan routes for many origin-destination pairs in one request
+    
+    Request body:
+    {
+        "pairs": [
+            {"id": "optional", "start": {"lat": 28.6129, "lon": 77.2295}, "end": {"lat": 28.5517, "lon": 77.1983}},
+            ...
+        ],
+        "preference": "fastest" | "cheapest" | "balanced"
+    }
+    
+    Response: NDJSON, one line per pair in completion order
+    {"index": 0, "id": "optional", "routes": [...]}
+    """
+    try:
+        data = request.get_json()
+        if not data or not isinstance(data.get('pairs'), list) or not data['pairs']:
+            return jsonify({"error": "Missing pairs"}), 400
+        if len(data['pairs']) > MAX_BATCH_PAIRS:
+            return jsonify({"error": f"At most {MAX_BATCH_PAIRS} pairs per request"}), 400
+        
+        pairs = [
+            (float(p['start']['lat']), float(p['start']['lon']), float(p['end']['lat']), float(p['end']['lon']))
+            for p in data['pairs']
+        ]
+        ids = [p.get('id') for p in data['pairs']]
+        preference = data.get('preference', 'fastest')
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"error": "Each pair needs start and end lat/lon"}), 400
+    
+    planner = get_planner()
+    
+    def generate():
+        for index, result in planner.plan_routes_batch(pairs, preference=preference):
+            line = {'index': index, 'id': ids[index], **result}
+            yield json.dumps(line) + "\n"
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 @app.route("/api/nearby-buses", methods=["GET"])
 def get_nearby_buses():
     """
@@ -184,28 +272,46 @@ def get_active_routes():
 @app.route("/api/realtime-arrivals", methods=["GET"])
 def get_realtime_arrivals():
     """
-    Get real-time arrival predictions for buses at a location
+    Get real-time arrival predictions for buses at a location or stop
     
     Query params:
     - lat: latitude
     - lon: longitude
+    - stop_id: optional - instead of lat/lon, a stop's arrival board
     - route_id: optional - filter by route
     - limit: number of arrivals (default: 5)
     """
     try:
-        lat = float(request.args.get('lat'))
-        lon = float(request.args.get('lon'))
+        stop_id = request.args.get('stop_id')
         route_id = request.args.get('route_id')
         limit = int(request.args.get('limit', 5))
-        
         planner = get_planner()
-        arrivals = planner.get_realtime_arrivals(lat, lon, route_id, limit)
+        trace = tracing.RequestTrace('realtime-arrivals', tracing.requested(request.args, request.headers))
+        
+        if stop_id:
+            with trace:
+                arrivals = planner.get_stop_arrivals(stop_id, route_id, limit)
+            if arrivals is None:
+                return jsonify({"error": f"Unknown stop: {stop_id}"}), 404
+            return jsonify({
+                'arrivals': arrivals,
+                'count': len(arrivals),
+                'stop_id': stop_id,
+                'timestamp': datetime.now().isoformat(),
+                **({'metadata': {'trace': trace.to_dict()}} if trace.active else {})
+            })
+        
+        lat = float(request.args.get('lat'))
+        lon = float(request.args.get('lon'))
+        with trace:
+            arrivals = planner.get_realtime_arrivals(lat, lon, route_id, limit)
         
         return jsonify({
             'arrivals': arrivals,
             'count': len(arrivals),
             'location': {'lat': lat, 'lon': lon},
-            'timestamp': datetime.now().isoformat()
+            'timestamp': datetime.now().isoformat(),
+            **({'metadata': {'trace': trace.to_dict()}} if trace.active else {})
         })
         
     except ValueError:
@@ -213,20 +319,130 @@ def get_realtime_arrivals():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route("/api/isochrone", methods=["GET"])
+def get_isochrone():
+    """
+    Get the stops (and optionally the area) reachable within a time budget
+    
+    Query params:
+    - lat: latitude
+    - lon: longitude
+    - minutes: time budget (default: 30, max: 120)
+    - departure: optional - HH:MM today (default: now)
+    - max_transfers: optional - vehicle changes allowed (default: 3)
+    - polygon: optional - 'true' to include a gridded GeoJSON area
+    - cell: optional - polygon grid cell size in metres (default: 250)
+    """
+    try:
+        lat = float(request.args.get('lat'))
+        lon = float(request.args.get('lon'))
+        minutes = min(float(request.args.get('minutes', 30)), MAX_MINUTES)
+        max_transfers = int(request.args.get('max_transfers', 3))
+        polygon = request.args.get('polygon', 'false').lower() in ('1', 'true', 'yes')
+        cell_m = max(float(request.args.get('cell', 250)), 50)
+        departure = None
+        if request.args.get('departure'):
+            clock = datetime.strptime(request.args.get('departure'), '%H:%M')
+            departure = datetime.combine(datetime.now().date(), clock.time())
+        if minutes <= 0:
+            raise ValueError("minutes must be positive")
+        
+        network = get_network()
+        if network is None:
+            return jsonify({"error": "Static GTFS data not loaded"}), 503
+        
+        result = compute_isochrone(network, lat, lon, minutes, departure, max_transfers,
+                                   polygon=polygon, cell_m=cell_m)
+        result['timestamp'] = datetime.now().isoformat()
+        return jsonify(result)
+        
+    except (TypeError, ValueError):
+        return jsonify({"error": "Invalid lat/lon, minutes or departure parameters"}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/matrix", methods=["POST"])
+def get_travel_time_matrix():
+    """
+    Door-to-door transit travel times from many origins to many destinations
+    
+    Request body:
+    {
+        "origins": [[28.6129, 77.2295], ...],
+        "destinations": [[28.5517, 77.1983], ...],
+        "departure": "08:30",       (optional, default: now)
+        "max_minutes": 180,         (optional)
+        "format": "npy" | "raw"     (optional, default: npy)
+    }
+    
+    Response: a dense int32 seconds matrix (origins x destinations), -1
+    where unreachable. "npy" is a NumPy .npy file; "raw" is little-endian
+    int32 in row-major order. The shape is in the X-Matrix-Shape header.
+    """
+    try:
+        data = request.get_json()
+        if not data or not data.get('origins') or not data.get('destinations'):
+            return jsonify({"error": "Missing origins or destinations"}), 400
+        
+        origins = np.asarray(data['origins'], dtype=np.float64).reshape(-1, 2)
+        destinations = np.asarray(data['destinations'], dtype=np.float64).reshape(-1, 2)
+        if len(origins) * len(destinations) > MAX_MATRIX_CELLS:
+            return jsonify({"error": f"At most {MAX_MATRIX_CELLS} origin-destination cells per request"}), 400
+        
+        departure = None
+        if data.get('departure'):
+            clock = datetime.strptime(data['departure'], '%H:%M')
+            departure = datetime.combine(datetime.now().date(), clock.time())
+        max_minutes = min(float(data.get('max_minutes', 180)), 24 * 60)
+        output = data.get('format', 'npy')
+        if output not in ('npy', 'raw'):
+            raise ValueError("format must be npy or raw")
+    except (TypeError, ValueError):
+        return jsonify({"error": "Invalid origins, destinations, departure or format"}), 400
+    
+    try:
+        matrix = travel_time_matrix(origins, destinations, departure, max_minutes=max_minutes)
+        
+        if output == 'npy':
+            buffer = io.BytesIO()
+            np.save(buffer, matrix)
+            body = buffer.getvalue()
+        else:
+            body = matrix.astype('<i4').tobytes()
+        
+        response = Response(body, mimetype='application/octet-stream')
+        response.headers['X-Matrix-Shape'] = f"{matrix.shape[0]},{matrix.shape[1]}"
+        response.headers['X-Matrix-Unreachable'] = str(UNREACHABLE)
+        return response
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @app.route("/api/health", methods=["GET"])
 def health_check():
     """Health check endpoint"""
     planner = get_planner()
+    transit_db = get_transit_db()
     
     return jsonify({
         'status': 'healthy',
         'buses_tracked': len(planner.buses),
         'routes_active': len(planner.routes),
         'last_update': planner.last_update.isoformat() if planner.last_update else None,
+        'static_data_version': transit_db.version if transit_db.exists() else None,
+        'plan_cache': planner.plan_cache.stats(),
+        'vehicle_history': planner.arrival_predictor.history.stats(),
+        'arrival_boards': planner.arrival_boards.stats(),
+        'shared_feed': planner.shared_feed.stats() if planner.shared_feed is not None else None,
         'data_source': 'Delhi Open Transit Data',
         'mode': 'Real-time (Simple Planner with Arrival Predictions)'
     })
 
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Request latencies, feed and planner stage timings, cache and memory figures (Prometheus text format)"""
+    return Response(metrics.render(get_planner()), content_type=metrics.CONTENT_TYPE)
+
 if __name__ == "__main__":
     print("=" * 60)
     print("🚌 Delhi Transit Route Planning Server")
@@ -234,14 +450,32 @@ if __name__ == "__main__":
     print("\nEndpoints:")
     print("  GET  /api/live               - Live bus positions")
     print("  POST /api/plan-route         - Plan a route")
+    print("  POST /api/plan-route/batch   - Plan many OD pairs (NDJSON stream)")
     print("  GET  /api/nearby-buses       - Find nearby buses")
     print("  GET  /api/realtime-arrivals  - Real-time arrival predictions ⭐ NEW!")
+    print("  GET  /api/isochrone          - Reachable stops/area within N minutes")
+    print("  POST /api/matrix             - Many-to-many travel-time matrix (binary)")
     print("  GET  /api/routes             - Active routes")
     print("  GET  /api/health             - Health check")
+    print("  GET  /metrics                - Prometheus metrics")
     print("\nMode: Simple Planner with Arrival Predictions")
     print("Features: Real-time tracking + ETA predictions + Metro integration")
     print("\nStarting server on http://localhost:5000")
     print("=" * 60)
     print()
     
-    app.run(debug=True, port=5000)
+    # FLASK_DEBUG=0 turns off debug mode and its reloader. With the
+    # reloader this module runs twice: a watching parent and the child that
+    # serves. Only the serving process starts background threads.
+    debug = os.environ.get('FLASK_DEBUG', '1').lower() in ('1', 'true', 'yes')
+    if not debug or is_running_from_reloader():
+        # Fork the matrix workers before any other thread exists
+        start_pool()
+        
+        # Pick up rebuilt transit.db files without restarting
+        get_transit_db().start_watcher()
+        
+        # Forget buses that stopped reporting, whether or not the feed updates
+        get_arrival_predictor().start_cleanup()
+    
+    app.run(debug=debug, port=5000)
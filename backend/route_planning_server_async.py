@@ -0,0 +1,620 @@
+"""
+Route planning server, asyncio (ASGI) variant
+
+Serves the same endpoints as route_planning_server.py, for deployments
+where many map clients poll at once:
+
+- The live feed is fetched by one background task with a non-blocking HTTP
+  client every FEED_REFRESH_SECONDS; requests never wait on the Delhi API.
+- With SHARED_SNAPSHOTS=1 the task reads the snapshots published by
+  route_planner.shared_snapshot instead, so workers share one upstream poll.
+- Planning, isochrones, matrices and other CPU work run on a thread pool,
+  so the event loop keeps accepting and answering requests meanwhile.
+- At most MAX_PENDING jobs may be running or queued for the pool; beyond
+  that requests get 503 with Retry-After instead of piling up.
+
+Run with:  python route_planning_server_async.py
+      or:  uvicorn route_planning_server_async:app --port 5000
+  workers: python -m route_planner.shared_snapshot publish &
+           SHARED_SNAPSHOTS=1 uvicorn route_planning_server_async:app --port 5000 --workers 4
+"""
+
+import asyncio
+import io
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime
+from pathlib import Path
+
+import httpx
+import numpy as np
+import uvicorn
+from google.transit import gtfs_realtime_pb2
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+# Add route_planner to path
+sys.path.insert(0, str(Path(__file__).parent))
+
+from route_planner.simple_planner import get_planner, REALTIME_API
+from route_planner.arrival_predictor import get_arrival_predictor
+from route_planner.transit_db import get_transit_db
+from route_planner.network import get_network
+from route_planner.isochrone import compute_isochrone, MAX_MINUTES
+from route_planner.matrix import start_pool, travel_time_matrix, UNREACHABLE
+from route_planner import metrics, tracing
+
+# Largest number of OD pairs accepted by /api/plan-route/batch
+MAX_BATCH_PAIRS = 10000
+
+# Largest travel-time matrix accepted by /api/matrix
+MAX_MATRIX_CELLS = 1000000
+
+FEED_REFRESH_SECONDS = 30
+SHARED_POLL_SECONDS = 1     # How often to look for a newer shared snapshot (SHARED_SNAPSHOTS=1)
+FEED_TIMEOUT_SECONDS = 10
+PLANNER_THREADS = 4
+MAX_PENDING = 64            # Jobs running or waiting for a planner thread
+RETRY_AFTER_SECONDS = 2
+
+
+class Overloaded(Exception):
+    """Every planner thread is busy and the queue is full"""
+
+
+class JSON(JSONResponse):
+    """JSON response that, like Flask's jsonify, accepts dates"""
+
+    def render(self, content):
+        return json.dumps(content, default=str, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def error(message, status_code):
+    return JSON({"error": message}, status_code=status_code)
+
+
+class FeedState:
+    """The latest raw feed, shared by the refresher and /api/live"""
+
+    def __init__(self):
+        self.content = None
+        self.fetched_at = None
+        self.live = None            # Parsed /api/live response of `content`
+        self.failures = 0
+
+
+executor = ThreadPoolExecutor(max_workers=PLANNER_THREADS, thread_name_prefix="planner")
+feed = FeedState()
+_pending = 0
+
+
+class PendingSlot:
+    """One place in the planner queue, held until released (at most once)"""
+
+    def __init__(self):
+        global _pending
+        if _pending >= MAX_PENDING:
+            raise Overloaded()
+        _pending += 1
+        self.held = True
+
+    def release(self):
+        global _pending
+        if self.held:
+            self.held = False
+            _pending -= 1
+
+
+async def offload(fn, *args, slot=None, **kwargs):
+    """
+    Run fn on the planner pool, or raise Overloaded when the queue is full
+
+    A job that already holds a slot (a streamed batch) passes it instead
+    of taking another one.
+    """
+    own = PendingSlot() if slot is None else None
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, lambda: fn(*args, **kwargs))
+    finally:
+        if own is not None:
+            own.release()
+
+
+def _live_buses(content):
+    """Parse a raw feed into the /api/live bus list"""
+    message = gtfs_realtime_pb2.FeedMessage()
+    message.ParseFromString(content)
+
+    buses = []
+    for entity in message.entity:
+        if entity.HasField("vehicle"):
+            v = entity.vehicle
+            buses.append({
+                "id": v.vehicle.id,
+                "latitude": v.position.latitude,
+                "longitude": v.position.longitude,
+                "route_id": v.trip.route_id,
+                "timestamp": v.timestamp,
+                "trip_id": v.trip.trip_id,
+                "vehicle_id": v.vehicle.label or v.vehicle.id
+            })
+    return buses
+
+
+async def refresh_feed(client):
+    """Fetch the feed without blocking the loop, then ingest it on the pool"""
+    started = time.perf_counter()
+    response = await client.get(REALTIME_API, timeout=FEED_TIMEOUT_SECONDS)
+    metrics.FEED_STAGE.observe(time.perf_counter() - started, 'fetch')
+    response.raise_for_status()
+    planner = get_planner()
+    await asyncio.get_running_loop().run_in_executor(executor, planner.ingest_feed, response.content)
+    feed.content = response.content
+    feed.fetched_at = time.time()
+    feed.live = None
+    feed.failures = 0
+
+
+async def read_shared_feed():
+    """Shared mode: ingest the ingest process's snapshot when it has a new one"""
+    content = await asyncio.get_running_loop().run_in_executor(executor, get_planner().ingest_shared)
+    if content is not None:
+        feed.content = content
+        feed.fetched_at = get_planner().shared_feed.fetched_at
+        feed.live = None
+
+
+async def feed_refresher(client):
+    shared = get_planner().shared_feed is not None
+    while True:
+        try:
+            if shared:
+                await read_shared_feed()
+            else:
+                await refresh_feed(client)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            feed.failures += 1
+            print(f"⚠ Feed refresh failed ({feed.failures} in a row): {e}")
+        await asyncio.sleep(SHARED_POLL_SECONDS if shared else FEED_REFRESH_SECONDS)
+
+
+async def get_live_bus_data(request):
+    """Get live bus positions (existing endpoint)"""
+    try:
+        if feed.content is None:
+            async with httpx.AsyncClient() as client:
+                response = await client.get(REALTIME_API, timeout=FEED_TIMEOUT_SECONDS)
+            if response.status_code != 200:
+                return error(f"Delhi API returned {response.status_code}", 500)
+            return JSON(await offload(_live_buses, response.content))
+
+        # Parsed once per refresh, however many clients ask
+        if feed.live is None:
+            content = feed.content
+            live = await offload(_live_buses, content)
+            if feed.content is content:
+                feed.live = live
+            return JSON(live)
+        return JSON(feed.live)
+
+    except Overloaded:
+        raise
+    except Exception as e:
+        return error(str(e), 500)
+
+
+async def plan_route(request):
+    """
+    Plan a route using real transit data
+
+    Request body and response as in route_planning_server.py
+    """
+    try:
+        data = await request.json()
+
+        # Validate input
+        if not data or 'start' not in data or 'end' not in data:
+            return error("Missing start or end location", 400)
+
+        start = data['start']
+        end = data['end']
+        preference = data.get('preference', 'fastest')
+
+        planner = get_planner()
+        trace = tracing.RequestTrace('plan-route', tracing.requested(request.query_params, request.headers))
+        result = await offload(trace.call, planner.plan_route, start['lat'], start['lon'], end['lat'], end['lon'],
+                               preference=preference)
+
+        # Add metadata
+        result['metadata'] = {
+            'start_name': start.get('name', 'Start Location'),
+            'end_name': end.get('name', 'End Location'),
+            'preference': preference,
+            'data_source': 'Delhi Open Transit Data (Real-time) + DMRC GTFS',
+            'last_updated': planner.last_update.isoformat() if planner.last_update else None,
+            'note': 'Showing both DTC bus routes and Delhi Metro options',
+            'features': [
+                'Real-time bus tracking (2,600+ buses)',
+                'Delhi Metro network integration',
+                'Multi-modal route suggestions',
+                'Direction-validated bus routes',
+                'Confidence scoring'
+            ]
+        }
+        if trace.active:
+            result['metadata']['trace'] = trace.to_dict()
+
+        return JSON(result)
+
+    except Overloaded:
+        raise
+    except Exception as e:
+        return error(str(e), 500)
+
+
+async def plan_route_batch(request):
+    """
+    Plan routes for many origin-destination pairs in one request
+
+    Request body and NDJSON response as in route_planning_server.py. The
+    whole stream counts as one pending job until it ends, so an accepted
+    batch is never turned away halfway through.
+    """
+    try:
+        data = await request.json()
+        if not data or not isinstance(data.get('pairs'), list) or not data['pairs']:
+            return error("Missing pairs", 400)
+        if len(data['pairs']) > MAX_BATCH_PAIRS:
+            return error(f"At most {MAX_BATCH_PAIRS} pairs per request", 400)
+
+        pairs = [
+            (float(p['start']['lat']), float(p['start']['lon']), float(p['end']['lat']), float(p['end']['lon']))
+            for p in data['pairs']
+        ]
+        ids = [p.get('id') for p in data['pairs']]
+        preference = data.get('preference', 'fastest')
+    except (KeyError, TypeError, ValueError):
+        return error("Each pair needs start and end lat/lon", 400)
+
+    planner = get_planner()
+    slot = PendingSlot()
+    try:
+        results = await offload(planner.plan_routes_batch, pairs, preference=preference, slot=slot)
+    except BaseException:
+        slot.release()
+        raise
+    done = object()
+
+    async def generate():
+        try:
+            while True:
+                item = await offload(next, results, done, slot=slot)
+                if item is done:
+                    break
+                index, result = item
+                yield json.dumps({'index': index, 'id': ids[index], **result}, default=str) + "\n"
+        finally:
+            slot.release()
+
+    # The background task also frees the slot if the stream never starts
+    return StreamingResponse(generate(), media_type='application/x-ndjson',
+                             background=BackgroundTask(slot.release))
+
+
+async def get_nearby_buses(request):
+    """
+    Get buses near a location
+
+    Query params:
+    - lat: latitude
+    - lon: longitude
+    - radius: radius in km (default: 1.0)
+    """
+    try:
+        lat = float(request.query_params.get('lat'))
+        lon = float(request.query_params.get('lon'))
+        radius = float(request.query_params.get('radius', 1.0))
+
+        nearby = await offload(get_planner().find_nearby_buses, lat, lon, radius)
+
+        return JSON({
+            'buses': nearby,
+            'count': len(nearby),
+            'radius_km': radius
+        })
+
+    except (TypeError, ValueError):
+        return error("Invalid lat/lon parameters", 400)
+    except Overloaded:
+        raise
+    except Exception as e:
+        return error(str(e), 500)
+
+
+async def get_active_routes(request):
+    """Get list of currently active bus routes"""
+    planner = get_planner()
+    routes_info = [
+        {'route_id': route_id, 'active_buses': len(buses), 'coverage': 'Active'}
+        for route_id, buses in planner.routes.items()
+    ]
+    routes_info.sort(key=lambda x: x['active_buses'], reverse=True)
+
+    return JSON({
+        'routes': routes_info,
+        'total_routes': len(routes_info),
+        'total_buses': len(planner.buses)
+    })
+
+
+async def get_realtime_arrivals(request):
+    """
+    Get real-time arrival predictions for buses at a location or stop
+
+    Query params:
+    - lat: latitude
+    - lon: longitude
+    - stop_id: optional - instead of lat/lon, a stop's arrival board
+    - route_id: optional - filter by route
+    - limit: number of arrivals (default: 5)
+    """
+    try:
+        stop_id = request.query_params.get('stop_id')
+        route_id = request.query_params.get('route_id')
+        limit = int(request.query_params.get('limit', 5))
+        planner = get_planner()
+        trace = tracing.RequestTrace('realtime-arrivals', tracing.requested(request.query_params, request.headers))
+
+        if stop_id:
+            # A board read: cheap enough for the event loop
+            arrivals = trace.call(planner.get_stop_arrivals, stop_id, route_id, limit)
+            if arrivals is None:
+                return error(f"Unknown stop: {stop_id}", 404)
+            return JSON({
+                'arrivals': arrivals,
+                'count': len(arrivals),
+                'stop_id': stop_id,
+                'timestamp': datetime.now().isoformat(),
+                **({'metadata': {'trace': trace.to_dict()}} if trace.active else {})
+            })
+
+        lat = float(request.query_params.get('lat'))
+        lon = float(request.query_params.get('lon'))
+        arrivals = await offload(trace.call, planner.get_realtime_arrivals, lat, lon, route_id, limit)
+
+        return JSON({
+            'arrivals': arrivals,
+            'count': len(arrivals),
+            'location': {'lat': lat, 'lon': lon},
+            'timestamp': datetime.now().isoformat(),
+            **({'metadata': {'trace': trace.to_dict()}} if trace.active else {})
+        })
+
+    except (TypeError, ValueError):
+        return error("Invalid lat/lon parameters", 400)
+    except Overloaded:
+        raise
+    except Exception as e:
+        return error(str(e), 500)
+
+
+async def get_isochrone(request):
+    """
+    Get the stops (and optionally the area) reachable within a time budget
+
+    Query params as in route_planning_server.py
+    """
+    args = request.query_params
+    try:
+        lat = float(args.get('lat'))
+        lon = float(args.get('lon'))
+        minutes = min(float(args.get('minutes', 30)), MAX_MINUTES)
+        max_transfers = int(args.get('max_transfers', 3))
+        polygon = args.get('polygon', 'false').lower() in ('1', 'true', 'yes')
+        cell_m = max(float(args.get('cell', 250)), 50)
+        departure = None
+        if args.get('departure'):
+            clock = datetime.strptime(args.get('departure'), '%H:%M')
+            departure = datetime.combine(datetime.now().date(), clock.time())
+        if minutes <= 0:
+            raise ValueError("minutes must be positive")
+    except (TypeError, ValueError):
+        return error("Invalid lat/lon, minutes or departure parameters", 400)
+
+    try:
+        network = get_network()
+        if network is None:
+            return error("Static GTFS data not loaded", 503)
+
+        result = await offload(compute_isochrone, network, lat, lon, minutes, departure, max_transfers,
+                               polygon=polygon, cell_m=cell_m)
+        result['timestamp'] = datetime.now().isoformat()
+        return JSON(result)
+
+    except Overloaded:
+        raise
+    except Exception as e:
+        return error(str(e), 500)
+
+
+async def get_travel_time_matrix(request):
+    """
+    Door-to-door transit travel times from many origins to many destinations
+
+    Request body and binary response as in route_planning_server.py
+    """
+    try:
+        data = await request.json()
+        if not data or not data.get('origins') or not data.get('destinations'):
+            return error("Missing origins or destinations", 400)
+
+        origins = np.asarray(data['origins'], dtype=np.float64).reshape(-1, 2)
+        destinations = np.asarray(data['destinations'], dtype=np.float64).reshape(-1, 2)
+        if len(origins) * len(destinations) > MAX_MATRIX_CELLS:
+            return error(f"At most {MAX_MATRIX_CELLS} origin-destination cells per request", 400)
+
+        departure = None
+        if data.get('departure'):
+            clock = datetime.strptime(data['departure'], '%H:%M')
+            departure = datetime.combine(datetime.now().date(), clock.time())
+        max_minutes = min(float(data.get('max_minutes', 180)), 24 * 60)
+        output = data.get('format', 'npy')
+        if output not in ('npy', 'raw'):
+            raise ValueError("format must be npy or raw")
+    except (TypeError, ValueError):
+        return error("Invalid origins, destinations, departure or format", 400)
+
+    def compute():
+        matrix = travel_time_matrix(origins, destinations, departure, max_minutes=max_minutes)
+        if output == 'npy':
+            buffer = io.BytesIO()
+            np.save(buffer, matrix)
+            return matrix.shape, buffer.getvalue()
+        return matrix.shape, matrix.astype('<i4').tobytes()
+
+    try:
+        shape, body = await offload(compute)
+        return Response(body, media_type='application/octet-stream', headers={
+            'X-Matrix-Shape': f"{shape[0]},{shape[1]}",
+            'X-Matrix-Unreachable': str(UNREACHABLE),
+        })
+
+    except Overloaded:
+        raise
+    except Exception as e:
+        return error(str(e), 500)
+
+
+async def health_check(request):
+    """Health check endpoint"""
+    planner = get_planner()
+    transit_db = get_transit_db()
+
+    return JSON({
+        'status': 'healthy',
+        'buses_tracked': len(planner.buses),
+        'routes_active': len(planner.routes),
+        'last_update': planner.last_update.isoformat() if planner.last_update else None,
+        'static_data_version': transit_db.version if transit_db.exists() else None,
+        'plan_cache': planner.plan_cache.stats(),
+        'vehicle_history': planner.arrival_predictor.history.stats(),
+        'arrival_boards': planner.arrival_boards.stats(),
+        'shared_feed': planner.shared_feed.stats() if planner.shared_feed is not None else None,
+        'feed': {
+            'age_seconds': round(time.time() - feed.fetched_at, 1) if feed.fetched_at else None,
+            'consecutive_failures': feed.failures,
+        },
+        'planner_queue': {'pending': _pending, 'max_pending': MAX_PENDING, 'threads': PLANNER_THREADS},
+        'data_source': 'Delhi Open Transit Data',
+        'mode': 'Real-time (Simple Planner with Arrival Predictions, asyncio)'
+    })
+
+
+async def get_metrics(request):
+    """Request latencies, feed and planner stage timings, cache and memory figures (Prometheus text format)"""
+    return Response(metrics.render(get_planner()), media_type=metrics.CONTENT_TYPE)
+
+
+class LatencyMiddleware:
+    """Observe each request's time to its last response byte (ASGI, so streams are covered)"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        status = [500]
+
+        async def timed_send(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, timed_send)
+        finally:
+            # Labelled by route, so unknown paths share one series
+            endpoint = scope['path'] if scope['path'] in ENDPOINTS else 'unmatched'
+            metrics.HTTP_LATENCY.observe(time.perf_counter() - started, endpoint, scope['method'],
+                                         str(status[0]))
+
+
+async def overloaded(request, exc):
+    return JSONResponse({"error": "Server busy, retry shortly"}, status_code=503,
+                        headers={'Retry-After': str(RETRY_AFTER_SECONDS)})
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Fork the matrix workers before the first thread of this process exists
+    start_pool()
+
+    # Building the planner loads static data: do it off the loop
+    planner = await asyncio.get_running_loop().run_in_executor(executor, get_planner)
+    planner.fetch_on_demand = False
+    get_transit_db().start_watcher()
+    get_arrival_predictor().start_cleanup()
+
+    client = httpx.AsyncClient()
+    refresher = asyncio.create_task(feed_refresher(client))
+    try:
+        yield
+    finally:
+        refresher.cancel()
+        await client.aclose()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+app = Starlette(
+    routes=[
+        Route("/api/live", get_live_bus_data, methods=["GET"]),
+        Route("/api/plan-route", plan_route, methods=["POST"]),
+        Route("/api/plan-route/batch", plan_route_batch, methods=["POST"]),
+        Route("/api/nearby-buses", get_nearby_buses, methods=["GET"]),
+        Route("/api/routes", get_active_routes, methods=["GET"]),
+        Route("/api/realtime-arrivals", get_realtime_arrivals, methods=["GET"]),
+        Route("/api/isochrone", get_isochrone, methods=["GET"]),
+        Route("/api/matrix", get_travel_time_matrix, methods=["POST"]),
+        Route("/api/health", health_check, methods=["GET"]),
+        Route("/metrics", get_metrics, methods=["GET"]),
+    ],
+    middleware=[Middleware(LatencyMiddleware), Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])],
+    exception_handlers={Overloaded: overloaded},
+    lifespan=lifespan,
+)
+
+ENDPOINTS = {route.path for route in app.routes}
+
+if __name__ == "__main__":
+    print("=" * 60)
+    print("🚌 Delhi Transit Route Planning Server (asyncio)")
+    print("=" * 60)
+    print("\nEndpoints:")
+    print("  GET  /api/live               - Live bus positions")
+    print("  POST /api/plan-route         - Plan a route")
+    print("  POST /api/plan-route/batch   - Plan many OD pairs (NDJSON stream)")
+    print("  GET  /api/nearby-buses       - Find nearby buses")
+    print("  GET  /api/realtime-arrivals  - Real-time arrival predictions")
+    print("  GET  /api/isochrone          - Reachable stops/area within N minutes")
+    print("  POST /api/matrix             - Many-to-many travel-time matrix (binary)")
+    print("  GET  /api/routes             - Active routes")
+    print("  GET  /api/health             - Health check")
+    print("  GET  /metrics                - Prometheus metrics")
+    print(f"Feed refreshed every {FEED_REFRESH_SECONDS}s in the background; "
+          f"{PLANNER_THREADS} planner threads, {MAX_PENDING} queued jobs at most")
+    print("\nStarting server on http://localhost:5000")
+    print("=" * 60)
+    print()
+
+    uvicorn.run(app, host="127.0.0.1", port=5000)
@@ -0,0 +1,65 @@
+"""Small synthetic timetables for the routing tests"""
+
+import sqlite3
+from datetime import date, timedelta
+
+from route_planner.raptor import Timetable
+from route_planner.service_calendar import ServiceCalendar
+
+DAY = date(2024, 3, 5)
+DAY_SECONDS = 86400
+
+
+def build_network(trips, n_stops, spacing=0.05):
+    """
+    In-memory GTFS tables for trips given as (trip_id, route_id, service_id,
+    [(stop, arrival, departure), ...]) with times in seconds, and stop i at
+    latitude 28.5 + spacing * i (the default 5 km keeps stops out of walking
+    range, so every search starts from exactly one stop)
+    """
+    conn = sqlite3.connect(':memory:')
+    conn.execute("CREATE TABLE stops (stop_id TEXT, stop_name TEXT, stop_lat REAL, stop_lon REAL)")
+    conn.execute("CREATE TABLE trips (trip_id TEXT, route_id TEXT, service_id TEXT)")
+    conn.execute("CREATE TABLE stop_times (trip_id TEXT, stop_id TEXT, arrival_time TEXT, "
+                 "departure_time TEXT, stop_sequence INTEGER)")
+    conn.execute("CREATE TABLE calendar_dates (service_id TEXT, date TEXT, exception_type INTEGER)")
+
+    conn.executemany("INSERT INTO stops VALUES (?, ?, ?, ?)",
+                     [(f"S{i}", f"Stop {i}", 28.5 + spacing * i, 77.2) for i in range(n_stops)])
+    for trip_id, route_id, service_id, calls in trips:
+        conn.execute("INSERT INTO trips VALUES (?, ?, ?)", (trip_id, route_id, service_id))
+        conn.executemany("INSERT INTO stop_times VALUES (?, ?, ?, ?, ?)", [
+            (trip_id, f"S{stop}", hms(arrival), hms(departure), seq)
+            for seq, (stop, arrival, departure) in enumerate(calls)
+        ])
+    yesterday = (DAY - timedelta(days=1)).strftime('%Y%m%d')
+    today = DAY.strftime('%Y%m%d')
+    conn.executemany("INSERT INTO calendar_dates VALUES (?, ?, 1)", [
+        ('yesterday', yesterday), ('today', today), ('daily', yesterday), ('daily', today),
+    ])
+
+    timetable = Timetable.build(conn)
+    calendar = ServiceCalendar.build(conn, today=DAY)
+    return timetable, calendar
+
+
+def hms(seconds):
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def random_trips(rng, n_stops, n_routes=12):
+    trips = []
+    for r in range(n_routes):
+        stops = rng.sample(range(n_stops), rng.randint(2, 5))
+        service = rng.choice(['today', 'yesterday', 'daily'])
+        for t in range(rng.randint(1, 6)):
+            # Mostly around midnight, sometimes well past 24:00:00
+            clock = rng.randint(22 * 3600, 27 * 3600) if rng.random() < 0.7 else rng.randint(0, 3 * 3600)
+            calls = []
+            for stop in stops:
+                arrival = clock
+                clock += rng.randint(0, 120)
+                calls.append((stop, arrival, clock))
+                clock += rng.randint(180, 1200)
+            trips.append((f"R{r}T{t}", f"R{r}", service, calls))
+    return trips
@@ -0,0 +1,217 @@
+"""Conditional, resumable GTFS downloads against a local HTTP stand-in"""
+
+import io
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from route_planner import gtfs_downloader
+from route_planner.gtfs_downloader import META_FILE, download_gtfs_data, recover_interrupted_swap
+
+
+def make_feed(version):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as zf:
+        for name in gtfs_downloader.REQUIRED_FILES:
+            # Incompressible padding so the zip is large enough to truncate
+            zf.writestr(name, f"v{version}\n" + (name * 4000))
+    return buffer.getvalue()
+
+
+class FeedServer:
+    """Serves one zip with ETag/Last-Modified, Range and If-Range support"""
+
+    def __init__(self):
+        self.requests = []
+        self.truncate_at = None         # close the connection after this many body bytes
+        self.bogus_range = False        # answer ranges with a different start
+        self.weak_etag = False
+        self.set_feed(1)
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.requests.append(dict(self.headers))
+                server.handle(self)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/GTFS.zip"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def set_feed(self, version):
+        self.body = make_feed(version)
+        self.etag = f'"feed-{version}"'
+        self.last_modified = f"Mon, 0{version} Jan 2024 00:00:00 GMT"
+
+    def handle(self, h):
+        etag = f"W/{self.etag}" if self.weak_etag else self.etag
+        if h.headers.get('If-None-Match') == etag:
+            h.send_response(304)
+            h.end_headers()
+            return
+        start = 0
+        range_header = h.headers.get('Range')
+        if_range = h.headers.get('If-Range')
+        if range_header and if_range in (None, self.etag, self.last_modified):
+            start = int(range_header.split('=')[1].rstrip('-'))
+            if self.bogus_range:
+                start = max(0, start - 10)
+        body = self.body[start:]
+        h.send_response(206 if start else 200)
+        if start:
+            h.send_header('Content-Range', f"bytes {start}-{len(self.body) - 1}/{len(self.body)}")
+        h.send_header('Content-Length', str(len(body)))
+        h.send_header('ETag', etag)
+        h.send_header('Last-Modified', self.last_modified)
+        h.end_headers()
+        if self.truncate_at is not None:
+            h.wfile.write(body[:self.truncate_at])
+            h.wfile.flush()
+            h.close_connection = True
+            return
+        h.wfile.write(body)
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def server(monkeypatch):
+    # Small reads, so the chunks before a dropped connection reach the part file
+    monkeypatch.setattr(gtfs_downloader, 'CHUNK_SIZE', 256)
+    server = FeedServer()
+    yield server
+    server.close()
+
+
+def read_version(data_dir):
+    return (data_dir / 'routes.txt').read_text().splitlines()[0]
+
+
+def test_unchanged_feed_is_a_304(server, tmp_path):
+    data_dir = tmp_path / 'gtfs_data'
+    download_gtfs_data(url=server.url, data_dir=data_dir)
+    download_gtfs_data(url=server.url, data_dir=data_dir)
+
+    assert server.requests[1].get('If-None-Match') == '"feed-1"'
+    assert read_version(data_dir) == 'v1'
+    assert (data_dir / META_FILE).exists()
+
+
+def test_changed_feed_replaces_data(server, tmp_path):
+    data_dir = tmp_path / 'gtfs_data'
+    download_gtfs_data(url=server.url, data_dir=data_dir)
+    server.set_feed(2)
+    download_gtfs_data(url=server.url, data_dir=data_dir)
+
+    assert read_version(data_dir) == 'v2'
+    assert not (tmp_path / 'gtfs_data.old').exists()
+    assert not (tmp_path / 'gtfs_data.staging').exists()
+
+
+def test_truncated_download_resumes(server, tmp_path, capsys):
+    data_dir = tmp_path / 'gtfs_data'
+    part_path = tmp_path / 'gtfs_data.zip.part'
+    server.truncate_at = 1000
+    with pytest.raises((requests.exceptions.RequestException, IOError)):
+        download_gtfs_data(url=server.url, data_dir=data_dir)
+    output = capsys.readouterr().out
+    assert "Error downloading" in output and "re-run to resume" in output
+    kept = part_path.stat().st_size
+    assert 0 < kept <= 1000
+    assert not data_dir.exists()
+
+    server.truncate_at = None
+    download_gtfs_data(url=server.url, data_dir=data_dir)
+
+    assert server.requests[1]['Range'] == f'bytes={kept}-'
+    assert server.requests[1]['If-Range'] == '"feed-1"'
+    assert read_version(data_dir) == 'v1'
+    assert not part_path.exists()
+
+
+def test_checksum_mismatch_is_reported_as_verification(server, tmp_path, capsys):
+    data_dir = tmp_path / 'gtfs_data'
+    with pytest.raises(IOError, match="Checksum mismatch"):
+        download_gtfs_data(url=server.url, data_dir=data_dir, expected_sha256='0' * 64)
+    output = capsys.readouterr().out
+    assert "Error verifying" in output and "re-run to resume" not in output
+    assert not (tmp_path / 'gtfs_data.zip.part').exists()
+    assert not data_dir.exists()
+
+
+def test_corrupt_zip_is_not_kept_for_resume(server, tmp_path, capsys):
+    data_dir = tmp_path / 'gtfs_data'
+    server.body = b"not a zip" * 100
+    with pytest.raises(zipfile.BadZipFile):
+        download_gtfs_data(url=server.url, data_dir=data_dir)
+    assert "Error extracting" in capsys.readouterr().out
+    assert not (tmp_path / 'gtfs_data.zip.part').exists()
+
+
+def test_feed_changed_mid_resume_starts_over(server, tmp_path):
+    data_dir = tmp_path / 'gtfs_data'
+    server.truncate_at = 1000
+    with pytest.raises((requests.exceptions.RequestException, IOError)):
+        download_gtfs_data(url=server.url, data_dir=data_dir)
+
+    # If-Range no longer matches, so the server sends the new file in full
+    server.truncate_at = None
+    server.set_feed(2)
+    download_gtfs_data(url=server.url, data_dir=data_dir)
+
+    assert read_version(data_dir) == 'v2'
+
+
+def test_mismatched_range_restarts_without_range(server, tmp_path):
+    data_dir = tmp_path / 'gtfs_data'
+    server.truncate_at = 1000
+    with pytest.raises((requests.exceptions.RequestException, IOError)):
+        download_gtfs_data(url=server.url, data_dir=data_dir)
+
+    server.truncate_at = None
+    server.bogus_range = True
+    download_gtfs_data(url=server.url, data_dir=data_dir)
+
+    assert 'Range' in server.requests[1]
+    assert 'Range' not in server.requests[2]
+    assert read_version(data_dir) == 'v1'
+
+
+def test_weak_etag_is_not_used_for_if_range(server, tmp_path):
+    data_dir = tmp_path / 'gtfs_data'
+    server.weak_etag = True
+    server.truncate_at = 1000
+    with pytest.raises((requests.exceptions.RequestException, IOError)):
+        download_gtfs_data(url=server.url, data_dir=data_dir)
+
+    server.truncate_at = None
+    download_gtfs_data(url=server.url, data_dir=data_dir)
+
+    assert server.requests[1]['If-Range'] == server.last_modified
+    assert read_version(data_dir) == 'v1'
+
+
+def test_interrupted_swap_is_recovered(server, tmp_path):
+    data_dir = tmp_path / 'gtfs_data'
+    download_gtfs_data(url=server.url, data_dir=data_dir)
+
+    # Crash after the first rename: only gtfs_data.old is left
+    data_dir.rename(tmp_path / 'gtfs_data.old')
+    assert recover_interrupted_swap(data_dir)
+    assert read_version(data_dir) == 'v1'
+
+    # Crash with a complete staging directory: it wins over the old feed
+    data_dir.rename(tmp_path / 'gtfs_data.staging')
+    (tmp_path / 'gtfs_data.old').mkdir()
+    assert recover_interrupted_swap(data_dir)
+    assert read_version(data_dir) == 'v1'
+    assert not recover_interrupted_swap(data_dir)
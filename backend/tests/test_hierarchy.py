@@ -0,0 +1,71 @@
+"""Contraction hierarchy queries against plain Dijkstra on small synthetic networks"""
+
+import random
+
+import numpy as np
+import pytest
+
+from route_planner.hierarchy import CHANGE, ContractionHierarchy
+from route_planner.network import TransitNetwork
+from route_planner.transfers import TransferTable
+from synthetic import build_network, random_trips
+
+
+def network_and_hierarchy(seed, n_stops=12):
+    rng = random.Random(seed)
+    trips = random_trips(rng, n_stops, n_routes=8)
+    # ~330 m apart, so neighbouring stops are joined by walks
+    timetable, calendar = build_network(trips, n_stops, spacing=0.003)
+    transfers = TransferTable.build(timetable.stop_lat, timetable.stop_lon)
+    network = TransitNetwork(timetable, transfers, calendar)
+    return network, ContractionHierarchy.build(network, verbose=False)
+
+
+@pytest.mark.parametrize('seed', range(8))
+def test_matches_dijkstra_for_every_stop_pair(seed):
+    network, hierarchy = network_and_hierarchy(seed)
+    n_nodes = network.n_nodes
+    assert hierarchy.n_states == n_nodes + network.n_stops
+
+    for a in range(network.n_stops):
+        seconds, _, _ = network.search([a], [0])
+        for b in range(network.n_stops):
+            expected = min(seconds[b], seconds[n_nodes + b])
+            result, _ = hierarchy.query([n_nodes + a], [0], {b: 0, n_nodes + b: 0})
+            got = result[0] if result else float('inf')
+            assert got == expected, (a, b)
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_unpacked_paths_are_connected_and_add_up(seed):
+    network, hierarchy = network_and_hierarchy(seed)
+    n_nodes = network.n_nodes
+
+    for a in range(network.n_stops):
+        for b in range(network.n_stops):
+            result, _ = hierarchy.query([n_nodes + a], [0], {b: 0, n_nodes + b: 0})
+            if result is None:
+                continue
+            cost, target, source, path = result
+            assert source == n_nodes + a
+            assert target in (b, n_nodes + b)
+            if not path:
+                assert source == target and cost == 0
+                continue
+            assert path[0][1] == source and path[-1][2] == target
+            assert all(x[2] == y[1] for x, y in zip(path, path[1:]))
+            assert sum(0 if e == CHANGE else int(network.edge_seconds[e]) for e, _, _ in path) == cost
+
+
+def test_save_and_load_round_trip(tmp_path):
+    network, hierarchy = network_and_hierarchy(0)
+    path = tmp_path / 'transit.ch.npz'
+    hierarchy.save(path)
+    loaded = ContractionHierarchy.load(path)
+
+    assert loaded.n_shortcuts == hierarchy.n_shortcuts
+    for name in ContractionHierarchy.ARRAYS:
+        assert np.array_equal(getattr(loaded, name), getattr(hierarchy, name))
+    n_nodes = network.n_nodes
+    query = ([n_nodes], [0], {network.n_stops - 1: 0, n_nodes + network.n_stops - 1: 0})
+    assert loaded.query(*query) == hierarchy.query(*query)
@@ -0,0 +1,108 @@
+"""Plan cache buckets, invalidation, expiry and walk re-anchoring"""
+
+from route_planner.plan_cache import LIVE, METRO, PlanCache, plan_kind
+
+START = (28.61391, 77.20902)
+END = (28.55012, 77.25011)
+NOW = 1_700_000_000.0
+
+
+def walk(a, b):
+    return {'mode': 'WALK', 'path': [{'lat': a[0], 'lng': a[1]}, {'lat': b[0], 'lng': b[1]}]}
+
+
+def route(mode, timed=False, start=START, end=END):
+    station_a, station_b = (28.612, 77.21), (28.551, 77.249)
+    details = {'mode': mode.lower()}
+    if timed:
+        details['departure_time'] = '08:30'
+    return {
+        'routeDetails': details,
+        'segments': [
+            walk(start, station_a),
+            {'mode': mode, 'path': [{'lat': 28.612, 'lng': 77.21}, {'lat': 28.551, 'lng': 77.249}]},
+            walk(station_b, end),
+        ],
+    }
+
+
+def put(cache, result, snapshot=1, version='v1', now=NOW, **kwargs):
+    cache.put(*START, *END, version, snapshot, result, now=now, **kwargs)
+
+
+def get(cache, snapshot=1, version='v1', now=NOW, start=START, end=END):
+    return cache.get(*start, *end, version, snapshot, now=now)
+
+
+def test_kinds():
+    assert plan_kind({'routes': [route('METRO')]}) == METRO
+    assert plan_kind({'routes': [route('METRO'), route('BUS')]}) == LIVE
+    # Timetable results show departure times, so they never get the long bucket
+    assert plan_kind({'routes': [route('METRO', timed=True)]}) == LIVE
+    assert plan_kind({'routes': []}) == LIVE
+
+
+def test_untimed_metro_plans_survive_new_snapshots():
+    cache = PlanCache()
+    put(cache, {'routes': [route('METRO')]})
+    assert get(cache, snapshot=2, now=NOW + 300) is not None
+
+    put(cache, {'routes': [route('BUS')]}, snapshot=2, now=NOW + 300)
+    assert get(cache, snapshot=3, now=NOW + 300)['routes'][0]['routeDetails']['mode'] == 'metro'
+
+
+def test_live_plans_end_with_their_snapshot_and_bucket():
+    cache = PlanCache()
+    put(cache, {'routes': [route('BUS')]})
+    assert get(cache) is not None
+    assert get(cache, snapshot=2) is None
+
+    put(cache, {'routes': [route('BUS')]}, snapshot=2)
+    assert get(cache, snapshot=2, now=NOW + 120) is None
+
+
+def test_static_version_drops_everything():
+    cache = PlanCache()
+    put(cache, {'routes': [route('METRO')]})
+    assert get(cache, version='v2') is None
+
+
+def test_timed_plans_expire_at_first_departure():
+    cache = PlanCache()
+    result = {'routes': [route('METRO', timed=True)]}
+    bucket_start = NOW - NOW % 60
+    put(cache, result, now=bucket_start, valid_until=bucket_start + 20)
+
+    assert get(cache, now=bucket_start + 19) is not None
+    assert get(cache, now=bucket_start + 20) is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_walks_are_reanchored_to_the_request():
+    cache = PlanCache()
+    put(cache, {'routes': [route('METRO')]})
+
+    # Same ~110 m grid cells, slightly different points
+    start, end = (START[0] + 0.0002, START[1] - 0.0001), (END[0] - 0.0001, END[1] + 0.0002)
+    segments = get(cache, start=start, end=end)['routes'][0]['segments']
+    assert segments[0]['path'][0] == {'lat': start[0], 'lng': start[1]}
+    assert segments[0]['path'][-1] == {'lat': 28.612, 'lng': 77.21}
+    assert segments[-1]['path'][0] == {'lat': 28.551, 'lng': 77.249}
+    assert segments[-1]['path'][-1] == {'lat': end[0], 'lng': end[1]}
+
+    # The cached plan still holds the first request's points
+    segments = get(cache)['routes'][0]['segments']
+    assert segments[0]['path'][0] == {'lat': START[0], 'lng': START[1]}
+    assert segments[-1]['path'][-1] == {'lat': END[0], 'lng': END[1]}
+
+
+def test_lru_bound_and_errors():
+    cache = PlanCache(max_entries=2)
+    put(cache, {'error': 'no data'})
+    assert cache.stats()['entries'] == 0
+
+    for i in range(3):
+        cache.put(28.5 + i * 0.01, 77.2, *END, 'v1', 1, {'routes': [route('BUS')]}, now=NOW)
+    assert cache.stats()['entries'] == 2
+    assert cache.stats()['evictions'] == 1
+    assert cache.get(28.5, 77.2, *END, 'v1', 1, now=NOW) is None
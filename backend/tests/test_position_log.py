@@ -0,0 +1,53 @@
+"""Position log partitions and reads, and which reports get logged"""
+
+import time
+
+from route_planner import arrival_predictor
+from route_planner.arrival_predictor import ArrivalPredictor
+from route_planner.position_log import PositionLog
+from route_planner.speed_profiles import SpeedProfiles
+
+HOUR = 3600
+NOW = 1_700_000_000 - 1_700_000_000 % HOUR
+
+
+def test_reads_span_partitions_and_filter_vehicles(tmp_path):
+    log = PositionLog(tmp_path, retention_hours=10 ** 6)
+    log.append(['a', 'b'], ['R1', None], [28.6, 28.7], [77.2, 77.3], [NOW - 10, NOW + 10])
+    log.append(['a'], ['R1'], [28.61], [77.2], [NOW + 20])
+    assert sorted(p.name for p in tmp_path.glob('*.bin')) == [
+        time.strftime('%Y%m%d%H.bin', time.gmtime(NOW - HOUR)),
+        time.strftime('%Y%m%d%H.bin', time.gmtime(NOW)),
+    ]
+
+    records = log.read(NOW - HOUR, NOW + HOUR)
+    assert records['timestamp'].tolist() == [NOW - 10, NOW + 10, NOW + 20]
+    assert records['vehicle_id'].tolist() == ['a', 'b', 'a']
+    assert records['route_id'].tolist() == ['R1', '', 'R1']
+
+    records = log.read(NOW, NOW + 15, vehicle_ids=['a', 'b', 'c'])
+    assert records['vehicle_id'].tolist() == ['b']
+
+    # Dictionaries survive a reopen
+    assert PositionLog(tmp_path).read(NOW + 20, NOW + 21)['vehicle_id'].tolist() == ['a']
+
+
+def test_old_partitions_are_pruned(tmp_path):
+    log = PositionLog(tmp_path, retention_hours=1)
+    now = int(time.time())
+    log.append(['a', 'a'], ['R1', 'R1'], [28.6, 28.6], [77.2, 77.2], [now - 5 * HOUR, now])
+    assert len(list(tmp_path.glob('*.bin'))) == 1
+    assert log.read(now - 6 * HOUR, now + 1)['timestamp'].tolist() == [now]
+
+
+def test_update_from_feed_returns_only_new_reports(monkeypatch):
+    monkeypatch.setattr(arrival_predictor, 'get_speed_profiles', SpeedProfiles)
+    predictor = ArrivalPredictor()
+    buses = [
+        {'id': 'a', 'lat': 28.6, 'lon': 77.2, 'route_id': 'R1', 'trip_id': '', 'timestamp': NOW},
+        {'id': 'b', 'lat': 28.7, 'lon': 77.3, 'route_id': 'R2', 'trip_id': '', 'timestamp': 0},
+    ]
+    assert sorted(predictor.update_from_feed(buses, NOW).tolist()) == [0, 1]
+
+    # The next refresh repeats 'a' and brings a new fix for 'b'
+    assert predictor.update_from_feed(buses, NOW + 30).tolist() == [1]
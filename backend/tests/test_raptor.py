@@ -0,0 +1,124 @@
+"""RAPTOR against a brute-force connection scan on small synthetic timetables"""
+
+import random
+from datetime import datetime, time, timedelta
+
+import numpy as np
+import pytest
+
+from route_planner import raptor
+from route_planner.raptor import INF, RaptorRouter
+from route_planner.transfers import TransferTable
+from synthetic import DAY, DAY_SECONDS, build_network, random_trips
+
+
+def connection_scan(trips, origin, t0, n_stops):
+    """Earliest arrival at every stop, from today's trips and last night's (shifted)"""
+    connections = []
+    for trip_id, _, service_id, calls in trips:
+        for day, shift in (('today', 0), ('yesterday', DAY_SECONDS)):
+            if service_id not in (day, 'daily'):
+                continue
+            for (a, _, dep), (b, arr, _) in zip(calls, calls[1:]):
+                connections.append((dep - shift, arr - shift, a, b, (trip_id, day)))
+    connections.sort(key=lambda c: (c[0], c[1]))
+
+    earliest = [INF] * n_stops
+    earliest[origin] = t0
+    boarded = set()
+    for dep, arr, a, b, trip in connections:
+        if trip in boarded or earliest[a] <= dep:
+            boarded.add(trip)
+            earliest[b] = min(earliest[b], arr)
+    return earliest
+
+
+def reach(router, timetable, origin, t0):
+    departure = datetime.combine(DAY, time()) + timedelta(seconds=t0)
+    _, arrival = router.reach(float(timetable.stop_lat[origin]), float(timetable.stop_lon[origin]),
+                              departure, max_seconds=2 * DAY_SECONDS, max_transfers=12,
+                              max_walk_km=0.01)
+    order = [timetable.stop_index(f"S{i}") for i in range(len(timetable.stop_ids))]
+    return [int(arrival[i]) for i in order]
+
+
+@pytest.fixture(autouse=True)
+def no_change_time(monkeypatch):
+    # The connection scan has no minimum change time either
+    monkeypatch.setattr(raptor, 'MIN_CHANGE_SECONDS', 0)
+
+
+def test_boards_last_nights_trips_after_midnight():
+    trips = [
+        ('late', 'R1', 'yesterday', [(0, 24 * 3600 + 600, 24 * 3600 + 600), (1, 24 * 3600 + 1800, 24 * 3600 + 1800)]),
+        ('early', 'R1', 'today', [(0, 3600, 3600), (1, 4800, 4800)]),
+    ]
+    timetable, calendar = build_network(trips, 2)
+    router = RaptorRouter(timetable, calendar)
+
+    assert reach(router, timetable, 0, 300)[1] == 1800
+    assert reach(router, timetable, 0, 900)[1] == 4800
+
+    departure = datetime.combine(DAY, time(0, 5))
+    journeys = router.plan(28.5, 77.2, 28.55, 77.2, departure, max_walk_km=0.01)
+    ride = [leg for leg in journeys[0]['legs'] if leg['mode'] == 'BUS'][0]
+    assert ride['trip_id'] == 'late'
+    assert (ride['departure'], ride['arrival']) == (600, 1800)
+
+
+@pytest.mark.parametrize('seed', range(25))
+def test_matches_connection_scan(seed):
+    rng = random.Random(seed)
+    n_stops = 8
+    trips = random_trips(rng, n_stops)
+    timetable, calendar = build_network(trips, n_stops)
+    router = RaptorRouter(timetable, calendar)
+
+    for _ in range(5):
+        origin = rng.randrange(n_stops)
+        t0 = rng.randint(0, 4 * 3600)
+        expected = connection_scan(trips, origin, t0, n_stops)
+        assert reach(router, timetable, origin, t0) == expected
+
+
+def test_plan_arrival_matches_connection_scan():
+    rng = random.Random(7)
+    n_stops = 8
+    trips = random_trips(rng, n_stops)
+    timetable, calendar = build_network(trips, n_stops)
+    router = RaptorRouter(timetable, calendar)
+
+    for origin in range(n_stops):
+        t0 = 1800
+        expected = connection_scan(trips, origin, t0, n_stops)
+        for target in range(n_stops):
+            if target == origin:
+                continue
+            departure = datetime.combine(DAY, time()) + timedelta(seconds=t0)
+            journeys = router.plan(28.5 + 0.05 * origin, 77.2, 28.5 + 0.05 * target, 77.2, departure,
+                                   max_transfers=12, max_walk_km=0.01)
+            arrival = journeys[-1]['arrival'] if journeys else INF
+            assert arrival == expected[target]
+            for journey in journeys:
+                rides = [leg for leg in journey['legs'] if leg['mode'] != 'WALK']
+                assert all(a['arrival'] <= b['departure'] for a, b in zip(rides, rides[1:]))
+                assert np.all(np.diff([leg['departure'] for leg in rides]) >= 0)
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_pareto_earliest_arrival_matches_plan(seed):
+    rng = random.Random(seed)
+    n_stops = 12
+    # ~330 m apart: many trips are quickest on foot through a stop
+    timetable, calendar = build_network(random_trips(rng, n_stops), n_stops, spacing=0.003)
+    router = RaptorRouter(timetable, calendar, TransferTable.build(timetable.stop_lat, timetable.stop_lon))
+
+    for origin in range(n_stops):
+        for target in range(n_stops):
+            departure = datetime.combine(DAY, time()) + timedelta(seconds=rng.randint(0, 3 * 3600))
+            args = (28.5 + 0.003 * origin, 77.2, 28.5 + 0.003 * target, 77.2, departure)
+            fastest = router.plan(*args)
+            frontier = router.plan_pareto(*args)
+            assert bool(frontier) == bool(fastest)
+            if fastest:
+                assert frontier[0]['arrival'] == fastest[-1]['arrival']
@@ -0,0 +1,77 @@
+"""Arrivals near a stop: board rows plus buses the boards could not place"""
+
+import time
+
+import pytest
+
+from route_planner import arrival_predictor, eta_engine
+from route_planner.arrival_boards import ArrivalBoards
+from route_planner.arrival_predictor import ArrivalPredictor
+from route_planner.raptor import RaptorRouter
+from route_planner.simple_planner import SimpleRoutePlanner
+from route_planner.speed_profiles import SpeedProfiles
+from synthetic import build_network
+
+SPACING = 0.003     # ~330 m, so a location near one stop snaps to it alone
+
+
+class RouteNames:
+    def get_route_info(self, route_id, mode='bus'):
+        return {'name': f"Route {route_id}"}
+
+
+@pytest.fixture
+def planner(monkeypatch):
+    # Route R1 runs S0 -> S3 every morning; route X9 is not in the static data
+    hour = 8 * 3600
+    trips = [('R1T1', 'R1', 'daily', [(i, hour + 300 * i, hour + 300 * i) for i in range(4)])]
+    timetable, calendar = build_network(trips, 4, spacing=SPACING)
+    router = RaptorRouter(timetable, calendar)
+    monkeypatch.setattr(eta_engine, 'get_raptor_router', lambda: router)
+    monkeypatch.setattr(eta_engine, 'get_shape_index', lambda: None)
+    monkeypatch.setattr(arrival_predictor, 'get_speed_profiles', SpeedProfiles)
+
+    feed_time = int(time.time())
+    buses = [
+        {'id': 'placed', 'lat': 28.5, 'lon': 77.2, 'route_id': 'R1', 'trip_id': 'R1T1', 'timestamp': feed_time},
+        {'id': 'ghost', 'lat': 28.5 + 2.5 * SPACING, 'lon': 77.2, 'route_id': 'X9', 'trip_id': 'X9T1',
+         'timestamp': feed_time},
+    ]
+    predictor = ArrivalPredictor()
+    predictor.update_from_feed(buses, feed_time)
+    boards = ArrivalBoards(RouteNames())
+    boards.refresh(buses, predictor, feed_time)
+
+    planner = SimpleRoutePlanner.__new__(SimpleRoutePlanner)
+    planner.buses = buses
+    planner.routes = {'R1': buses[:1], 'X9': buses[1:]}
+    planner.last_update = None
+    planner.fetch_on_demand = False
+    planner.shared_feed = None
+    planner.route_mapper = RouteNames()
+    planner.arrival_predictor = predictor
+    planner.arrival_boards = boards
+    return planner
+
+
+def test_near_a_stop_unplaced_buses_are_still_predicted(planner):
+    lat, lon = 28.5 + 2 * SPACING, 77.2
+    assert len(planner.arrival_boards.stops_near(lat, lon)) == 1
+
+    arrivals = planner.get_realtime_arrivals(lat, lon)
+    by_bus = {arrival['bus_id']: arrival for arrival in arrivals}
+    assert set(by_bus) == {'placed', 'ghost'}
+    assert by_bus['placed']['stop_id'] == 'S2'
+    assert 'stop_id' not in by_bus['ghost']
+    assert [a['eta_minutes'] for a in arrivals] == sorted(a['eta_minutes'] for a in arrivals)
+
+
+def test_route_filter_missing_from_the_board(planner):
+    lat, lon = 28.5 + 2 * SPACING, 77.2
+    assert [a['bus_id'] for a in planner.get_realtime_arrivals(lat, lon, route_id='X9')] == ['ghost']
+    assert [a['bus_id'] for a in planner.get_realtime_arrivals(lat, lon, route_id='R1')] == ['placed']
+
+
+def test_full_board_is_not_topped_up(planner):
+    lat, lon = 28.5 + 2 * SPACING, 77.2
+    assert [a['bus_id'] for a in planner.get_realtime_arrivals(lat, lon, limit=1)] == ['placed']
@@ -0,0 +1,127 @@
+"""Vehicle history ring buffers, deduplication, memory budget and TTL eviction"""
+
+import time
+
+import numpy as np
+import pytest
+
+from route_planner.vehicle_history import VehicleHistory
+
+NOW = 1_700_000_000
+KM_PER_DEGREE = 111.195     # Along a meridian, as haversine_km sees it
+
+
+def ingest(history, reports, received=None):
+    """reports: [(vehicle id, timestamp, lat, lon), ...]"""
+    ids, times, lat, lon = zip(*reports)
+    return history.ingest(list(ids), lat, lon, times, received=received).tolist()
+
+
+def test_ring_buffer_keeps_the_last_depth_reports():
+    history = VehicleHistory(depth=4)
+    for i in range(6):
+        ingest(history, [('bus', NOW + 30 * i, 28.6 + 0.001 * i, 77.2)])
+
+    assert history.sample_count('bus') == 4
+    times, lat, _ = history.recent('bus', n=10)
+    assert times.tolist() == [NOW + 30 * i for i in range(2, 6)]
+    assert np.allclose(lat, [28.6 + 0.001 * i for i in range(2, 6)])
+    assert history.recent('bus', n=1)[0].tolist() == [NOW + 150]
+    assert history.recent('tram')[0].size == 0
+
+
+def test_repeated_and_out_of_order_reports_are_dropped():
+    history = VehicleHistory(depth=4)
+    assert ingest(history, [('a', NOW, 28.6, 77.2), ('b', NOW, 28.7, 77.3)]) == [0, 1]
+
+    # Same timestamp again, an older one, and two of 'b' in one batch
+    recorded = ingest(history, [
+        ('a', NOW, 28.61, 77.2),
+        ('b', NOW + 20, 28.70, 77.3),
+        ('a', NOW - 10, 28.62, 77.2),
+        ('b', NOW + 40, 28.71, 77.3),
+    ])
+    assert recorded == [3]
+    assert history.sample_count('a') == 1
+    assert history.recent('a', n=1)[1][0] == pytest.approx(28.6)
+    assert history.recent('b', n=4)[0].tolist() == [NOW, NOW + 40]
+
+
+def test_speed_over_the_last_reports_and_heading():
+    history = VehicleHistory()
+    assert ingest(history, [('bus', NOW, 28.60, 77.2)]) == [0]
+    assert history.speed('bus') is None
+
+    # Northbound, 0.01 degrees a minute, then a stop for a minute
+    for i, t in enumerate([60, 120, 180], start=1):
+        ingest(history, [('bus', NOW + t, 28.60 + 0.01 * min(i, 2), 77.2)])
+
+    # Last three reports: 0.01 degrees in 120 seconds
+    assert history.speed('bus') == pytest.approx(0.01 * KM_PER_DEGREE / 120 * 3600, rel=1e-3)
+    slot = history.slot_of('bus')
+    # The stop did not move it, so the heading is still the last real move
+    assert history.heading[slot] == pytest.approx(0.0, abs=0.5)
+
+    speeds, counts = history.motion(history.slots(['bus', 'unknown']))
+    assert counts.tolist() == [4, 0]
+    assert np.isnan(speeds[1])
+    lat, _ = history.positions(history.slots(['bus', 'unknown']), back=3)
+    assert lat[0] == pytest.approx(28.60)
+    assert np.isnan(lat[1])
+
+
+def test_grows_up_to_the_memory_budget_then_evicts_least_recently_seen():
+    depth = 4
+    history = VehicleHistory(depth=depth, capacity=1, max_bytes=3 * VehicleHistory.slot_bytes(depth))
+    assert history.max_slots == 3
+
+    for i, vehicle in enumerate(['a', 'b', 'c']):
+        ingest(history, [(vehicle, NOW + i, 28.6, 77.2)], received=NOW + i)
+    assert history.capacity == 3
+    assert history.sample_count('a') == 1
+
+    # 'a' reports again, so 'b' is now the least recently seen
+    ingest(history, [('a', NOW + 10, 28.61, 77.2)], received=NOW + 10)
+    ingest(history, [('d', NOW + 11, 28.6, 77.2)], received=NOW + 11)
+    assert history.slot_of('b') is None
+    assert {v for v in ['a', 'c', 'd'] if history.slot_of(v) is not None} == {'a', 'c', 'd'}
+    assert history.sample_count('a') == 2
+
+    # A batch bigger than the whole budget keeps what fits
+    recorded = ingest(history, [(f"x{i}", NOW + 20, 28.6, 77.2) for i in range(5)], received=NOW + 20)
+    assert len(recorded) == 3
+    stats = history.stats()
+    assert stats['vehicles'] == 3
+    assert stats['evicted_budget'] == 4
+    assert stats['rejected'] == 2
+    assert stats['bytes'] == history.nbytes() <= stats['max_bytes']
+
+
+def test_ttl_eviction_frees_slots_for_reuse():
+    history = VehicleHistory(depth=4, capacity=2)
+    ingest(history, [('old', NOW, 28.6, 77.2)], received=NOW)
+    ingest(history, [('new', NOW + 600, 28.6, 77.2)], received=NOW + 600)
+
+    assert history.evict_older_than(NOW + 300) == 1
+    assert history.slot_of('old') is None
+    assert history.speed('old') is None
+    assert history.stats()['evicted_ttl'] == 1
+
+    # The freed slot starts empty for the next vehicle
+    ingest(history, [('next', NOW + 700, 28.7, 77.3)], received=NOW + 700)
+    assert history.capacity == 2
+    assert history.sample_count('next') == 1
+    assert history.recent('next', n=4)[0].tolist() == [NOW + 700]
+
+
+def test_background_evictor_runs_without_feed_updates():
+    history = VehicleHistory(depth=4)
+    ingest(history, [('bus', NOW, 28.6, 77.2)], received=time.time() - 120)
+
+    thread = history.start_evictor(ttl=60, interval=0.01)
+    assert history.start_evictor() is thread
+    deadline = time.time() + 5
+    while len(history) and time.time() < deadline:
+        time.sleep(0.01)
+    assert len(history) == 0
+    assert history.stats()['evicted_ttl'] == 1